@@ -0,0 +1,368 @@
+"""Throughput and latency of the API under load, offline.
+
+Boots ``main:app`` with ``SIMSYNC_BACKEND=local`` (in-memory metadata, a
+temporary storage directory) and drives it through httpx's ASGI transport,
+so no network or Google service is involved. The app's lifespan runs as it
+would under uvicorn, so background work such as feed rebuilds and upload
+inspection competes with requests.
+
+Each Firestore, Storage and token verification call sleeps for an injected
+latency (``--firestore-ms``, ``--storage-ms``, ``--auth-ms``, with
+``--jitter``) in the thread that makes it, the way a blocking RPC holds its
+thread, and is counted per operation. Calls nested in another counted call,
+such as the reads behind ``get_all``, count once. Tokens are the user's uid
+and are checked by a stand-in for ``verify_firebase_token``; the token
+cache in front of it is the real one.
+
+Users are seeded as premium with files and community shares, then each
+scenario (``upload``, ``list``, ``browse``, ``download``, ``rate`` and a
+weighted ``mixed``) runs ``--requests`` requests at each ``--concurrency``,
+once the jobs started by earlier runs have finished. The JSON report gives
+per run throughput, p50/p95/p99 latency, status codes, the process's peak
+RSS so far and backend calls, including those of background work started
+during the run. Pass ``--compare`` an earlier report to get
+the change in throughput and p95 per run.
+
+Usage (from simsync/backend, after ``pip install -r requirements-dev.txt``):
+    python -m benchmarks.api_load --concurrency 1 16 64 --output baseline.json
+    python -m benchmarks.api_load --concurrency 1 16 64 --compare baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import inspect
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import httpx
+
+SCENARIOS = ['upload', 'list', 'browse', 'download', 'rate', 'mixed']
+MIXED_WEIGHTS = {'list': 35, 'browse': 30, 'download': 15, 'rate': 10, 'upload': 10}
+FILE_EXTENSIONS = ['package', 'package', 'package', 'ts4script', 'zip']
+
+# Stand-in methods that would be an RPC, by class: method name -> operation
+FIRESTORE_CALLS = {
+    'MemoryDocument': {'get': 'get'},
+    'MemoryQuery': {'stream': 'query'},
+    'MemoryAggregation': {'get': 'aggregate'},
+    'MemoryFirestore': {'get_all': 'batch_get', '_commit': 'commit'},
+    'MemoryTransaction': {'_begin': 'begin_transaction', '_rollback': 'rollback'},
+}
+STORAGE_CALLS = {
+    'LocalBlob': {name: name for name in [
+        'exists', 'reload', 'upload_from_file', 'upload_from_string', 'download_as_bytes',
+        'download_to_file', 'delete', 'make_public', 'create_resumable_upload_session',
+    ]},
+    'LocalBucket': {'get_blob': 'get_blob'},
+}
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 2)
+
+class Backends:
+    """Injected latency and call counts for the stand-in backends"""
+
+    def __init__(self, latency_ms: dict, jitter: float, seed: int):
+        self.latency = {backend: ms / 1000 for backend, ms in latency_ms.items()}
+        self.enabled = True
+        self.jitter = jitter
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._local = threading.local()
+
+    def delay(self, backend: str):
+        seconds = self.latency[backend] if self.enabled else 0
+        if seconds and self.jitter:
+            with self._lock:
+                seconds *= 1 + self._rng.uniform(-self.jitter, self.jitter)
+        return seconds
+
+    def take_calls(self):
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+    def instrument(self, owner, method_name: str, backend: str, operation: str):
+        original = getattr(owner, method_name)
+        operation = f"{backend}.{operation}"
+
+        @functools.wraps(original)
+        def call(*args, **kwargs):
+            if getattr(self._local, 'depth', 0):
+                return original(*args, **kwargs)
+            with self._lock:
+                self.calls[operation] += 1
+            seconds = self.delay(backend)
+            if seconds:
+                time.sleep(seconds)
+            self._local.depth = 1
+            try:
+                result = original(*args, **kwargs)
+                # Run generators here, so their nested calls aren't counted again
+                return iter(list(result)) if inspect.isgenerator(result) else result
+            finally:
+                self._local.depth = 0
+
+        setattr(owner, method_name, call)
+
+def boot(args, backends):
+    """Import ``main`` against the local backend with the stand-ins installed"""
+    os.environ['SIMSYNC_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_ROOT'] = args.storage_root
+    os.environ.setdefault('QUOTA_BACKEND', 'memory')
+    os.environ.setdefault('FIREBASE_PROJECT_ID', 'simsync-bench')
+
+    from routes import local_storage, memory_firestore, token_verifier
+    for module, calls, backend in [
+        (memory_firestore, FIRESTORE_CALLS, 'firestore'),
+        (local_storage, STORAGE_CALLS, 'storage'),
+    ]:
+        for owner, methods in calls.items():
+            for method_name, operation in methods.items():
+                backends.instrument(getattr(module, owner), method_name, backend, operation)
+
+    def verify_firebase_token(token):
+        return {'uid': token, 'sub': token, 'email': f"{token}@bench.invalid", 'exp': time.time() + 3600}
+    token_verifier.verify_firebase_token = verify_firebase_token
+    backends.instrument(token_verifier, 'verify_firebase_token', 'auth', 'verify_token')
+    token_verifier.cert_request.refresh = lambda: 3600
+
+    import logging
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main.app
+
+def headers(uid):
+    return {'Authorization': f"Bearer {uid}"}
+
+def make_upload(rng, extension, size):
+    body = rng.randbytes(size)
+    if extension == 'package':
+        body = b'DBPF' + body[4:]
+    return body
+
+class Workload:
+    """Seeded users, files and shares, and the requests each scenario makes"""
+
+    def __init__(self, client, rng, args):
+        self.client = client
+        self.rng = rng
+        self.args = args
+        self.users = [f"bench-user-{n:04d}" for n in range(args.users)]
+        self.file_ids = {uid: [] for uid in self.users}
+        # Shared file id -> uid of the user who shared it
+        self.shares = {}
+        self._uploads = 0
+
+    async def seed(self):
+        from routes.firebase_config import get_firestore_client
+        from routes.user_profiles import default_profile
+        db = get_firestore_client()
+        for uid in self.users:
+            profile = {**default_profile(), 'subscription_tier': 'premium', 'storage_limit': 1024 * 1024}
+            db.collection('users').document(uid).set(profile)
+
+        semaphore = asyncio.Semaphore(32)
+
+        async def seed_user(uid):
+            async with semaphore:
+                for _ in range(self.args.files_per_user):
+                    await self.upload(uid)
+
+        await asyncio.gather(*(seed_user(uid) for uid in self.users))
+        owned = [(uid, file_id) for uid, ids in self.file_ids.items() for file_id in ids]
+        for uid, file_id in self.rng.sample(owned, min(self.args.shares, len(owned))):
+            response = await self.client.post(
+                '/api/community/share', json={'file_id': file_id, 'description': 'Seeded'}, headers=headers(uid)
+            )
+            response.raise_for_status()
+            self.shares[response.json()['shared_file_id']] = uid
+
+    async def settle(self, timeout=60):
+        """Wait for background jobs (upload inspection) to finish"""
+        from routes.firebase_config import get_firestore_client
+        jobs = get_firestore_client().collection('jobs')
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not jobs.where('status', 'in', ['queued', 'running']).limit(1).get():
+                return
+            await asyncio.sleep(0.1)
+
+    async def upload(self, uid):
+        self._uploads += 1
+        extension = self.rng.choice(FILE_EXTENSIONS)
+        name = f"cc_{self._uploads:06d}.{extension}"
+        body = make_upload(self.rng, extension, self.args.file_kb * 1024)
+        response = await self.client.post(
+            '/api/files/upload',
+            files={'file': (name, body, 'application/octet-stream')},
+            data={'path': f"Mods/Bench/{name}", 'mtime': str(time.time())},
+            headers=headers(uid),
+        )
+        if response.status_code == 200:
+            self.file_ids[uid].append(response.json()['file_id'])
+        return response
+
+    async def request(self, scenario):
+        uid = self.rng.choice(self.users)
+        if scenario == 'mixed':
+            scenario = self.rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+        if scenario == 'upload':
+            return await self.upload(uid)
+        if scenario == 'list':
+            return await self.client.get('/api/files/list', params={'page_size': 100}, headers=headers(uid))
+        if scenario == 'browse':
+            # Mostly the default feed pages, sometimes a filtered or sorted query
+            if self.rng.random() < 0.7:
+                params = {}
+            else:
+                params = {'sort': self.rng.choice(['downloads', 'rating']), 'file_type': self.rng.choice(['package', 'ts4script'])}
+            return await self.client.get('/api/community/files', params=params)
+        shared_id = self.rng.choice(list(self.shares))
+        if scenario == 'download':
+            return await self.client.post(f"/api/community/{shared_id}/download", headers=headers(uid))
+        # Owners can't rate their own files
+        while self.shares[shared_id] == uid:
+            uid = self.rng.choice(self.users)
+        return await self.client.post(
+            f"/api/community/{shared_id}/rate", json={'rating': self.rng.randint(1, 5)}, headers=headers(uid)
+        )
+
+async def run_scenario(workload, backends, scenario, concurrency, requests):
+    timings = []
+    statuses = Counter()
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            response = await workload.request(scenario)
+            timings.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+
+    backends.take_calls()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    calls = backends.take_calls()
+
+    timings.sort()
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'status_codes': {str(status): count for status, count in sorted(statuses.items())},
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': percentile(timings, 0.50),
+        'p95_ms': percentile(timings, 0.95),
+        'p99_ms': percentile(timings, 0.99),
+        'max_ms': percentile(timings, 1.0),
+        'peak_rss_mb': peak_rss_mb(),
+        'backend_calls': dict(sorted(calls.items())),
+        'backend_calls_per_request': round(sum(calls.values()) / requests, 2),
+    }
+
+def compare(results, baseline):
+    """Change in throughput and p95 latency against an earlier report, in percent"""
+    previous = {(run['scenario'], run['concurrency']): run for run in baseline['results']}
+    changes = []
+    for run in results:
+        before = previous.get((run['scenario'], run['concurrency']))
+        if before is None:
+            continue
+        changes.append({
+            'scenario': run['scenario'],
+            'concurrency': run['concurrency'],
+            'throughput_change_pct': round((run['throughput_rps'] / before['throughput_rps'] - 1) * 100, 1),
+            'p95_change_pct': round((run['p95_ms'] / before['p95_ms'] - 1) * 100, 1),
+            'backend_calls_per_request_before': before['backend_calls_per_request'],
+            'backend_calls_per_request': run['backend_calls_per_request'],
+        })
+    return changes
+
+async def run(args, backends, app):
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            workload = Workload(client, rng, args)
+            backends.enabled = False
+            await workload.seed()
+            backends.enabled = True
+            results = []
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    backends.enabled = False
+                    await workload.settle()
+                    backends.enabled = True
+                    results.append(await run_scenario(workload, backends, scenario, concurrency, args.requests))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario and concurrency")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--files-per-user", type=int, default=40)
+    parser.add_argument("--shares", type=int, default=200)
+    parser.add_argument("--file-kb", type=int, default=64)
+    parser.add_argument("--firestore-ms", type=float, default=5.0)
+    parser.add_argument("--storage-ms", type=float, default=20.0)
+    parser.add_argument("--auth-ms", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency varies by up to this fraction")
+    parser.add_argument("--seed", type=int, default=12)
+    parser.add_argument("--output", help="also write the report here")
+    parser.add_argument("--compare", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    backends = Backends(
+        {'firestore': args.firestore_ms, 'storage': args.storage_ms, 'auth': args.auth_ms},
+        args.jitter, args.seed,
+    )
+    args.storage_root = tempfile.mkdtemp(prefix="simsync-bench-")
+    try:
+        # The routes print progress; keep stdout for the report
+        with contextlib.redirect_stdout(sys.stderr):
+            app = boot(args, backends)
+            results = asyncio.run(run(args, backends, app))
+    finally:
+        shutil.rmtree(args.storage_root, ignore_errors=True)
+
+    report = {
+        'config': {
+            key: getattr(args, key) for key in
+            ['users', 'files_per_user', 'shares', 'file_kb', 'requests', 'firestore_ms', 'storage_ms', 'auth_ms', 'jitter', 'seed']
+        },
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(results, json.load(f))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""How long a fresh worker takes to import the app and answer ``/health``.
+
+Each run starts a new interpreter, so nothing is cached between runs:
+
+- import: ``import main`` on its own, timed in the child
+- first health: from spawning ``uvicorn main:app`` to the first 200 from
+  ``/health``, polled every ``--poll-ms``
+
+Runs are repeated ``--runs`` times per ``WARMUP`` mode (``background`` and
+``wait`` by default) and the median and worst are reported. With
+``background`` the worker serves as soon as it is up and creates its
+Firebase and Stripe clients meanwhile; ``wait`` shows what a start that
+sets them up first costs. ``--importtime`` adds the slowest top-level
+imports from ``python -X importtime``, which is where most of a cold start
+goes.
+
+The local backend is used unless ``--backend firebase`` is passed, in which
+case the Firebase and Stripe settings come from the environment.
+
+Usage (from simsync/backend):
+    python -m benchmarks.cold_start --runs 5 --importtime
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_MAIN = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def child_env(args, warmup):
+    env = dict(os.environ, WARMUP=warmup, LOG_LEVEL='WARNING')
+    if args.backend == 'local':
+        env['SIMSYNC_BACKEND'] = 'local'
+        env['LOCAL_STORAGE_ROOT'] = tempfile.mkdtemp(prefix="simsync-bench-")
+        env.setdefault('QUOTA_BACKEND', 'memory')
+        env.setdefault('FIREBASE_PROJECT_ID', 'simsync-bench')
+    return env
+
+def time_import(env):
+    output = subprocess.run([sys.executable, '-c', IMPORT_MAIN], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def time_first_health(env, args):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/health"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < args.timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {server.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(args.poll_ms / 1000)
+        raise RuntimeError(f"/health didn't answer within {args.timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def slowest_imports(env, count):
+    """Top-level imports of ``main`` by cumulative time, from ``-X importtime``"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Top-level modules are indented by one space only
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return [{'module': name, 'ms': round(us / 1000, 1)} for us, name in sorted(imports, reverse=True)[:count]]
+
+def summarize(seconds):
+    return {
+        'median_ms': round(statistics.median(seconds) * 1000, 1),
+        'max_ms': round(max(seconds) * 1000, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", nargs='+', default=['background', 'wait'], choices=['background', 'wait', 'off'])
+    parser.add_argument("--backend", choices=['local', 'firebase'], default='local')
+    parser.add_argument("--poll-ms", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--importtime", action='store_true', help="also list the slowest imports")
+    args = parser.parse_args()
+
+    report = {'backend': args.backend, 'import': summarize([time_import(child_env(args, 'off')) for _ in range(args.runs)])}
+    report['first_health'] = {
+        mode: summarize([time_first_health(child_env(args, mode), args) for _ in range(args.runs)])
+        for mode in args.modes
+    }
+    if args.importtime:
+        report['slowest_imports'] = slowest_imports(child_env(args, 'off'), 15)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Documents read per community listing page, first page against a deep one.
+
+Seeds ``--shares`` active shared files into the local backend's in-memory
+Firestore, spread over two extensions and two size buckets. Then, for every
+sort mode with no filter, each filter and both filters together, it walks
+``get_community_files`` page by page with ``next_cursor`` and counts the
+documents read for page 1 and page ``--page``. The app's lifespan doesn't
+run, so there is no feed snapshot and every page is queried:
+
+- query: documents the listing query returned, which is what Firestore
+  bills for a query
+- cursor: documents fetched to resume after the previous page
+
+The query reads must be at most ``limit + 1`` on both pages, so a deep page
+costs the same as the first. The process exits non-zero if any is larger,
+or if a combination has fewer than ``--page`` pages.
+
+Usage (from simsync/backend):
+    python -m benchmarks.community_reads --limit 10 --page 50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+EXTENSIONS = ['package', 'ts4script']
+SIZES = {'small': 200 * 1024, 'medium': 5 * 1024 * 1024}
+
+class ReadCounter:
+    """Counts documents returned by in-memory queries and document gets"""
+
+    def __init__(self, memory_firestore):
+        self.query = 0
+        self.cursor = 0
+        counter = self
+        run = memory_firestore.MemoryQuery._run
+        get = memory_firestore.MemoryDocument.get
+
+        def counted_run(query, transaction=None):
+            results = run(query, transaction)
+            counter.query += len(results)
+            return results
+
+        def counted_get(document, field_paths=None, transaction=None):
+            counter.cursor += 1
+            return get(document, field_paths=field_paths, transaction=transaction)
+
+        memory_firestore.MemoryQuery._run = counted_run
+        memory_firestore.MemoryDocument.get = counted_get
+
+    def reset(self):
+        self.query = self.cursor = 0
+
+def seed(db, community, count: int, rng: random.Random):
+    created = datetime.now(timezone.utc)
+    for n in range(count):
+        extension = EXTENSIONS[n % len(EXTENSIONS)]
+        size_name = list(SIZES)[(n // len(EXTENSIONS)) % len(SIZES)]
+        size = SIZES[size_name]
+        shared_file_id = f"share-{n:06d}"
+        db.collection('shared_files').document(shared_file_id).set({
+            'id': shared_file_id,
+            'original_file_id': f"file-{n:06d}",
+            'shared_by_uid': f"user-{n % 97:03d}",
+            'shared_by_name': f"user{n % 97}",
+            'file_name': f"mod_{n:06d}.{extension}",
+            'file_size': size,
+            'description': '',
+            'downloads_count': rng.randrange(10000),
+            'downloads_count_sharded': True,
+            'average_rating': round(rng.uniform(1, 5), 1),
+            'rating_sum': 0,
+            'rating_count': 0,
+            'created_at': created - timedelta(seconds=n),
+            'is_active': True,
+            'file_extension': extension,
+            'size_bucket': community.size_bucket(size),
+            'storage_path': f"content/{n:06d}",
+        })
+
+async def walk(community, reads, args, sort, file_type, size):
+    """Reads for page 1 and page ``args.page`` of one sort/filter combination"""
+    cursor = None
+    measured = {}
+    for page in range(1, args.page + 1):
+        reads.reset()
+        body = await community.get_community_files(
+            None, limit=args.limit, cursor=cursor, sort=sort, file_type=file_type, size=size
+        )
+        if page in (1, args.page):
+            measured[f"page_{page}"] = {'query': reads.query, 'cursor': reads.cursor, 'files': len(body['files'])}
+        cursor = body['next_cursor']
+        if cursor is None and page < args.page:
+            measured['error'] = f"only {page} pages"
+            break
+    return measured
+
+async def run(args):
+    from routes import community, memory_firestore
+    from routes.firebase_config import get_firestore_client
+
+    db = get_firestore_client()
+    seed(db, community, args.shares, random.Random(args.seed))
+    reads = ReadCounter(memory_firestore)
+
+    results = {}
+    ok = True
+    for sort, file_type, size in itertools.product(community.SORT_FIELDS, [None, 'package'], [None, 'medium']):
+        measured = await walk(community, reads, args, sort, file_type, size)
+        ok = ok and 'error' not in measured and all(
+            measured[page]['query'] <= args.limit + 1 for page in ('page_1', f"page_{args.page}")
+        )
+        results[f"{sort} type={file_type or '-'} size={size or '-'}"] = measured
+    return {'limit': args.limit, 'page': args.page, 'combinations': results, 'ok': ok}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shares", type=int, default=2500)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['SIMSYNC_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_ROOT'] = tempfile.mkdtemp(prefix="simsync-bench-")
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if not report['ok']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
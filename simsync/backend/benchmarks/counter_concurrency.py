@@ -0,0 +1,103 @@
+"""Concurrency check for ``routes.counters.ShardedCounter``.
+
+Runs against the local backend's in-memory Firestore, which checks
+transaction reads at commit the way Firestore does. Each of ``--docs``
+shared files starts with a pre-sharding ``downloads_count`` of
+``--legacy``. ``--workers`` counters, standing in for API processes, then
+fire ``--increments`` concurrent ``increment()`` calls on every document
+between them, through the blocking pool as requests would, while each
+worker runs ``rollup_dirty()`` every ``--rollup-ms``.
+
+After a final rollup every document's ``downloads_count`` must equal the
+legacy value plus the increments, exactly once: no increment lost and the
+legacy value folded into shard 0 once, however the rollups of different
+workers interleaved. The report gives the counts per document, the time
+taken and the rollups run, and the process exits non-zero on a mismatch.
+
+Usage (from simsync/backend):
+    python -m benchmarks.counter_concurrency --increments 500 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+FIELD = 'downloads_count'
+
+async def roll_up_until(counter, done: asyncio.Event, interval: float):
+    rollups = 0
+    while not done.is_set():
+        await counter.rollup_dirty()
+        rollups += 1
+        await asyncio.sleep(interval)
+    return rollups
+
+async def run(args):
+    from routes.counters import ShardedCounter
+    from routes.firebase_config import get_firestore_client
+
+    db = get_firestore_client()
+    doc_ids = [f"shared-{n:03d}" for n in range(args.docs)]
+    for doc_id in doc_ids:
+        db.collection('shared_files').document(doc_id).set({'file_name': f"{doc_id}.package", FIELD: args.legacy})
+
+    counters = [ShardedCounter('shared_files', FIELD, num_shards=args.shards) for _ in range(args.workers)]
+    done = asyncio.Event()
+    rollers = [asyncio.create_task(roll_up_until(counter, done, args.rollup_ms / 1000)) for counter in counters]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        counters[n % args.workers].increment(doc_id)
+        for n in range(args.increments)
+        for doc_id in doc_ids
+    ))
+    elapsed = time.perf_counter() - started
+    done.set()
+    rollups = sum(await asyncio.gather(*rollers))
+    for counter in counters:
+        await counter.rollup_dirty()
+
+    expected = args.legacy + args.increments
+    results = {}
+    for doc_id in doc_ids:
+        parent = db.collection('shared_files').document(doc_id).get().to_dict()
+        shard_sum = sum(shard.to_dict().get('count', 0) for shard in counters[0]._shards(doc_id).stream())
+        results[doc_id] = {
+            FIELD: parent.get(FIELD),
+            'shard_sum': shard_sum,
+            'sharded': parent.get(f'{FIELD}_sharded', False),
+        }
+    ok = all(
+        result[FIELD] == expected and result['shard_sum'] == expected and result['sharded']
+        for result in results.values()
+    )
+    return {
+        'expected': expected,
+        'increments_per_second': round(args.increments * args.docs / elapsed, 1),
+        'rollups_during_increments': rollups,
+        'documents': results,
+        'ok': ok,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=3)
+    parser.add_argument("--increments", type=int, default=500, help="increments per document")
+    parser.add_argument("--legacy", type=int, default=37, help="pre-sharding count on each document")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--shards", type=int, default=20)
+    parser.add_argument("--rollup-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    os.environ['SIMSYNC_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_ROOT'] = tempfile.mkdtemp(prefix="simsync-bench-")
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if not report['ok']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Bytes sent for a one-resource package update: delta sync versus full upload.
+
+Builds synthetic DBPF 2.1 packages, changes a single resource, and compares
+the size of a full upload with what delta sync sends (the plan/commit JSON
+plus the missing segment bodies). Each case also rebuilds the new package
+from the base with ``assemble_package`` and checks it matches byte for byte.
+
+Usage (from simsync/backend):
+    python -m benchmarks.dbpf_delta --resources 50 500 5000
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import struct
+import time
+
+from routes.dbpf import assemble_package, split_package
+from routes.delta import DeltaSegment, plan_missing
+
+RESOURCE_TYPES = [0x034AEECB, 0x545AC67A, 0x00B2D882, 0x319E4F1D, 0x0166038C]
+
+def build_package(resources):
+    """Serialise ``(type, group, instance, body)`` tuples as a DBPF 2.1 package"""
+    body = io.BytesIO()
+    body.write(b"\0" * 96)
+    entries = []
+    for resource_type, group, instance, data in resources:
+        entries.append((resource_type, group, instance, body.tell(), len(data)))
+        body.write(data)
+
+    index = io.BytesIO()
+    index.write(struct.pack("<I", 0))
+    for resource_type, group, instance, offset, size in entries:
+        index.write(struct.pack(
+            "<IIIIIIIHH",
+            resource_type, group, instance >> 32, instance & 0xFFFFFFFF,
+            offset, size | 0x80000000, size, 0, 1
+        ))
+    index_offset = body.tell()
+    body.write(index.getvalue())
+
+    header = bytearray(96)
+    header[0:4] = b"DBPF"
+    struct.pack_into("<II", header, 4, 2, 1)
+    struct.pack_into("<I", header, 36, len(entries))
+    struct.pack_into("<I", header, 44, len(index.getvalue()))
+    struct.pack_into("<I", header, 60, 3)
+    struct.pack_into("<I", header, 64, index_offset)
+    package = bytearray(body.getvalue())
+    package[0:96] = header
+    return bytes(package)
+
+def synthetic_resources(count, rng):
+    return [
+        (rng.choice(RESOURCE_TYPES), 0, rng.getrandbits(64), rng.randbytes(rng.randint(512, 64 * 1024)))
+        for _ in range(count)
+    ]
+
+def run_case(count, rng):
+    resources = synthetic_resources(count, rng)
+    old_package = build_package(resources)
+
+    # A creator update: one resource changes size and content
+    changed = rng.randrange(count)
+    resource_type, group, instance, data = resources[changed]
+    resources[changed] = (resource_type, group, instance, rng.randbytes(len(data) + 100))
+    new_package = build_package(resources)
+
+    started = time.perf_counter()
+    base_segments = split_package(io.BytesIO(old_package))
+    new_segments = split_package(io.BytesIO(new_package))
+    split_seconds = time.perf_counter() - started
+
+    segments = [DeltaSegment(hash=s.hash, length=s.length) for s in new_segments]
+    missing = plan_missing(segments, base_segments)
+    new_bodies = {s.hash: new_package[s.offset:s.offset + s.length] for s in new_segments}
+    chunks = b"".join(new_bodies[h] for h in missing)
+
+    manifest = json.dumps({
+        "size": len(new_package),
+        "sha256": hashlib.sha256(new_package).hexdigest(),
+        "segments": [s.model_dump() for s in segments],
+    })
+
+    started = time.perf_counter()
+    rebuilt = io.BytesIO()
+    size, digest = assemble_package(segments, io.BytesIO(old_package), base_segments, io.BytesIO(chunks), rebuilt)
+    assemble_seconds = time.perf_counter() - started
+    assert rebuilt.getvalue() == new_package and digest == hashlib.sha256(new_package).hexdigest()
+
+    delta_bytes = len(manifest) * 2 + len(chunks)  # manifest goes to /plan and /commit
+    return {
+        "resources": count,
+        "full_upload_bytes": len(new_package),
+        "delta_bytes": delta_bytes,
+        "missing_segments": len(missing),
+        "missing_segment_bytes": len(chunks),
+        "saving_pct": round(100 * (1 - delta_bytes / len(new_package)), 2),
+        "split_seconds": round(split_seconds, 4),
+        "assemble_seconds": round(assemble_seconds, 4),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resources", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--seed", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(json.dumps([run_case(count, rng) for count in args.resources], indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Cost of logging on the request path: synchronous writes versus the queue pipeline.
+
+Log output goes to a sink whose writes take ``--write-us``, standing in for
+a stdout pipe that a log collector drains slowly. Two measurements:
+
+- per record: the time a log call takes on the calling thread with
+  ``print``, a synchronous ``StreamHandler`` with the JSON formatter, the
+  queue pipeline from ``routes.logs``, and the pipeline dropping the record
+  because the request wasn't sampled
+- per request: ``GET /api/files/list`` through the app (local backend, auth
+  stubbed) at ``--concurrency``, with logging off, with every request's
+  access line written synchronously, through the pipeline, and through the
+  pipeline sampling 1% of requests
+
+The report gives the mean and p99 per record or request, the throughput
+and, per request, the overhead against logging off. Request modes take
+turns over ``--rounds`` and the median round of each is reported, since
+run-to-run noise is of the same order as the differences. At concurrency 1
+the difference in mean latency is the logging cost per request. With more
+requests in flight than cores, formatting on the writer thread competes with
+the event loop for CPU. Sampling is what keeps that cost small.
+
+Usage (from simsync/backend, after ``pip install -r requirements-dev.txt``):
+    python -m benchmarks.logging_overhead --write-us 50 --requests 2000
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+class SlowSink(io.TextIOBase):
+    """Text stream whose every write blocks for a while, like a full pipe"""
+
+    def __init__(self, write_seconds):
+        self.write_seconds = write_seconds
+        self.writes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.writes += 1
+        if self.write_seconds:
+            time.sleep(self.write_seconds)
+        return len(text)
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'mean_us': round(statistics.fmean(timings) * 1e6, 1),
+        'p99_us': round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1e6, 1),
+    }
+
+def time_calls(log, count):
+    timings = []
+    for n in range(count):
+        started = time.perf_counter()
+        log(n)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+def per_record(args, sink, logs):
+    sync_logger = logging.getLogger('bench.sync')
+    sync_logger.propagate = False
+    sync_handler = logging.StreamHandler(sink)
+    sync_handler.setFormatter(logs.JSONFormatter())
+    sync_logger.addHandler(sync_handler)
+
+    queued_logger = logging.getLogger('bench.queued')
+    sampled_out = logs.RequestContext('bench', 'GET', {}, sampled=False)
+
+    def dropped(n):
+        token = logs._request_context.set(sampled_out)
+        try:
+            queued_logger.info(f"Listed files for request {n}")
+        finally:
+            logs._request_context.reset(token)
+
+    results = {
+        'print': time_calls(lambda n: print(f"Listed files for request {n}", file=sink), args.records),
+        'sync_handler': time_calls(lambda n: sync_logger.info(f"Listed files for request {n}"), args.records),
+        'queue_pipeline': time_calls(lambda n: queued_logger.info(f"Listed files for request {n}"), args.records),
+        'queue_pipeline_sampled_out': time_calls(dropped, args.records),
+    }
+    logs.stop_logging()
+    return results
+
+async def drive(app, args):
+    timings = []
+    remaining = iter(range(args.requests))
+
+    async def worker(client):
+        for _ in remaining:
+            started = time.perf_counter()
+            response = await client.get('/api/files/list', params={'page_size': 20})
+            response.raise_for_status()
+            timings.append(time.perf_counter() - started)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        await client.get('/api/files/list')
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    result = summarize(timings)
+    result['throughput_rps'] = round(args.requests / elapsed, 1)
+    return result
+
+def per_request(args, sink, logs):
+    import main
+    from routes import auth
+    main.app.dependency_overrides[auth.verify_token] = lambda: {'uid': 'bench-user', 'email': 'bench@bench.invalid'}
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    root = logging.getLogger()
+    pipeline_handlers = list(root.handlers)
+    sync_handler = logging.StreamHandler(sink)
+    sync_handler.setFormatter(logs.JSONFormatter())
+
+    def configure(mode):
+        root.handlers = [sync_handler] if mode == 'sync_handler' else pipeline_handlers
+        root.setLevel(logging.CRITICAL if mode == 'off' else logging.INFO)
+        logs.LOG_SAMPLE_RATE = 0.01 if mode == 'queue_pipeline_sampled_1pct' else 1.0
+
+    modes = ['off', 'sync_handler', 'queue_pipeline', 'queue_pipeline_sampled_1pct']
+    runs = {mode: [] for mode in modes}
+    # Modes take turns, so drift over the run affects them alike
+    for _ in range(args.rounds):
+        for mode in modes:
+            configure(mode)
+            runs[mode].append(asyncio.run(drive(main.app, args)))
+    results = {mode: sorted(runs[mode], key=lambda run: run['mean_us'])[len(runs[mode]) // 2] for mode in modes}
+    for mode, result in results.items():
+        result['overhead_us'] = round(result['mean_us'] - results['off']['mean_us'], 1)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--write-us", type=float, default=50.0, help="time each write to the log sink takes")
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=5, help="runs per mode; the median run is reported")
+    args = parser.parse_args()
+
+    os.environ['SIMSYNC_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_ROOT'] = tempfile.mkdtemp(prefix="simsync-bench-")
+    os.environ.setdefault('QUOTA_BACKEND', 'memory')
+    os.environ['LOG_SLOW_REQUEST_MS'] = '60000'
+    from routes import logs
+
+    sink = SlowSink(args.write_us / 1e6)
+    logs.setup_logging(stream=sink)
+    report = {'write_us': args.write_us, 'per_record': per_record(args, sink, logs)}
+    logs.setup_logging(stream=sink)
+    report['per_request'] = per_request(args, sink, logs)
+    logs.stop_logging()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
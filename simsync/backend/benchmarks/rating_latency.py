@@ -0,0 +1,225 @@
+"""Rating latency with many existing ratings: per-user documents versus one map.
+
+Seeds a shared file with N existing ratings and then times votes (new
+raters and re-rates) through ``routes.community.apply_rating``, next to a copy
+of the previous implementation that kept every vote in a ``ratings`` map on
+the shared file document.
+
+Firestore is replaced by a small in-memory store that keeps documents
+encoded, so every read decodes and every write encodes the whole document,
+roughly like the wire format does. ``--rpc-ms`` adds a fixed round trip per
+read and per commit. The report also gives the bytes written per vote and
+the size of the shared file document against Firestore's 1 MiB limit.
+
+Usage (from simsync/backend):
+    python -m benchmarks.rating_latency --ratings 10 10000 100000
+"""
+import argparse
+import itertools
+import json
+import pickle
+import random
+import statistics
+import time
+from datetime import datetime
+
+from google.cloud.firestore_v1 import transforms
+
+from routes.community import apply_rating
+
+MAX_DOCUMENT_BYTES = 1024 * 1024
+
+def document_size(value):
+    """Approximate stored size using Firestore's documented size rules"""
+    if isinstance(value, dict):
+        return 32 + sum(len(key) + 1 + document_size(item) for key, item in value.items())
+    if isinstance(value, str):
+        return len(value) + 1
+    if isinstance(value, bool) or value is None:
+        return 1
+    return 8
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+    def get(self, field):
+        return self._data[field]
+
+class FakeDocument:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+
+    def collection(self, name):
+        return FakeCollection(self._store, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        self._store.round_trip()
+        raw = self._store.docs.get(self.path)
+        return FakeSnapshot(pickle.loads(raw) if raw is not None else None)
+
+    def update(self, data):
+        self._store.commit([("update", self, data)])
+
+class FakeCollection:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self._store, f"{self.path}/{doc_id}")
+
+class FakeTransaction:
+    """Just enough of ``Transaction`` for ``firestore.transactional``"""
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, store):
+        self._store = store
+        self._id = None
+        self._writes = []
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = b"txn"
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        self._store.commit(self._writes)
+        self._clean_up()
+
+    def set(self, ref, data):
+        self._writes.append(("set", ref, data))
+
+    def update(self, ref, data):
+        self._writes.append(("update", ref, data))
+
+class FakeFirestore:
+    def __init__(self, rpc_seconds=0.0):
+        self.docs = {}
+        self.rpc_seconds = rpc_seconds
+        self.bytes_written = 0
+
+    def round_trip(self):
+        if self.rpc_seconds:
+            time.sleep(self.rpc_seconds)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def commit(self, writes):
+        self.round_trip()
+        for op, ref, data in writes:
+            current = pickle.loads(self.docs[ref.path]) if op == "update" else {}
+            for key, value in data.items():
+                if value is transforms.DELETE_FIELD:
+                    current.pop(key, None)
+                elif value is transforms.SERVER_TIMESTAMP:
+                    current[key] = datetime.now()
+                else:
+                    current[key] = value
+            self.bytes_written += document_size(data)
+            self.docs[ref.path] = pickle.dumps(current)
+
+    def seed(self, path, data):
+        self.docs[path] = pickle.dumps(data)
+
+def legacy_rate(shared_ref, uid, rating):
+    """The previous rate handler: read the share, rewrite the whole ratings map"""
+    shared_file_data = shared_ref.get().to_dict()
+    ratings = shared_file_data.get('ratings', {})
+    old_rating = ratings.get(uid)
+    ratings[uid] = rating
+    total_rating = sum(ratings.values())
+    rating_count = len(ratings)
+    average_rating = total_rating / rating_count if rating_count > 0 else 0
+    shared_ref.update({
+        'ratings': ratings,
+        'average_rating': round(average_rating, 1),
+        'rating_count': rating_count
+    })
+    return old_rating, round(average_rating, 1), rating_count
+
+def make_uid(n):
+    # Firebase uids are 28 characters
+    return f"{n:028d}"
+
+def seed_share(store, count, rng, legacy):
+    votes = {make_uid(n): rng.randint(1, 5) for n in range(count)}
+    share = {
+        'id': 'share',
+        'shared_by_uid': 'owner',
+        'file_name': 'CC_Hair_Pack.package',
+        'is_active': True,
+        'average_rating': round(sum(votes.values()) / count, 1),
+        'rating_count': count,
+    }
+    if legacy:
+        share['ratings'] = votes
+    else:
+        share['rating_sum'] = sum(votes.values())
+        for uid, value in votes.items():
+            store.seed(f"shared_files/share/ratings/{uid}", {'rating': value})
+    store.seed("shared_files/share", share)
+    return store.collection('shared_files').document('share')
+
+def run_case(count, votes, rng, rpc_seconds, legacy):
+    store = FakeFirestore(rpc_seconds)
+    shared_ref = seed_share(store, count, rng, legacy)
+    new_raters = (make_uid(n) for n in itertools.count(count))
+
+    timings = []
+    for _ in range(votes):
+        # Half the votes are re-rates by existing raters
+        uid = make_uid(rng.randrange(count)) if rng.random() < 0.5 else next(new_raters)
+        rating = rng.randint(1, 5)
+        started = time.perf_counter()
+        if legacy:
+            legacy_rate(shared_ref, uid, rating)
+        else:
+            apply_rating(store.transaction(), shared_ref, uid, rating)
+        timings.append(time.perf_counter() - started)
+
+    final = pickle.loads(store.docs["shared_files/share"])
+    timings.sort()
+    return {
+        "implementation": "ratings map" if legacy else "ratings subcollection",
+        "existing_ratings": count,
+        "votes": votes,
+        "p50_ms": round(statistics.median(timings) * 1000, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1] * 1000, 3),
+        "bytes_written_per_vote": store.bytes_written // votes,
+        "share_document_bytes": document_size(final),
+        "over_document_limit": document_size(final) > MAX_DOCUMENT_BYTES,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ratings", type=int, nargs="+", default=[10, 10000, 100000])
+    parser.add_argument("--votes", type=int, default=200)
+    parser.add_argument("--rpc-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=12)
+    args = parser.parse_args()
+
+    results = []
+    for count in args.ratings:
+        for legacy in (True, False):
+            rng = random.Random(args.seed)
+            results.append(run_case(count, args.votes, rng, args.rpc_ms / 1000, legacy))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Peak memory of streaming uploads versus file size.
+
+Each file size runs in a fresh process so ``ru_maxrss`` reflects that run
+only. Uploads go through the real google-cloud-storage resumable upload code
+against an in-process fake of the Cloud Storage HTTP API that discards bytes.
+
+Usage (from simsync/backend):
+    python -m benchmarks.upload_memory --sizes 10 50 200 --concurrency 4
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+MB = 1024 * 1024
+
+
+class FakeResumableSession(requests.Session):
+    """Minimal Cloud Storage JSON API that accepts resumable uploads."""
+
+    is_mtls = False
+
+    def __init__(self):
+        super().__init__()
+        self.received = {}
+        self.bytes_received = 0
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        headers = headers or {}
+        if "uploadType=resumable" in url:
+            upload_id = str(len(self.received))
+            self.received[upload_id] = 0
+            return self._response(200, {"location": f"https://fake-upload/{upload_id}"})
+
+        upload_id = url.rsplit("/", 1)[-1]
+        length = len(data) if data else 0
+        self.received[upload_id] += length
+        self.bytes_received += length
+        # Chunks carry "bytes a-b/*" until the last one reveals the total;
+        # an upload that ends on a chunk boundary finishes with "bytes */total".
+        end, total = re.match(
+            r"bytes (?:\d+-(\d+)|\*)/(\d+|\*)", headers["content-range"]
+        ).groups()
+        if total == "*":
+            return self._response(308, {"range": f"bytes=0-{end}"})
+        body = {"name": upload_id, "bucket": "bench", "size": total}
+        return self._response(200, {"content-type": "application/json"}, json.dumps(body))
+
+    @staticmethod
+    def _response(status, headers, body=""):
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = body.encode()
+        return response
+
+
+def make_spooled_file(size_mb):
+    """Write ``size_mb`` of data to a temp file the way Starlette spools uploads."""
+    spool = tempfile.SpooledTemporaryFile(max_size=MB)
+    block = os.urandom(MB)
+    for _ in range(size_mb):
+        spool.write(block)
+    spool.seek(0)
+    return spool
+
+
+def run_case(size_mb, concurrency, queue):
+    from fastapi.concurrency import run_in_threadpool
+    from routes.content_store import stream_upload
+
+    session = FakeResumableSession()
+    client = storage.Client(project="bench", credentials=AnonymousCredentials(), _http=session)
+    bucket = client.bucket("bench")
+    spools = [make_spooled_file(size_mb) for _ in range(concurrency)]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    async def upload_all():
+        return await asyncio.gather(*[
+            run_in_threadpool(stream_upload, bucket.blob(f"bench/{i}"), spool, "application/octet-stream")
+            for i, spool in enumerate(spools)
+        ])
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = asyncio.run(upload_all())
+    elapsed = time.perf_counter() - started
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert all(size == size_mb * MB for size, _ in results)
+    assert session.bytes_received == concurrency * size_mb * MB
+    queue.put({
+        "file_size_mb": size_mb,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "traced_peak_mb": round(traced_peak / MB, 2),
+        "rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024, 2),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="file sizes in MB")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size_mb in args.sizes:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_case, args=(size_mb, args.concurrency, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise SystemExit(f"benchmark for {size_mb} MB failed")
+        results.append(queue.get())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
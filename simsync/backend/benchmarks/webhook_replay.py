@@ -0,0 +1,161 @@
+"""Replay Stripe webhooks with redeliveries and out-of-order arrival.
+
+Boots ``main:app`` with ``SIMSYNC_BACKEND=local`` and its lifespan, so the
+job workers apply events as they would in production. Each of ``--users``
+users gets the same subscription history, one event a minute apart:
+checkout completed, subscription ``past_due``, ``active`` again, and
+cancelled in the same second as that last update. Profiles must end up
+cancelled whichever of those two is applied first. The events are signed with a test secret and posted to
+``/api/payments/webhook`` at ``--concurrency`` in two runs, each on users of
+its own:
+
+- ``in_order``: every event once, sent in order
+- ``replayed``: every event ``1 + --duplicates`` times on average, shuffled
+
+Once the jobs have finished, the report gives per run the webhook's ack
+latency (p50/p99), the status each event ended with in ``stripe_events``,
+the commits that wrote to ``users`` documents, and whether every profile
+ended up as the last event left it. The replayed run should write
+no more profiles than the in-order one, however the events arrive.
+
+Usage (from simsync/backend, after ``pip install -r requirements-dev.txt``):
+    python -m benchmarks.webhook_replay --users 50 --duplicates 2
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+WEBHOOK_SECRET = 'whsec_simsync_bench'
+
+def sign(payload: bytes, timestamp: int):
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def history(uid: str, started: int):
+    """The events one user's subscription goes through, oldest first"""
+    subscription = {'id': f"sub_{uid}", 'customer': f"cus_{uid}", 'metadata': {'user_id': uid}}
+    steps = [
+        ('checkout.session.completed', {'id': f"cs_{uid}", 'customer': f"cus_{uid}", 'client_reference_id': uid}),
+        ('customer.subscription.updated', {**subscription, 'status': 'past_due'}),
+        ('customer.subscription.updated', {**subscription, 'status': 'active'}),
+        ('customer.subscription.deleted', {**subscription, 'status': 'canceled'}),
+    ]
+    # The cancellation shares its second with the update before it
+    created = [started, started + 60, started + 120, started + 120]
+    return [
+        {'id': f"evt_{uid}_{n}", 'type': event_type, 'created': created[n], 'data': {'object': data}}
+        for n, (event_type, data) in enumerate(steps)
+    ]
+
+class UserWrites:
+    """Counts commits that write to ``users`` documents"""
+
+    def __init__(self, client):
+        self.count = 0
+        original = client._commit
+
+        def commit(writes, reads=None):
+            result = original(writes, reads)
+            if any(reference._collection_path == 'users' for _, reference, _, _ in writes):
+                self.count += 1
+            return result
+        client._commit = commit
+
+async def settle(db, timeout=120):
+    jobs = db.collection('jobs')
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not jobs.where('status', 'in', ['queued', 'running']).limit(1).get():
+            return
+        await asyncio.sleep(0.05)
+    raise RuntimeError("Jobs didn't finish in time")
+
+async def replay(client, db, user_writes, uids, args, rng, duplicates):
+    from routes.user_profiles import default_profile
+    for uid in uids:
+        db.collection('users').document(uid).set(default_profile())
+    started = int(time.time()) - 3600
+    histories = {uid: history(uid, started) for uid in uids}
+    deliveries = [event for events in histories.values() for event in events]
+    if duplicates:
+        deliveries += [rng.choice(deliveries) for _ in range(int(len(deliveries) * duplicates))]
+        rng.shuffle(deliveries)
+
+    writes_before = user_writes.count
+    timings = []
+    outcomes = Counter()
+    remaining = iter(deliveries)
+
+    async def worker():
+        for event in remaining:
+            payload = json.dumps(event).encode()
+            headers = {'Stripe-Signature': sign(payload, int(time.time())), 'Content-Type': 'application/json'}
+            sent = time.perf_counter()
+            response = await client.post('/api/payments/webhook', content=payload, headers=headers)
+            timings.append(time.perf_counter() - sent)
+            response.raise_for_status()
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    await settle(db)
+
+    correct = 0
+    for uid, events in histories.items():
+        profile = db.collection('users').document(uid).get().to_dict()
+        correct += profile.get('stripe_event_id') == events[-1]['id'] and profile['subscription_tier'] == 'basic'
+        for event in events:
+            outcomes[db.collection('stripe_events').document(event['id']).get().get('status')] += 1
+
+    timings.sort()
+    return {
+        'deliveries': len(deliveries),
+        'events': sum(len(events) for events in histories.values()),
+        'ack_p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+        'ack_p99_ms': round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000, 2),
+        'event_status': dict(outcomes),
+        'user_document_writes': user_writes.count - writes_before,
+        'profiles_correct': f"{correct}/{len(uids)}",
+    }
+
+async def run(args):
+    import main
+    from routes.firebase_config import get_firestore_client
+    db = get_firestore_client()
+    user_writes = UserWrites(db)
+    rng = random.Random(args.seed)
+    report = {}
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name, duplicates in [('in_order', 0), ('replayed', args.duplicates)]:
+                uids = [f"{name}-user-{n:04d}" for n in range(args.users)]
+                report[name] = await replay(client, db, user_writes, uids, args, rng, duplicates)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duplicates", type=float, default=2.0, help="extra deliveries per event, on average")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['SIMSYNC_BACKEND'] = 'local'
+    os.environ['LOCAL_STORAGE_ROOT'] = tempfile.mkdtemp(prefix="simsync-bench-")
+    os.environ.setdefault('QUOTA_BACKEND', 'memory')
+    os.environ.setdefault('FIREBASE_PROJECT_ID', 'simsync-bench')
+    os.environ['STRIPE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    os.environ.setdefault('JOB_RETRY_BASE_SECONDS', '1')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Gunicorn settings for serving the API from several uvicorn workers.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+``WEB_CONCURRENCY`` sets the number of workers. With ``PRELOAD_APP`` (on by
+default) the master imports the app and the SDKs and loads the Firebase
+credentials once, then forks the workers, which share those pages instead of
+each paying for them. Anything holding connections or threads (the Firestore
+and Storage clients, the blocking pool, the log writer) is created in each
+worker after the fork, by its warm-up or on first use.
+
+``SIMSYNC_BACKEND=local`` keeps metadata in process, so use one worker with it.
+"""
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
+# Give in-flight requests and the lifespan shutdown time to finish
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+
+def when_ready(server):
+    # Runs in the master after the app is preloaded and before any fork
+    if preload_app:
+        from routes.firebase_config import initialize_firebase
+        initialize_firebase()
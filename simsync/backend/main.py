@@ -1,23 +1,75 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import uvicorn
 import os
+import secrets
 from dotenv import load_dotenv
 
-from routes.firebase_config import initialize_firebase
-from routes import auth, files, community
+from routes.firebase_config import SIMSYNC_BACKEND, get_firestore_client, get_storage_bucket
+from routes.executor import shutdown_executor
+from routes.jobs import job_queue
+from routes.logs import RequestLogMiddleware, setup_logging
+from routes.metrics import METRICS_TOKEN, MetricsMiddleware, render_metrics
+from routes.token_verifier import refresh_certs_forever, token_cache
+from routes.user_profiles import profile_cache, reconcile_usage_forever
+from routes.warmup import WARMUP, warm_up
+from routes import auth, files, community, delta, export, local_storage
 from routes import payments
 
 # Load environment variables
 load_dotenv()
 
-initialize_firebase()
+# JSON logs written by a background thread; see routes/logs.py
+setup_logging()
+
+# Firebase and Stripe are set up on first use; these set them up at startup
+WARMUP_HOOKS = [
+    ("firestore", "firestore", get_firestore_client),
+    ("storage", "storage", get_storage_bucket),
+    ("stripe", "stripe", payments.get_stripe),
+]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup = None
+    if WARMUP == "wait":
+        await warm_up(WARMUP_HOOKS)
+    elif WARMUP != "off":
+        warmup = asyncio.create_task(warm_up(WARMUP_HOOKS))
+    # Prefetch and keep refreshing Google's token signing certs
+    cert_refresher = asyncio.create_task(refresh_certs_forever())
+    # Precompute the anonymous community browse feed
+    feed_builder = asyncio.create_task(community.community_feed.run_forever())
+    download_rollup = asyncio.create_task(community.download_counter.run_forever())
+    # Repair any drift in per-user file counts and storage totals
+    usage_reconciler = asyncio.create_task(reconcile_usage_forever())
+    # Background jobs such as inspecting uploaded files
+    job_runner = asyncio.create_task(job_queue.run_forever())
+    # One-off data migrations, run as jobs by whichever worker claims them
+    share_backfill = asyncio.create_task(community.schedule_share_filter_backfill())
+    yield
+    if warmup is not None:
+        warmup.cancel()
+    cert_refresher.cancel()
+    feed_builder.cancel()
+    download_rollup.cancel()
+    usage_reconciler.cancel()
+    job_runner.cancel()
+    share_backfill.cancel()
+    # Don't lose counts incremented since the last periodic rollup
+    await community.download_counter.rollup_dirty()
+    # Nor CRC-32s that exports have computed but not saved yet
+    await export.drain_crc_writes()
+    # Let in-flight Firebase/Storage calls finish before the worker exits
+    shutdown_executor()
 
 app = FastAPI(
     title="SimSync API",
     description="Backend API for Sims 4 Custom Content Backup Tool",
-    version="1.0.1"
+    version="1.0.1",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -32,17 +84,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-security = HTTPBearer()
+app.add_middleware(RequestLogMiddleware)
+# Outermost, so it times everything including CORS handling
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(auth.router, prefix="/api/auth", tags=["Authentication"])
 app.include_router(files.router, prefix="/api/files", tags=["File Management"])
+app.include_router(delta.router, prefix="/api/files/delta", tags=["Delta Sync"])
+app.include_router(export.router, prefix="/api/files", tags=["File Export"])
 app.include_router(community.router, prefix="/api/community", tags=["Community Sharing"])
 app.include_router(payments.router, prefix="/api/payments", tags=["Payments"])
-
-# Simple request logging
-import logging
-logging.basicConfig(level=logging.INFO)
+if SIMSYNC_BACKEND == 'local':
+    # Object URLs and upload sessions that Cloud Storage would serve
+    app.include_router(local_storage.router, prefix=local_storage.ROUTE_PREFIX, tags=["Local Storage"])
 
 @app.get("/")
 async def root():
@@ -52,6 +106,22 @@ async def root():
 async def health_check():
     return {"status": "healthy", "service": "simsync-api"}
 
+@app.get("/cache-stats")
+async def cache_stats():
+    """Hit/miss counters for this worker's in-process caches"""
+    return {
+        "token_cache": token_cache.stats(),
+        "user_profile_cache": profile_cache.stats(),
+        "signed_url_cache": community.signed_url_cache.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Request and backend metrics for this worker in Prometheus text format"""
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
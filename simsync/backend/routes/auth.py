@@ -1,8 +1,11 @@
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from firebase_admin import auth
-from .firebase_config import get_auth_client, get_firestore_client
+from typing import Optional
+from .firebase_config import get_auth_client
+from .executor import auth_call
+from .token_verifier import verify_id_token_cached
+from .user_profiles import file_limit, get_usage, storage_limit_mb, update_user_profile
 from datetime import datetime
 import logging
 
@@ -15,79 +18,41 @@ class UserResponse(BaseModel):
     display_name: str = None
     subscription_tier: str = "basic"  # basic, premium
     subscription_status: str = "active"  # active, cancelled, expired
-    storage_used: int = 0
+    storage_used: float = 0  # MB
     storage_limit: int = 50  # MB
+    file_count: int = 0
+    file_limit: Optional[int] = 25  # None means unlimited
 
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Verify Firebase ID token with clock skew tolerance"""
+    """Verify Firebase ID token, reusing cached results for tokens seen before"""
     try:
-        token = credentials.credentials
-        
-        # Try verification with default settings first
-        try:
-            decoded_token = auth.verify_id_token(token, check_revoked=False)
-            print(f"Token verified for user: {decoded_token.get('uid')} ({decoded_token.get('email')})")
-            return decoded_token
-        except Exception as first_error:
-            # If it's a timing error, wait a bit and try again
-            if "Token used too early" in str(first_error):
-                print("Clock skew detected, waiting 2 seconds and retrying...")
-                import asyncio
-                await asyncio.sleep(2)
-                
-                # Retry verification
-                decoded_token = auth.verify_id_token(token, check_revoked=False)
-                print(f"Token verified on retry for user: {decoded_token.get('uid')} ({decoded_token.get('email')})")
-                return decoded_token
-            else:
-                raise first_error
-                
+        return await verify_id_token_cached(credentials.credentials)
     except Exception as e:
-        print(f"Token verification failed: {str(e)}")
         logging.error(f"Token verification failed: {str(e)}")
         raise HTTPException(status_code=401, detail="Authentication failed")
 
 async def get_user_subscription_info(user_id: str):
-    """Get user's subscription information from Firestore"""
+    """Get user's subscription information and usage from the cached user profile"""
     try:
-        db = get_firestore_client()
-        
-        # Get user document
-        user_doc = db.collection('users').document(user_id).get()
-        
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            return {
-                'subscription_tier': user_data.get('subscription_tier', 'basic'),
-                'subscription_status': user_data.get('subscription_status', 'active'),
-                'storage_used': user_data.get('storage_used', 0),
-                'storage_limit': user_data.get('storage_limit', 50 if user_data.get('subscription_tier', 'basic') == 'basic' else 500)
-            }
-        else:
-            # Create new user document with basic tier
-            user_data = {
-                'subscription_tier': 'basic',
-                'subscription_status': 'active',
-                'storage_used': 0,
-                'storage_limit': 50,
-                'created_at': datetime.now(),
-                'updated_at': datetime.now()
-            }
-            db.collection('users').document(user_id).set(user_data)
-            return {
-                'subscription_tier': 'basic',
-                'subscription_status': 'active', 
-                'storage_used': 0,
-                'storage_limit': 50
-            }
+        user_data = await get_usage(user_id)
+        return {
+            'subscription_tier': user_data.get('subscription_tier', 'basic'),
+            'subscription_status': user_data.get('subscription_status', 'active'),
+            'storage_used': round(user_data.get('storage_used_bytes', 0) / (1024 * 1024), 1),
+            'storage_limit': storage_limit_mb(user_data),
+            'file_count': user_data.get('file_count', 0),
+            'file_limit': file_limit(user_data)
+        }
     except Exception as e:
-        print(f"Error getting user subscription info: {e}")
+        logging.error(f"Error getting user subscription info: {e}")
         # Return default basic tier on error
         return {
             'subscription_tier': 'basic',
             'subscription_status': 'active',
             'storage_used': 0,
-            'storage_limit': 50
+            'storage_limit': storage_limit_mb({}),
+            'file_count': 0,
+            'file_limit': file_limit({})
         }
 
 @router.get("/test")
@@ -98,7 +63,6 @@ async def test_endpoint():
 @router.get("/verify", response_model=UserResponse)
 async def verify_user_token(user = Depends(verify_token)):
     """Verify user token and return user info with subscription details"""
-    print(f"=== VERIFY ENDPOINT CALLED ===")
     try:
         # Get subscription information
         subscription_info = await get_user_subscription_info(user['uid'])
@@ -110,12 +74,13 @@ async def verify_user_token(user = Depends(verify_token)):
             subscription_tier=subscription_info['subscription_tier'],
             subscription_status=subscription_info['subscription_status'],
             storage_used=subscription_info['storage_used'],
-            storage_limit=subscription_info['storage_limit']
+            storage_limit=subscription_info['storage_limit'],
+            file_count=subscription_info['file_count'],
+            file_limit=subscription_info['file_limit']
         )
-        print(f"Verify endpoint successful for user: {user['uid']} (tier: {subscription_info['subscription_tier']})")
         return result
     except Exception as e:
-        print(f"Error in verify endpoint: {e}")
+        logging.error(f"Error in verify endpoint: {e}")
         raise HTTPException(status_code=404, detail=f"User verification failed: {str(e)}")
 
 @router.get("/user/{user_id}")
@@ -125,7 +90,7 @@ async def get_user_info(user_id: str, user = Depends(verify_token)):
         if user['uid'] != user_id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        user_record = auth.get_user(user_id)
+        user_record = await auth_call(get_auth_client().get_user, user_id)
         # Get subscription information
         subscription_info = await get_user_subscription_info(user_id)
         
@@ -136,7 +101,9 @@ async def get_user_info(user_id: str, user = Depends(verify_token)):
             subscription_tier=subscription_info['subscription_tier'],
             subscription_status=subscription_info['subscription_status'],
             storage_used=subscription_info['storage_used'],
-            storage_limit=subscription_info['storage_limit']
+            storage_limit=subscription_info['storage_limit'],
+            file_count=subscription_info['file_count'],
+            file_limit=subscription_info['file_limit']
         )
     except Exception as e:
         raise HTTPException(status_code=404, detail="User not found")
@@ -148,8 +115,6 @@ async def upgrade_user_subscription(user_id: str, user = Depends(verify_token)):
         if user['uid'] != user_id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        db = get_firestore_client()
-        
         # Update user subscription
         user_data = {
             'subscription_tier': 'premium',
@@ -159,17 +124,15 @@ async def upgrade_user_subscription(user_id: str, user = Depends(verify_token)):
             'premium_activated_at': datetime.now()
         }
         
-        db.collection('users').document(user_id).update(user_data)
-        
-        # Return updated subscription info
-        subscription_info = await get_user_subscription_info(user_id)
+        await update_user_profile(user_id, user_data)
         
+        # Answer from what was just written instead of re-reading it
         return {
             'message': 'Subscription upgraded successfully',
-            'subscription_tier': subscription_info['subscription_tier'],
-            'storage_limit': subscription_info['storage_limit']
+            'subscription_tier': user_data['subscription_tier'],
+            'storage_limit': user_data['storage_limit']
         }
         
     except Exception as e:
-        print(f"Error upgrading subscription: {e}")
+        logging.error(f"Error upgrading subscription: {e}")
         raise HTTPException(status_code=500, detail="Failed to upgrade subscription")
\ No newline at end of file
@@ -1,20 +1,384 @@
 """Community file sharing routes for SimSync."""
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import datetime, timedelta
 from firebase_admin import firestore
+from google.cloud.firestore_v1 import Query
+from google.api_core import exceptions as gcs_exceptions
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
 from .firebase_config import get_firestore_client, get_storage_bucket
 from .auth import verify_token
+from .cache import TTLCache
+from .executor import firestore_call, firestore_stream, storage_call
+from .quota import daily_quota, take_daily_quota
+from .files import BATCH_WRITE_LIMIT, batch_ids, get_owned_files
+from .counters import ShardedCounter
+from .jobs import job_queue
 import uuid
 
 router = APIRouter()
 
+COMMUNITY_MAX_PAGE_SIZE = int(os.getenv("COMMUNITY_MAX_PAGE_SIZE", 100))
+
+# Precomputed browse feed: the first FEED_PAGES pages of each sort order
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", 50))
+FEED_PAGES = int(os.getenv("FEED_PAGES", 5))
+FEED_REFRESH_SECONDS = int(os.getenv("FEED_REFRESH_SECONDS", 60))
+# Wait this long after a share/unshare so bursts trigger one rebuild
+FEED_DEBOUNCE_SECONDS = float(os.getenv("FEED_DEBOUNCE_SECONDS", 2))
+# However busy sharing gets, rebuilds (3 queries of FEED_PAGE_SIZE *
+# FEED_PAGES + 1 reads, in every worker) start at most this often
+FEED_MIN_REBUILD_SECONDS = float(os.getenv("FEED_MIN_REBUILD_SECONDS", 15))
+FEED_MAX_AGE = int(os.getenv("FEED_MAX_AGE", 30))
+# Optional storage object the snapshot is mirrored to for fast warm starts
+FEED_SNAPSHOT_OBJECT = os.getenv("FEED_SNAPSHOT_OBJECT")
+# Shares created before the type and size filters need their filter fields
+# filled in. The job's fixed id keeps workers from recording it twice; once
+# the finished job expires a later start runs it again, which only reads
+SHARE_FILTER_BACKFILL_JOB = 'backfill_share_filters_v1'
+
+# Signed download URLs are valid for SIGNED_URL_TTL seconds and handed out
+# again until SIGNED_URL_MARGIN seconds before they expire
+SIGNED_URL_TTL = int(os.getenv("SIGNED_URL_TTL", 3600))
+SIGNED_URL_MARGIN = int(os.getenv("SIGNED_URL_MARGIN", 600))
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", 10000))
+
+signed_url_cache = TTLCache(max_entries=SIGNED_URL_CACHE_SIZE, ttl=SIGNED_URL_TTL - SIGNED_URL_MARGIN)
+
+# Sort modes and the field each one orders by (descending)
+SORT_FIELDS = {
+    'newest': 'created_at',
+    'downloads': 'downloads_count',
+    'rating': 'average_rating',
+}
+
+# Size filter buckets: name -> upper bound in bytes
+SIZE_BUCKETS = {
+    'small': 1024 * 1024,
+    'medium': 10 * 1024 * 1024,
+    'large': 100 * 1024 * 1024,
+    'huge': None,
+}
+
+# Only these fields are fetched for community listings
+LIST_FIELDS = [
+    'id', 'original_file_id', 'shared_by_uid', 'shared_by_name', 'file_name',
+    'file_size', 'description', 'downloads_count', 'average_rating',
+    'rating_count', 'created_at',
+]
+
+def size_bucket(size: int):
+    """Size filter bucket a file of ``size`` bytes falls into"""
+    for name, limit in SIZE_BUCKETS.items():
+        if limit is None or size < limit:
+            return name
+
+def file_extension(file_name: str):
+    """Lower-case extension used by the file type filter, e.g. 'package'"""
+    return os.path.splitext(file_name)[1].lstrip('.').lower()
+
+async def signed_download_url(storage_path: str):
+    """Signed GET URL for a stored object, reused across downloads by path"""
+    download_url = signed_url_cache.get(storage_path)
+    if download_url is None:
+        blob = get_storage_bucket().blob(storage_path)
+        download_url = await storage_call(
+            blob.generate_signed_url,
+            expiration=timedelta(seconds=SIGNED_URL_TTL),
+            method='GET'
+        )
+        signed_url_cache.set(storage_path, download_url)
+    return download_url
+
+def shared_file_summary(file_data: dict):
+    """Public listing fields of a shared file"""
+    return {
+        'id': file_data['id'],
+        'original_file_id': file_data['original_file_id'],
+        'shared_by_uid': file_data['shared_by_uid'],
+        'shared_by': file_data['shared_by_name'],
+        'name': file_data['file_name'],
+        'size': file_data['file_size'],
+        'description': file_data['description'],
+        'downloads': file_data['downloads_count'],
+        'average_rating': file_data['average_rating'],
+        'rating_count': file_data['rating_count'],
+        'created_at': file_data['created_at'].isoformat() if isinstance(file_data['created_at'], datetime) else str(file_data['created_at'])
+    }
+
+def community_page(docs, limit: int):
+    """Listing response for a query fetched with ``limit + 1`` documents"""
+    page = docs[:limit]
+    shared_files = [shared_file_summary(doc.to_dict()) for doc in page]
+    return {
+        "files": shared_files,
+        "total": len(shared_files),
+        "next_cursor": page[-1].id if len(docs) > limit else None
+    }
+
+def etag_matches(if_none_match: str, etag: str):
+    """Whether an If-None-Match header lists exactly ``etag``, or is ``*``"""
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+class CommunityFeed:
+    """In-memory snapshot of the first pages of every sort order.
+
+    Pages are stored pre-serialised with an ETag, keyed by ``(sort, cursor)``
+    where the cursor is ``None`` for the first page, so unfiltered browse
+    requests are answered without touching Firestore. The snapshot is rebuilt
+    every ``FEED_REFRESH_SECONDS``, and sooner after a share or unshare, but
+    never within ``FEED_MIN_REBUILD_SECONDS`` of the previous rebuild.
+
+    So a page can be stale by up to a build's duration plus:
+
+    - ``max(FEED_DEBOUNCE_SECONDS, FEED_MIN_REBUILD_SECONDS)`` for shares and
+      unshares made through this worker
+    - ``FEED_REFRESH_SECONDS`` for those made through other workers, ratings
+      and download counts
+
+    and clients may keep a page ``FEED_MAX_AGE`` seconds on top of that.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.built_at = None
+        self._dirty = asyncio.Event()
+
+    def lookup(self, sort: str, cursor: Optional[str]):
+        """Serialized page body and ETag, or None if not in the snapshot"""
+        return self.pages.get((sort, cursor))
+
+    def mark_dirty(self):
+        """Ask for a rebuild after a change to shared files"""
+        self._dirty.set()
+
+    async def build(self):
+        """Query each sort order once and split the results into pages"""
+        db = get_firestore_client()
+        base = db.collection('shared_files').where('is_active', '==', True).select(LIST_FIELDS)
+        results = await asyncio.gather(*[
+            firestore_stream(base.order_by(field, direction=Query.DESCENDING).limit(FEED_PAGE_SIZE * FEED_PAGES + 1))
+            for field in SORT_FIELDS.values()
+        ])
+
+        pages = {}
+        for sort, docs in zip(SORT_FIELDS, results):
+            cursor = None
+            for start in range(0, min(len(docs), FEED_PAGE_SIZE * FEED_PAGES) or 1, FEED_PAGE_SIZE):
+                body = community_page(docs[start:start + FEED_PAGE_SIZE + 1], FEED_PAGE_SIZE)
+                pages[(sort, cursor)] = self._serialize(body)
+                cursor = body['next_cursor']
+                if cursor is None:
+                    break
+        self.pages = pages
+        self.built_at = datetime.now()
+
+        if FEED_SNAPSHOT_OBJECT:
+            await self._save()
+
+    @staticmethod
+    def _serialize(body: dict):
+        data = json.dumps(body, separators=(',', ':')).encode()
+        return data, '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+    async def _save(self):
+        snapshot = {
+            'built_at': self.built_at.isoformat(),
+            'pages': [[sort, cursor, data.decode()] for (sort, cursor), (data, _) in self.pages.items()],
+        }
+        blob = get_storage_bucket().blob(FEED_SNAPSHOT_OBJECT)
+        await storage_call(blob.upload_from_string, json.dumps(snapshot), content_type='application/json')
+
+    async def load(self):
+        """Seed the snapshot from the mirrored storage object, if configured"""
+        if not FEED_SNAPSHOT_OBJECT:
+            return
+        try:
+            raw = await storage_call(get_storage_bucket().blob(FEED_SNAPSHOT_OBJECT).download_as_bytes)
+        except gcs_exceptions.NotFound:
+            return
+        snapshot = json.loads(raw)
+        self.pages = {
+            (sort, cursor): self._serialize(json.loads(data))
+            for sort, cursor, data in snapshot['pages']
+        }
+        self.built_at = datetime.fromisoformat(snapshot['built_at'])
+
+    async def run_forever(self):
+        """Keep the snapshot fresh; meant to run as a background task"""
+        try:
+            await self.load()
+        except Exception as e:
+            logging.error(f"Loading community feed snapshot failed: {e}")
+        while True:
+            started = time.monotonic()
+            try:
+                await self.build()
+            except Exception as e:
+                logging.error(f"Building community feed failed: {e}")
+            try:
+                await asyncio.wait_for(self._dirty.wait(), timeout=FEED_REFRESH_SECONDS)
+                await asyncio.sleep(max(FEED_DEBOUNCE_SECONDS, started + FEED_MIN_REBUILD_SECONDS - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+
+community_feed = CommunityFeed()
+
+async def backfill_share_filters():
+    """Fill in ``file_extension`` and ``size_bucket`` on shares that lack them.
+
+    Walks ``shared_files`` a page at a time, so filtered listings find shares
+    made before those fields existed. Returns the number of shares updated.
+    """
+    db = get_firestore_client()
+    fields = ['file_name', 'file_size', 'file_extension', 'size_bucket']
+    query = db.collection('shared_files').order_by('__name__').select(fields).limit(BATCH_WRITE_LIMIT)
+    updated = 0
+    page = await firestore_stream(query)
+    while page:
+        batch = db.batch()
+        writes = 0
+        for doc in page:
+            shared = doc.to_dict()
+            missing = {
+                'file_extension': file_extension(shared.get('file_name', '')),
+                'size_bucket': size_bucket(shared.get('file_size', 0)),
+            }
+            missing = {field: value for field, value in missing.items() if field not in shared}
+            if missing:
+                batch.update(doc.reference, missing)
+                writes += 1
+        if writes:
+            await firestore_call(batch.commit)
+            updated += writes
+        if len(page) < BATCH_WRITE_LIMIT:
+            break
+        page = await firestore_stream(query.start_after(page[-1]))
+    return updated
+
+@job_queue.handler('backfill_share_filters')
+async def run_share_filter_backfill(payload: dict):
+    """Job: ``backfill_share_filters``, then refresh the feed"""
+    updated = await backfill_share_filters()
+    logging.info(f"Share filter backfill updated {updated} shares")
+    if updated:
+        community_feed.mark_dirty()
+
+async def schedule_share_filter_backfill():
+    """Record the backfill job unless some worker already has; run at startup"""
+    job_ref, job = job_queue.new_job('backfill_share_filters', {}, job_id=SHARE_FILTER_BACKFILL_JOB)
+    try:
+        await firestore_call(job_ref.create, job)
+    except gcs_exceptions.AlreadyExists:
+        return False
+    except Exception as e:
+        logging.error(f"Scheduling the share filter backfill failed: {e}")
+        return False
+    job_queue.submit(job_ref.id)
+    return True
+
+# Downloads are counted in shards and rolled up into downloads_count
+download_counter = ShardedCounter('shared_files', 'downloads_count')
+
+# Legacy shares kept every vote in a ``ratings`` map on the document; maps up
+# to this size are moved into the ratings subcollection on their next vote
+RATING_MIGRATE_MAX = 400
+
+@firestore.transactional
+def apply_rating(transaction, shared_ref, uid: str, rating: int):
+    """Record one user's rating and update the running totals on the share.
+
+    Each vote lives in ``ratings/{uid}`` under the shared file, and the parent
+    keeps ``rating_sum`` and ``rating_count``, so a vote reads and writes a
+    fixed number of small documents however many ratings the file has. A
+    re-rate changes the sum by the difference from the previous vote.
+    Returns ``(previous_rating, average_rating, rating_count)``.
+    """
+    shared_file = shared_ref.get(transaction=transaction)
+    if not shared_file.exists:
+        raise HTTPException(status_code=404, detail="Shared file not found")
+    shared_file_data = shared_file.to_dict()
+
+    # Can't rate your own file
+    if shared_file_data['shared_by_uid'] == uid:
+        raise HTTPException(status_code=400, detail="You cannot rate your own file")
+
+    ratings_ref = shared_ref.collection('ratings')
+    rating_ref = ratings_ref.document(uid)
+    previous = rating_ref.get(transaction=transaction)
+    legacy = shared_file_data.get('ratings') or {}
+    old_rating = previous.get('rating') if previous.exists else legacy.get(uid)
+
+    update = {}
+    rating_sum = shared_file_data.get('rating_sum')
+    rating_count = shared_file_data.get('rating_count', 0)
+    if rating_sum is None:
+        # First vote since the move off the ratings map: seed the totals from it
+        rating_sum = sum(legacy.values())
+        rating_count = len(legacy)
+        if len(legacy) <= RATING_MIGRATE_MAX:
+            for rater_uid, value in legacy.items():
+                if rater_uid != uid:
+                    transaction.set(ratings_ref.document(rater_uid), {'rating': value})
+            update['ratings'] = firestore.DELETE_FIELD
+
+    if old_rating is None:
+        rating_sum += rating
+        rating_count += 1
+    else:
+        rating_sum += rating - old_rating
+    average_rating = round(rating_sum / rating_count, 1)
+
+    transaction.set(rating_ref, {'rating': rating, 'rated_at': firestore.SERVER_TIMESTAMP})
+    transaction.update(shared_ref, {
+        **update,
+        'rating_sum': rating_sum,
+        'rating_count': rating_count,
+        'average_rating': average_rating,
+    })
+    return old_rating, average_rating, rating_count
+
 class ShareFileRequest(BaseModel):
     """Request model for sharing a file."""
     file_id: str
     description: Optional[str] = ""
 
+class BatchShareRequest(BaseModel):
+    """Request model for sharing several files with one description."""
+    file_ids: List[str]
+    description: Optional[str] = ""
+
+def shared_file_document(shared_file_id: str, file_id: str, original_file: dict, user, description: Optional[str]):
+    """New ``shared_files`` document for one of the user's files"""
+    return {
+        'id': shared_file_id,
+        'original_file_id': file_id,
+        'shared_by_uid': user['uid'],
+        'shared_by_name': user.get('name', user.get('email', '').split('@')[0]),
+        'file_name': original_file.get('name', 'Unknown File'),
+        'file_size': original_file.get('size', 0),
+        'description': description or '',
+        'downloads_count': 0,
+        'downloads_count_sharded': True,
+        'average_rating': 0.0,
+        'rating_sum': 0,
+        'rating_count': 0,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'is_active': True,
+        'file_type': original_file.get('content_type', original_file.get('type', '')),
+        'file_extension': file_extension(original_file.get('name', '')),
+        'size_bucket': size_bucket(original_file.get('size', 0)),
+        'storage_path': original_file['storage_path']
+    }
+
 class CommunityFile(BaseModel):
     """Response model for community files."""
     id: str
@@ -35,13 +399,13 @@ class RateFileRequest(BaseModel):
     rating: int  # 1-5 stars
 
 @router.post("/share")
-async def share_file(request: ShareFileRequest, user = Depends(verify_token)):
+async def share_file(request: ShareFileRequest, user = Depends(daily_quota('shares'))):
     """Share a user's file with the community."""
     try:
         db = get_firestore_client()
         
         # Get the original file info using document ID
-        file_doc = db.collection('files').document(request.file_id).get()
+        file_doc = await firestore_call(db.collection('files').document(request.file_id).get)
         
         if not file_doc.exists:
             raise HTTPException(status_code=404, detail="File not found")
@@ -52,32 +416,24 @@ async def share_file(request: ShareFileRequest, user = Depends(verify_token)):
         if original_file.get('user_id') != user['uid']:
             raise HTTPException(status_code=403, detail="You can only share your own files")
         
+        # ``path`` is the client's folder, not an object; without stored
+        # content there is nothing for the community to download
+        if not original_file.get('storage_path'):
+            raise HTTPException(status_code=409, detail="File has no stored content to share")
+        
         # Check if file is already shared
-        existing_share = db.collection('shared_files').where('original_file_id', '==', request.file_id).where('shared_by_uid', '==', user['uid']).stream()
-        if list(existing_share):
+        existing_share = await firestore_stream(
+            db.collection('shared_files').where('original_file_id', '==', request.file_id).where('shared_by_uid', '==', user['uid'])
+        )
+        if existing_share:
             raise HTTPException(status_code=400, detail="File is already shared")
         
         # Create shared file entry
         shared_file_id = str(uuid.uuid4())
-        shared_file_data = {
-            'id': shared_file_id,
-            'original_file_id': request.file_id,
-            'shared_by_uid': user['uid'],
-            'shared_by_name': user.get('name', user.get('email', '').split('@')[0]),
-            'file_name': original_file.get('name', 'Unknown File'),
-            'file_size': original_file.get('size', 0),
-            'description': request.description or '',
-            'downloads_count': 0,
-            'ratings': {},
-            'average_rating': 0.0,
-            'rating_count': 0,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'is_active': True,
-            'file_type': original_file.get('content_type', original_file.get('type', '')),
-            'storage_path': original_file.get('storage_path', original_file.get('path', ''))
-        }
+        shared_file_data = shared_file_document(shared_file_id, request.file_id, original_file, user, request.description)
         
-        db.collection('shared_files').document(shared_file_id).set(shared_file_data)
+        await firestore_call(db.collection('shared_files').document(shared_file_id).set, shared_file_data)
+        community_feed.mark_dirty()
         
         return {
             "message": "File shared successfully!",
@@ -88,96 +444,129 @@ async def share_file(request: ShareFileRequest, user = Depends(verify_token)):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error sharing file: {e}")
-        print(f"Error type: {type(e)}")
-        print(f"User data: {user}")
-        print(f"Original file data: {original_file}")
+        logging.error(f"Error sharing file {request.file_id}: {type(e).__name__}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to share file: {str(e)}")
 
+@router.post("/batch-share")
+async def batch_share_files(request: BatchShareRequest, user = Depends(verify_token)):
+    """Share many of the user's files with the community at once."""
+    file_ids = batch_ids(request.file_ids)
+    try:
+        db = get_firestore_client()
+        owned, not_found, forbidden = await get_owned_files(db, file_ids, user['uid'])
+        
+        # One query for everything this user has shared, instead of one per file
+        existing = await firestore_stream(
+            db.collection('shared_files').where('shared_by_uid', '==', user['uid']).select(['original_file_id'])
+        )
+        shared_ids = {doc.get('original_file_id') for doc in existing}
+        already_shared = [file_id for file_id in owned if file_id in shared_ids]
+        not_stored = [file_id for file_id in owned if file_id not in shared_ids and not owned[file_id].get('storage_path')]
+        to_share = [file_id for file_id in owned if file_id not in shared_ids and file_id not in not_stored]
+        
+        if to_share:
+            await take_daily_quota(user['uid'], 'shares', len(to_share))
+        
+        shared = []
+        for start in range(0, len(to_share), BATCH_WRITE_LIMIT):
+            batch = db.batch()
+            for file_id in to_share[start:start + BATCH_WRITE_LIMIT]:
+                shared_file_id = str(uuid.uuid4())
+                batch.set(
+                    db.collection('shared_files').document(shared_file_id),
+                    shared_file_document(shared_file_id, file_id, owned[file_id], user, request.description)
+                )
+                shared.append({'file_id': file_id, 'shared_file_id': shared_file_id})
+            await firestore_call(batch.commit)
+        if shared:
+            community_feed.mark_dirty()
+        
+        return {
+            "message": f"Shared {len(shared)} files",
+            "shared": shared,
+            "already_shared": already_shared,
+            "not_stored": not_stored,
+            "not_found": not_found,
+            "forbidden": forbidden
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error batch sharing files: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to share files: {str(e)}")
+
 @router.get("/files")
-async def get_community_files(limit: int = 50, offset: int = 0):
-    """Get list of community shared files."""
+async def get_community_files(
+    request: Request,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    sort: Literal['newest', 'downloads', 'rating'] = 'newest',
+    file_type: Optional[str] = None,
+    size: Optional[Literal['small', 'medium', 'large', 'huge']] = None
+):
+    """Get one page of community shared files.
+
+    Unfiltered requests for the first pages are served from the precomputed
+    feed snapshot. Everything else is served by a composite index (see
+    firestore.indexes.json), so any page costs about ``limit`` reads.
+    Pass ``next_cursor`` back as ``cursor`` for the following page.
+    """
+    if limit == FEED_PAGE_SIZE and not file_type and not size:
+        cached = community_feed.lookup(sort, cursor)
+        if cached is not None:
+            data, etag = cached
+            headers = {'ETag': etag, 'Cache-Control': f'public, max-age={FEED_MAX_AGE}'}
+            if etag_matches(request.headers.get('if-none-match', ''), etag):
+                return Response(status_code=304, headers=headers)
+            return Response(content=data, media_type='application/json', headers=headers)
+
     try:
+        limit = max(1, min(limit, COMMUNITY_MAX_PAGE_SIZE))
         db = get_firestore_client()
+        shared_ref = db.collection('shared_files')
         
-        # Get shared files - using simple query until index is fully propagated
-        query = (db.collection('shared_files')
-                .where('is_active', '==', True)
-                .limit(limit))
-        
-        shared_files = []
-        for doc in query.stream():
-            file_data = doc.to_dict()
-            shared_files.append({
-                'id': file_data['id'],
-                'original_file_id': file_data['original_file_id'],
-                'shared_by_uid': file_data['shared_by_uid'],
-                'shared_by': file_data['shared_by_name'],
-                'name': file_data['file_name'],
-                'size': file_data['file_size'],
-                'description': file_data['description'],
-                'downloads': file_data['downloads_count'],
-                'average_rating': file_data['average_rating'],
-                'rating_count': file_data['rating_count'],
-                'created_at': file_data['created_at'].isoformat() if isinstance(file_data['created_at'], datetime) else str(file_data['created_at'])
-            })
-        
-        return {"files": shared_files, "total": len(shared_files)}
+        query = shared_ref.where('is_active', '==', True)
+        if file_type:
+            query = query.where('file_extension', '==', file_type.lstrip('.').lower())
+        if size:
+            query = query.where('size_bucket', '==', size)
+        query = query.order_by(SORT_FIELDS[sort], direction=Query.DESCENDING).select(LIST_FIELDS)
         
+        if cursor:
+            cursor_doc = await firestore_call(shared_ref.document(cursor).get)
+            if not cursor_doc.exists:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.start_after(cursor_doc)
+        
+        # One extra document tells us whether another page exists
+        docs = await firestore_stream(query.limit(limit + 1))
+        return community_page(docs, limit)
+        
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error getting community files: {e}")
+        logging.error(f"Error getting community files: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get community files: {str(e)}")
 
 @router.post("/{shared_file_id}/download")
-async def download_community_file(shared_file_id: str, user = Depends(verify_token)):
+async def download_community_file(shared_file_id: str, user = Depends(daily_quota('downloads'))):
     """Download a community shared file."""
     try:
         db = get_firestore_client()
         
         # Get shared file info
-        shared_file_doc = db.collection('shared_files').document(shared_file_id).get()
-        if not shared_file_doc.exists:
+        shared_file_doc = await firestore_call(db.collection('shared_files').document(shared_file_id).get)
+        shared_file_data = shared_file_doc.to_dict() if shared_file_doc.exists else None
+        if not shared_file_data or not shared_file_data.get('is_active'):
             raise HTTPException(status_code=404, detail="Shared file not found")
         
-        shared_file_data = shared_file_doc.to_dict()
-        
-        # Check user's download limits (if Basic tier)
-        user_doc = db.collection('users').document(user['uid']).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            subscription_tier = user_data.get('subscription_tier', 'basic')
-            
-            if subscription_tier == 'basic':
-                # Check daily download count
-                today = datetime.now().date()
-                downloads_today = user_data.get('daily_downloads', {}).get(str(today), 0)
-                
-                if downloads_today >= 10:  # Basic tier limit
-                    raise HTTPException(status_code=429, detail="Daily download limit reached. Upgrade to Premium for unlimited downloads!")
-        
-        # Generate download URL
-        bucket = get_storage_bucket()
-        blob = bucket.blob(shared_file_data['storage_path'])
-        
-        if not blob.exists():
-            raise HTTPException(status_code=404, detail="File not found in storage")
-        
-        # Generate signed URL (valid for 1 hour)
-        expiration_time = datetime.now() + timedelta(hours=1)
-        download_url = blob.generate_signed_url(expiration=expiration_time, method='GET')
+        # The share document is trusted to point at a stored object; clients
+        # that get a 404 from the URL call /report-missing to repair it
+        download_url = await signed_download_url(shared_file_data['storage_path'])
         
         # Update download count
-        db.collection('shared_files').document(shared_file_id).update({
-            'downloads_count': shared_file_data['downloads_count'] + 1
-        })
-        
-        # Update user's daily download count (if Basic tier)
-        if subscription_tier == 'basic':
-            daily_downloads = user_data.get('daily_downloads', {})
-            daily_downloads[str(today)] = downloads_today + 1
-            db.collection('users').document(user['uid']).update({
-                'daily_downloads': daily_downloads
-            })
+        await download_counter.increment(shared_file_id)
         
         return {
             "download_url": download_url,
@@ -185,10 +574,63 @@ async def download_community_file(shared_file_id: str, user = Depends(verify_tok
             "file_size": shared_file_data['file_size']
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error downloading community file: {e}")
+        logging.error(f"Error downloading community file: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to download file: {str(e)}")
 
+@router.post("/{shared_file_id}/report-missing")
+async def report_missing_file(shared_file_id: str, user = Depends(verify_token)):
+    """Repair a shared file whose download URL returned 404.
+
+    Points the share at the original file's current object if that moved
+    (e.g. after a delta update), or takes the share down if the file is gone.
+    """
+    try:
+        db = get_firestore_client()
+        bucket = get_storage_bucket()
+        shared_ref = db.collection('shared_files').document(shared_file_id)
+        
+        shared_file_doc = await firestore_call(shared_ref.get)
+        shared_file_data = shared_file_doc.to_dict() if shared_file_doc.exists else None
+        if not shared_file_data or not shared_file_data.get('is_active'):
+            raise HTTPException(status_code=404, detail="Shared file not found")
+        storage_path = shared_file_data['storage_path']
+        signed_url_cache.pop(storage_path)
+        
+        if await storage_call(bucket.blob(storage_path).exists):
+            return {"download_url": await signed_download_url(storage_path), "repaired": False}
+        
+        original_doc = await firestore_call(db.collection('files').document(shared_file_data['original_file_id']).get)
+        if original_doc.exists:
+            original_file = original_doc.to_dict()
+            new_path = original_file.get('storage_path')
+            if new_path and new_path != storage_path and await storage_call(bucket.blob(new_path).exists):
+                file_size = original_file.get('size', shared_file_data['file_size'])
+                await firestore_call(shared_ref.update, {
+                    'storage_path': new_path,
+                    'file_size': file_size,
+                    'size_bucket': size_bucket(file_size)
+                })
+                community_feed.mark_dirty()
+                return {"download_url": await signed_download_url(new_path), "repaired": True}
+        
+        # Nothing left to serve: take the share down
+        await firestore_call(shared_ref.update, {
+            'is_active': False,
+            'unshared_at': datetime.now(),
+            'missing_from_storage': True
+        })
+        community_feed.mark_dirty()
+        raise HTTPException(status_code=404, detail="File not found in storage")
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error repairing community file: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to check file: {str(e)}")
+
 @router.post("/{shared_file_id}/rate")
 async def rate_community_file(shared_file_id: str, request: RateFileRequest, user = Depends(verify_token)):
     """Rate a community shared file."""
@@ -198,44 +640,25 @@ async def rate_community_file(shared_file_id: str, request: RateFileRequest, use
         
         db = get_firestore_client()
         
-        # Get shared file
-        shared_file_doc = db.collection('shared_files').document(shared_file_id).get()
-        if not shared_file_doc.exists:
-            raise HTTPException(status_code=404, detail="Shared file not found")
-        
-        shared_file_data = shared_file_doc.to_dict()
-        
-        # Can't rate your own file
-        if shared_file_data['shared_by_uid'] == user['uid']:
-            raise HTTPException(status_code=400, detail="You cannot rate your own file")
-        
-        # Update rating
-        ratings = shared_file_data.get('ratings', {})
-        old_rating = ratings.get(user['uid'])
-        ratings[user['uid']] = request.rating
-        
-        # Recalculate average rating
-        total_rating = sum(ratings.values())
-        rating_count = len(ratings)
-        average_rating = total_rating / rating_count if rating_count > 0 else 0
-        
-        # Update in database
-        db.collection('shared_files').document(shared_file_id).update({
-            'ratings': ratings,
-            'average_rating': round(average_rating, 1),
-            'rating_count': rating_count
-        })
+        shared_ref = db.collection('shared_files').document(shared_file_id)
+        old_rating, average_rating, rating_count = await firestore_call(
+            apply_rating, db.transaction(), shared_ref, user['uid'], request.rating
+        )
+        # Ratings reach the feed on its periodic refresh; a rebuild per vote
+        # would cost more reads than the snapshot saves
         
         return {
             "message": f"Rated {request.rating} stars!",
             "your_rating": request.rating,
-            "average_rating": round(average_rating, 1),
+            "average_rating": average_rating,
             "total_ratings": rating_count,
             "previous_rating": old_rating
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error rating file: {e}")
+        logging.error(f"Error rating file: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to rate file: {str(e)}")
 
 @router.delete("/{shared_file_id}")
@@ -245,7 +668,7 @@ async def unshare_file(shared_file_id: str, user = Depends(verify_token)):
         db = get_firestore_client()
         
         # Get shared file
-        shared_file_doc = db.collection('shared_files').document(shared_file_id).get()
+        shared_file_doc = await firestore_call(db.collection('shared_files').document(shared_file_id).get)
         if not shared_file_doc.exists:
             raise HTTPException(status_code=404, detail="Shared file not found")
         
@@ -256,13 +679,14 @@ async def unshare_file(shared_file_id: str, user = Depends(verify_token)):
             raise HTTPException(status_code=403, detail="You can only unshare your own files")
         
         # Soft delete (set inactive)
-        db.collection('shared_files').document(shared_file_id).update({
+        await firestore_call(db.collection('shared_files').document(shared_file_id).update, {
             'is_active': False,
             'unshared_at': datetime.now()
         })
+        community_feed.mark_dirty()
         
         return {"message": "File removed from community sharing"}
         
     except Exception as e:
-        print(f"Error unsharing file: {e}")
+        logging.error(f"Error unsharing file: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to unshare file: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,270 @@
+"""Content-addressed, reference-counted storage for uploaded files.
+
+Each distinct file body is stored once under ``cas/{sha[:2]}/{sha}``. A
+``blobs/{sha}`` Firestore document tracks how many ``files`` documents point
+at it. The object is deleted only when the last reference goes away.
+
+Deletes are guarded with the object (and resource index) generation
+recorded in ``blobs/{sha}``, so a delete that races a re-upload of the same
+content cannot remove the new copy.
+"""
+import hashlib
+import io
+import json
+import os
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gcs_exceptions
+
+from . import dbpf
+from .cache import TTLCache
+from .executor import firestore_call, local_call, storage_call
+from .firebase_config import get_firestore_client, get_storage_bucket
+
+BLOBS_COLLECTION = 'blobs'
+HASH_CHUNK_SIZE = 1024 * 1024
+# Parsed DBPF indexes of stored packages, keyed by content hash
+dbpf_index_cache = TTLCache(max_entries=64, ttl=600)
+# Resumable upload chunk size; Cloud Storage requires a multiple of 256 KiB.
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+
+class HashingReader:
+    """File wrapper that counts and hashes bytes as the storage client reads them.
+
+    Resumable uploads may seek backwards to resend a chunk, so only bytes past
+    the furthest point already seen are fed into the hash.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        start = self._file.tell()
+        chunk = self._file.read(size)
+        end = start + len(chunk)
+        if end > self.size:
+            self.sha256.update(chunk[self.size - start:])
+            self.size = end
+        return chunk
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+def stream_upload(blob, fileobj, content_type):
+    """Upload a file object in fixed-size chunks over a resumable session.
+
+    Returns the number of bytes uploaded and their SHA-256 hex digest.
+    """
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    reader = HashingReader(fileobj)
+    blob.upload_from_file(reader, rewind=True, content_type=content_type)
+    return reader.size, reader.sha256.hexdigest()
+
+def content_path(content_hash: str):
+    """Storage path for a blob with the given SHA-256"""
+    return f"cas/{content_hash[:2]}/{content_hash}"
+
+def is_content_addressed(file_data: dict):
+    """Whether a ``files`` document points at a shared content-addressed blob"""
+    content_hash = file_data.get('content_hash')
+    return bool(content_hash) and file_data.get('storage_path') == content_path(content_hash)
+
+def dbpf_index_path(content_hash: str):
+    """Storage path of the resource index kept alongside a stored package"""
+    return f"dbpf-index/{content_hash}.json"
+
+def build_dbpf_index(fileobj):
+    """Segment list for a DBPF package, or None for any other file"""
+    try:
+        if not dbpf.is_dbpf(fileobj):
+            return None
+        return dbpf.split_package(fileobj)
+    except dbpf.DBPFError:
+        return None
+    finally:
+        fileobj.seek(0)
+
+async def load_dbpf_index(content_hash: str):
+    """Segments of a stored package, or None if it has no resource index"""
+    segments = dbpf_index_cache.get(content_hash)
+    if segments is None:
+        blob = get_storage_bucket().blob(dbpf_index_path(content_hash))
+        try:
+            raw = await storage_call(blob.download_as_bytes)
+        except gcs_exceptions.NotFound:
+            return None
+        segments = [dbpf.Segment(*fields) for fields in json.loads(raw)]
+        dbpf_index_cache.set(content_hash, segments)
+    return segments
+
+def hash_file(fileobj):
+    """Size and SHA-256 of a local file object, leaving it rewound"""
+    sha256 = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return size, sha256.hexdigest()
+
+@firestore.transactional
+def _add_reference(transaction, blob_ref, new_blob):
+    snapshot = blob_ref.get(transaction=transaction)
+    if snapshot.exists:
+        blob_data = snapshot.to_dict()
+        update = {'ref_count': firestore.Increment(1)}
+        # Concurrent first uploads overwrite each other; the newest generation is live
+        if new_blob and new_blob.get('generation', 0) > blob_data.get('generation', 0):
+            update['generation'] = new_blob['generation']
+        transaction.update(blob_ref, update)
+        return blob_data
+    if new_blob is None:
+        return None
+    transaction.set(blob_ref, {
+        **new_blob,
+        'ref_count': 1,
+        'created_at': firestore.SERVER_TIMESTAMP,
+    })
+    return new_blob
+
+def remove_references(transaction, db, references: dict):
+    """Drop references inside a caller's transaction, before any of its writes.
+
+    ``references`` maps content hash to the number of references going away.
+    Returns the documents of blobs that lost their last reference, by hash;
+    once the transaction has committed, pass each to ``delete_blob_objects``.
+    """
+    blob_refs = [db.collection(BLOBS_COLLECTION).document(content_hash) for content_hash in references]
+    snapshots = list(db.get_all(blob_refs, transaction=transaction)) if blob_refs else []
+    removed = {}
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+        blob_data = snapshot.to_dict()
+        count = references[snapshot.id]
+        if blob_data.get('ref_count', 0) <= count:
+            transaction.delete(snapshot.reference)
+            removed[snapshot.id] = blob_data
+        else:
+            transaction.update(snapshot.reference, {'ref_count': firestore.Increment(-count)})
+    return removed
+
+@firestore.transactional
+def _remove_reference(transaction, db, content_hash, count):
+    return remove_references(transaction, db, {content_hash: count}).get(content_hash)
+
+async def acquire_blob(content_hash: str):
+    """Add a reference to an already stored blob.
+
+    Returns the blob document, or None if the content is not stored yet.
+    """
+    db = get_firestore_client()
+    blob_ref = db.collection(BLOBS_COLLECTION).document(content_hash)
+    return await firestore_call(_add_reference, db.transaction(), blob_ref, None)
+
+async def register_blob(content_hash: str, blob_data: dict):
+    """Record a freshly uploaded blob, or add a reference if it raced another upload"""
+    db = get_firestore_client()
+    blob_ref = db.collection(BLOBS_COLLECTION).document(content_hash)
+    return await firestore_call(_add_reference, db.transaction(), blob_ref, blob_data)
+
+async def release_blob(content_hash: str, count: int = 1):
+    """Drop ``count`` references, deleting the stored object with the last one"""
+    db = get_firestore_client()
+    removed = await firestore_call(_remove_reference, db.transaction(), db, content_hash, count)
+    if removed is None:
+        return False
+    await delete_blob_objects(content_hash, removed)
+    return True
+
+async def delete_blob_objects(content_hash: str, blob_data: dict):
+    """Delete the object and resource index of a blob whose last reference went"""
+    bucket = get_storage_bucket()
+    # The index goes first: it is only useful next to the object it describes
+    if blob_data.get('dbpf_index_path'):
+        dbpf_index_cache.pop(content_hash)
+        try:
+            await storage_call(
+                bucket.blob(blob_data['dbpf_index_path']).delete,
+                if_generation_match=blob_data.get('dbpf_index_generation')
+            )
+        except (gcs_exceptions.NotFound, gcs_exceptions.PreconditionFailed):
+            pass
+    try:
+        await storage_call(bucket.blob(blob_data['storage_path']).delete, if_generation_match=blob_data.get('generation'))
+    except (gcs_exceptions.NotFound, gcs_exceptions.PreconditionFailed):
+        # Already gone, or re-uploaded since the count hit zero
+        pass
+
+async def _register_stored(content_hash: str, size: int, blob, fileobj, content_type: str):
+    """Publish an object just written under ``content_path`` and record it.
+
+    ``fileobj`` is a local copy of its bytes, used for the resource index.
+    """
+    await storage_call(blob.make_public)
+    blob_data = {
+        'storage_path': blob.name,
+        'size': size,
+        'content_type': content_type,
+        'download_url': blob.public_url,
+        'generation': blob.generation,
+    }
+    # Keep a resource index next to packages so updates can be sent as deltas
+    segments = await local_call(build_dbpf_index, fileobj)
+    if segments:
+        index_blob = get_storage_bucket().blob(dbpf_index_path(content_hash))
+        await storage_call(
+            index_blob.upload_from_string,
+            json.dumps([list(segment) for segment in segments]),
+            content_type='application/json'
+        )
+        blob_data['dbpf_index_path'] = index_blob.name
+        blob_data['dbpf_index_generation'] = index_blob.generation
+
+    return await register_blob(content_hash, blob_data)
+
+async def store_content(fileobj, content_type: str):
+    """Store a local file object once per distinct content and reference it.
+
+    Returns ``(content_hash, blob_data, deduplicated)``. When the content is
+    already stored no bytes are sent to Cloud Storage. The reference is taken
+    here; a caller whose ``files`` write then fails must ``release_blob`` it.
+    """
+    size, content_hash = await local_call(hash_file, fileobj)
+    blob_data = await acquire_blob(content_hash)
+    if blob_data is not None:
+        return content_hash, blob_data, True
+
+    blob = get_storage_bucket().blob(content_path(content_hash))
+    uploaded_size, uploaded_hash = await storage_call(stream_upload, blob, fileobj, content_type)
+    if uploaded_hash != content_hash:
+        raise ValueError("File changed while it was being uploaded")
+    blob_data = await _register_stored(content_hash, uploaded_size, blob, fileobj, content_type)
+    return content_hash, blob_data, False
+
+async def adopt_content(blob, fileobj, content_type: str):
+    """Take an object uploaded elsewhere in the bucket into the content store.
+
+    ``fileobj`` is a local copy of the object's bytes. The object is copied
+    under ``content_path`` inside Cloud Storage unless that content is
+    already stored; either way the caller deletes the original. Returns and
+    references like ``store_content``.
+    """
+    size, content_hash = await local_call(hash_file, fileobj)
+    blob_data = await acquire_blob(content_hash)
+    if blob_data is not None:
+        return content_hash, blob_data, True
+
+    bucket = get_storage_bucket()
+    stored = await storage_call(bucket.copy_blob, blob, bucket, content_path(content_hash))
+    blob_data = await _register_stored(content_hash, size, stored, fileobj, content_type)
+    return content_hash, blob_data, False
@@ -0,0 +1,92 @@
+"""Sharded counters for hot, frequently incremented fields.
+
+A counter for ``{collection}/{doc_id}.{field}`` is spread over
+``num_shards`` documents in the ``{field}_shards`` subcollection. Each
+increment is a single atomic ``Increment`` on a random shard, so concurrent
+increments to one document neither contend nor get lost. Touched documents
+are rolled up periodically: the shard sum is written back to ``field`` on the
+parent, which is what listings read.
+
+Documents created before sharding keep their old value: the first rollup
+moves it into shard 0 and sets ``{field}_sharded`` on the parent.
+"""
+import asyncio
+import logging
+import os
+import random
+
+from firebase_admin import firestore
+
+from .executor import firestore_call
+from .firebase_config import get_firestore_client
+
+COUNTER_SHARDS = int(os.getenv("COUNTER_SHARDS", 20))
+COUNTER_ROLLUP_SECONDS = int(os.getenv("COUNTER_ROLLUP_SECONDS", 30))
+
+class ShardedCounter:
+    """Atomic, contention-free counter stored in shard documents"""
+
+    def __init__(self, collection: str, field: str, num_shards: int = COUNTER_SHARDS):
+        self.collection = collection
+        self.field = field
+        self.num_shards = num_shards
+        # Documents incremented by this worker since their last rollup
+        self._dirty = set()
+
+    def _parent(self, doc_id: str):
+        return get_firestore_client().collection(self.collection).document(doc_id)
+
+    def _shards(self, doc_id: str):
+        return self._parent(doc_id).collection(f'{self.field}_shards')
+
+    async def increment(self, doc_id: str, amount: int = 1):
+        """Add ``amount`` to a random shard"""
+        shard_ref = self._shards(doc_id).document(str(random.randrange(self.num_shards)))
+        await firestore_call(shard_ref.set, {'count': firestore.Increment(amount)}, merge=True)
+        self._dirty.add(doc_id)
+
+    def _rollup(self, doc_id: str):
+        parent_ref = self._parent(doc_id)
+        shards_ref = self._shards(doc_id)
+        sharded_flag = f'{self.field}_sharded'
+
+        @firestore.transactional
+        def apply(transaction):
+            parent = parent_ref.get(transaction=transaction)
+            if not parent.exists:
+                return None
+            parent_data = parent.to_dict()
+            total = sum(shard.to_dict().get('count', 0) for shard in shards_ref.stream(transaction=transaction))
+            update = {}
+            if not parent_data.get(sharded_flag):
+                # Fold the pre-sharding value into shard 0 exactly once
+                legacy = parent_data.get(self.field, 0)
+                transaction.set(shards_ref.document('0'), {'count': firestore.Increment(legacy)}, merge=True)
+                total += legacy
+                update[sharded_flag] = True
+            if update or total != parent_data.get(self.field):
+                update[self.field] = total
+                transaction.update(parent_ref, update)
+            return total
+
+        return apply(get_firestore_client().transaction())
+
+    async def rollup(self, doc_id: str):
+        """Write the current shard sum back to the parent field"""
+        return await firestore_call(self._rollup, doc_id)
+
+    async def rollup_dirty(self):
+        """Roll up every document this worker has incremented"""
+        dirty, self._dirty = self._dirty, set()
+        for doc_id in dirty:
+            try:
+                await self.rollup(doc_id)
+            except Exception as e:
+                self._dirty.add(doc_id)
+                logging.error(f"Counter rollup failed for {self.collection}/{doc_id}: {e}")
+
+    async def run_forever(self):
+        """Roll up periodically; meant to run as a background task"""
+        while True:
+            await asyncio.sleep(COUNTER_ROLLUP_SECONDS)
+            await self.rollup_dirty()
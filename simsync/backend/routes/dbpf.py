@@ -0,0 +1,195 @@
+"""DBPF (.package) index parsing and resource-level segmentation.
+
+Sims 4 packages are DBPF 2.x containers: a 96-byte header, resource bodies,
+and an index that records each resource's type/group/instance key, offset
+and stored size. ``split_package`` cuts a package into contiguous segments,
+one per resource body plus "raw" segments for the header, index and any
+padding between resources. Concatenating the segments in order reproduces
+the file byte for byte, so a package can be rebuilt from a base version plus
+only the segments that changed.
+
+This module only depends on the standard library so a desktop client can
+reuse it to build the same segment list before uploading.
+"""
+import hashlib
+import struct
+from typing import BinaryIO, List, NamedTuple, Optional
+
+DBPF_MAGIC = b"DBPF"
+HEADER_SIZE = 96
+# Read resources in pieces so large resources never sit in memory whole
+READ_CHUNK_SIZE = 1024 * 1024
+
+class Resource(NamedTuple):
+    type: int
+    group: int
+    instance: int
+    offset: int
+    size: int
+
+class Segment(NamedTuple):
+    offset: int
+    length: int
+    hash: str
+    # None for raw segments (header, index, padding)
+    type: Optional[int] = None
+    group: Optional[int] = None
+    instance: Optional[int] = None
+
+class DBPFError(ValueError):
+    """Raised when a file is not a readable DBPF 2.x package"""
+
+def is_dbpf(fileobj: BinaryIO):
+    """Whether the file starts with a DBPF 2.x header"""
+    start = fileobj.tell()
+    header = fileobj.read(8)
+    fileobj.seek(start)
+    return len(header) == 8 and header[:4] == DBPF_MAGIC and struct.unpack_from("<I", header, 4)[0] == 2
+
+def read_index(fileobj: BinaryIO) -> List[Resource]:
+    """Parse the package index into a list of resources"""
+    fileobj.seek(0)
+    header = fileobj.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:4] != DBPF_MAGIC:
+        raise DBPFError("Not a DBPF package")
+    major, minor = struct.unpack_from("<II", header, 4)
+    if major != 2:
+        raise DBPFError(f"Unsupported DBPF version {major}.{minor}")
+
+    entry_count, = struct.unpack_from("<I", header, 36)
+    index_size, = struct.unpack_from("<I", header, 44)
+    index_offset, = struct.unpack_from("<I", header, 64)
+    if entry_count == 0:
+        return []
+
+    fileobj.seek(index_offset)
+    index = fileobj.read(index_size)
+    if len(index) < 4:
+        raise DBPFError("Truncated package index")
+
+    flags, = struct.unpack_from("<I", index, 0)
+    pos = 4
+    # Bits 0-3 mark type, group, instance-high and instance-low as shared
+    # by every entry and stored once in the index header.
+    constant = [None] * 4
+    for bit in range(4):
+        if flags & (1 << bit):
+            constant[bit], = struct.unpack_from("<I", index, pos)
+            pos += 4
+
+    resources = []
+    try:
+        for _ in range(entry_count):
+            fields = []
+            for bit in range(4):
+                if constant[bit] is not None:
+                    fields.append(constant[bit])
+                else:
+                    fields.append(struct.unpack_from("<I", index, pos)[0])
+                    pos += 4
+            offset, size, _decompressed = struct.unpack_from("<III", index, pos)
+            pos += 12
+            if size & 0x80000000:
+                # compression type and committed flag
+                pos += 4
+            resource_type, group, instance_high, instance_low = fields
+            resources.append(Resource(
+                type=resource_type,
+                group=group,
+                instance=(instance_high << 32) | instance_low,
+                offset=offset,
+                size=size & 0x7FFFFFFF,
+            ))
+    except struct.error:
+        raise DBPFError("Truncated package index")
+    return resources
+
+def _hash_range(fileobj: BinaryIO, offset: int, length: int):
+    sha256 = hashlib.sha256()
+    fileobj.seek(offset)
+    remaining = length
+    while remaining:
+        chunk = fileobj.read(min(READ_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise DBPFError("Resource extends past the end of the package")
+        sha256.update(chunk)
+        remaining -= len(chunk)
+    return sha256.hexdigest()
+
+def split_package(fileobj: BinaryIO) -> List[Segment]:
+    """Cut a package into contiguous, hashed segments covering the whole file"""
+    resources = read_index(fileobj)
+    fileobj.seek(0, 2)
+    file_size = fileobj.tell()
+
+    segments = []
+    cursor = 0
+
+    def add_raw(end):
+        if end > cursor:
+            segments.append(Segment(cursor, end - cursor, _hash_range(fileobj, cursor, end - cursor)))
+
+    for resource in sorted(resources, key=lambda r: (r.offset, r.size)):
+        end = resource.offset + resource.size
+        if resource.size == 0 or resource.offset < cursor or end > file_size:
+            # Empty, overlapping or out-of-range entries stay inside raw segments
+            continue
+        add_raw(resource.offset)
+        segments.append(Segment(
+            resource.offset,
+            resource.size,
+            _hash_range(fileobj, resource.offset, resource.size),
+            resource.type,
+            resource.group,
+            resource.instance,
+        ))
+        cursor = end
+    add_raw(file_size)
+    return segments
+
+def _copy_range(src: BinaryIO, offset: Optional[int], length: int, out: BinaryIO, sha256):
+    """Copy ``length`` bytes from ``src`` (at ``offset``, or its current
+    position when None) to the end of ``out``, hashing them on the way"""
+    segment_hash = hashlib.sha256()
+    remaining = length
+    while remaining:
+        if offset is not None:
+            src.seek(offset + length - remaining)
+        chunk = src.read(min(READ_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise DBPFError("Segment data ended early")
+        out.seek(0, 2)
+        out.write(chunk)
+        segment_hash.update(chunk)
+        sha256.update(chunk)
+        remaining -= len(chunk)
+    return segment_hash.hexdigest()
+
+def assemble_package(segments, base: Optional[BinaryIO], base_segments, chunks: Optional[BinaryIO], out: BinaryIO):
+    """Rebuild a package from a base version plus uploaded segment bodies.
+
+    ``segments`` lists ``(hash, length)`` items in file order. Bodies found in
+    ``base_segments`` are copied from ``base``; bodies already written are
+    copied from ``out``; everything else is read in order from ``chunks``,
+    which holds each missing body once, in order of first appearance. Every
+    segment is re-hashed. Returns the rebuilt size and SHA-256.
+    """
+    base_ranges = {s.hash: (s.offset, s.length) for s in base_segments or []}
+    written = {}
+    sha256 = hashlib.sha256()
+    size = 0
+    for segment in segments:
+        if base is not None and base_ranges.get(segment.hash, (None, None))[1] == segment.length:
+            src, offset = base, base_ranges[segment.hash][0]
+        elif segment.hash in written:
+            src, offset = out, written[segment.hash]
+        elif chunks is not None:
+            src, offset = chunks, None
+        else:
+            raise DBPFError(f"No data for segment {segment.hash}")
+
+        written.setdefault(segment.hash, size)
+        if _copy_range(src, offset, segment.length, out, sha256) != segment.hash:
+            raise DBPFError(f"Data for segment {segment.hash} does not match its hash")
+        size += segment.length
+    return size, sha256.hexdigest()
@@ -0,0 +1,180 @@
+"""Resource-level delta sync for updated .package files.
+
+A client that already backed up a package sends the new version as a list of
+segments (see ``routes.dbpf.split_package``). ``/plan`` answers which
+segment bodies the server does not have in the stored base version, and
+``/commit`` takes just those bodies, rebuilds the full package server-side
+and swaps it in for the base file.
+"""
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional
+from datetime import datetime
+import logging
+import tempfile
+
+from .auth import verify_token
+from .content_store import (
+    is_content_addressed,
+    load_dbpf_index,
+    release_blob,
+    store_content,
+)
+from .dbpf import DBPFError, assemble_package
+from .executor import firestore_call, local_call, storage_call
+from .files import check_storage_quota
+from .firebase_config import get_firestore_client, get_storage_bucket
+from .inspection import PENDING_INSPECTION, add_inspection_job
+from .jobs import job_queue
+from .user_profiles import commit_with_usage
+
+router = APIRouter()
+
+# Rebuilt packages spill to disk past this size
+SPOOL_MAX_SIZE = 1024 * 1024
+
+class DeltaSegment(BaseModel):
+    hash: str  # SHA-256 of the segment body
+    length: int
+
+class DeltaPlanRequest(BaseModel):
+    base_file_id: str
+    size: int
+    sha256: str
+    segments: List[DeltaSegment]
+
+class DeltaPlanResponse(BaseModel):
+    unchanged: bool
+    missing: List[str]  # segment hashes to send, in upload order
+    upload_bytes: int
+    full_bytes: int
+
+class DeltaCommitRequest(DeltaPlanRequest):
+    name: Optional[str] = None
+    path: Optional[str] = None
+    mtime: Optional[float] = None
+
+async def get_base_file(base_file_id: str, user):
+    """Load the user's base file and the resource index of its stored content"""
+    db = get_firestore_client()
+    file_doc = await firestore_call(db.collection('files').document(base_file_id).get)
+    if not file_doc.exists:
+        raise HTTPException(status_code=404, detail="Base file not found")
+    file_data = file_doc.to_dict()
+    if file_data['user_id'] != user['uid']:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    base_segments = None
+    if is_content_addressed(file_data):
+        base_segments = await load_dbpf_index(file_data['content_hash'])
+    if base_segments is None:
+        raise HTTPException(status_code=409, detail="Base file has no resource index; upload the whole file instead")
+    return file_data, base_segments
+
+def plan_missing(segments: List[DeltaSegment], base_segments):
+    """Unique segment hashes absent from the base, in order of first appearance"""
+    known = {(s.hash, s.length) for s in base_segments}
+    missing = {}
+    for segment in segments:
+        if (segment.hash, segment.length) not in known and segment.hash not in missing:
+            missing[segment.hash] = segment.length
+    return missing
+
+def check_segments(request: DeltaPlanRequest):
+    if sum(segment.length for segment in request.segments) != request.size:
+        raise HTTPException(status_code=400, detail="Segment lengths do not add up to the file size")
+
+@router.post("/plan", response_model=DeltaPlanResponse)
+async def plan_delta(request: DeltaPlanRequest, user = Depends(verify_token)):
+    """Work out which segments of an updated package need uploading"""
+    check_segments(request)
+    file_data, base_segments = await get_base_file(request.base_file_id, user)
+    if request.sha256.lower() == file_data['content_hash']:
+        return DeltaPlanResponse(unchanged=True, missing=[], upload_bytes=0, full_bytes=request.size)
+
+    missing = plan_missing(request.segments, base_segments)
+    return DeltaPlanResponse(
+        unchanged=False,
+        missing=list(missing),
+        upload_bytes=sum(missing.values()),
+        full_bytes=request.size
+    )
+
+@router.post("/commit")
+async def commit_delta(
+    manifest: str = Form(...),
+    chunks: Optional[UploadFile] = File(None),
+    user = Depends(verify_token)
+):
+    """Rebuild an updated package from its base plus the uploaded segments.
+
+    ``manifest`` is a JSON ``DeltaCommitRequest``; ``chunks`` holds the bodies
+    of the segments ``/plan`` reported missing, concatenated in that order.
+    """
+    try:
+        request = DeltaCommitRequest.model_validate_json(manifest)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid manifest: {e}")
+    check_segments(request)
+    file_data, base_segments = await get_base_file(request.base_file_id, user)
+    if request.size > file_data.get('size', 0):
+        await check_storage_quota(user['uid'], request.size - file_data.get('size', 0), count=0)
+
+    try:
+        with tempfile.TemporaryFile() as base, tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as rebuilt:
+            # Only pull the base from storage if some segment is reused from it
+            if plan_missing(request.segments, base_segments).keys() != {s.hash for s in request.segments}:
+                base_blob = get_storage_bucket().blob(file_data['storage_path'])
+                await storage_call(base_blob.download_to_file, base)
+
+            size, content_hash = await local_call(
+                assemble_package,
+                request.segments,
+                base,
+                base_segments,
+                chunks.file if chunks else None,
+                rebuilt
+            )
+            if size != request.size or content_hash != request.sha256.lower():
+                raise HTTPException(status_code=400, detail="Rebuilt package does not match the declared size and hash")
+
+            content_hash, blob_data, deduplicated = await store_content(rebuilt, file_data.get('content_type'))
+    except DBPFError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Delta commit failed: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Delta commit failed: {str(e)}")
+
+    db = get_firestore_client()
+    batch = db.batch()
+    batch.update(db.collection('files').document(request.base_file_id), {
+        'name': request.name or file_data['name'],
+        'path': request.path or file_data.get('path') or file_data['name'],
+        'mtime': request.mtime,
+        'size': size,
+        'content_hash': content_hash,
+        'storage_path': blob_data['storage_path'],
+        'download_url': blob_data['download_url'],
+        'upload_date': datetime.now(),
+        'inspection': PENDING_INSPECTION
+    })
+    job_id = add_inspection_job(batch, request.base_file_id)
+    try:
+        await commit_with_usage(batch, user['uid'], storage_used_bytes=size - file_data.get('size', 0))
+    except Exception as e:
+        # The file still points at its base; drop the reference store_content took
+        await release_blob(content_hash)
+        logging.error(f"Delta commit failed: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Delta commit failed: {str(e)}")
+    job_queue.submit(job_id)
+    await release_blob(file_data['content_hash'])
+
+    return {
+        'message': 'Package updated from delta',
+        'file_id': request.base_file_id,
+        'download_url': blob_data['download_url'],
+        'bytes_received': chunks.size if chunks else 0,
+        'deduplicated': deduplicated
+    }
@@ -0,0 +1,106 @@
+"""Run blocking Firebase, Cloud Storage and Stripe SDK calls off the event loop.
+
+All blocking calls share one bounded thread pool. Each backend also has its
+own concurrency limit, so a burst of slow Storage uploads cannot take every
+thread away from Firestore reads. Sizes come from the environment:
+
+    BLOCKING_POOL_SIZE          total worker threads (default 64)
+    FIRESTORE_MAX_CONCURRENCY   default 32
+    STORAGE_MAX_CONCURRENCY     default 16
+    AUTH_MAX_CONCURRENCY        default 8
+    STRIPE_MAX_CONCURRENCY      default 8
+    LOCAL_IO_MAX_CONCURRENCY    local disk/CPU work such as hashing, default 8
+
+Every call is reported to ``routes.metrics`` with the time it took, so it is
+charged to the request that made it.
+"""
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import record_backend_call
+
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", 64))
+
+BACKEND_LIMITS = {
+    "firestore": int(os.getenv("FIRESTORE_MAX_CONCURRENCY", 32)),
+    "storage": int(os.getenv("STORAGE_MAX_CONCURRENCY", 16)),
+    "auth": int(os.getenv("AUTH_MAX_CONCURRENCY", 8)),
+    "stripe": int(os.getenv("STRIPE_MAX_CONCURRENCY", 8)),
+    "local": int(os.getenv("LOCAL_IO_MAX_CONCURRENCY", 8)),
+}
+
+_executor = None
+_semaphores = {}
+
+def get_executor():
+    """Get the shared thread pool, creating it on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=BLOCKING_POOL_SIZE,
+            thread_name_prefix="simsync-blocking",
+        )
+    return _executor
+
+def _get_semaphore(backend):
+    semaphore = _semaphores.get(backend)
+    if semaphore is None:
+        semaphore = _semaphores[backend] = asyncio.Semaphore(BACKEND_LIMITS[backend])
+    return semaphore
+
+async def _run(backend, operation, func, *args, **kwargs):
+    async with _get_semaphore(backend):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        result = None
+        try:
+            result = await loop.run_in_executor(
+                get_executor(), functools.partial(func, *args, **kwargs)
+            )
+            return result
+        finally:
+            record_backend_call(backend, operation, func, args, result, time.perf_counter() - started)
+
+async def run_blocking(backend, func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` on the shared pool under ``backend``'s limit"""
+    return await _run(backend, None, func, *args, **kwargs)
+
+async def firestore_call(func, *args, **kwargs):
+    """Run a blocking Firestore call"""
+    return await run_blocking("firestore", func, *args, **kwargs)
+
+async def firestore_stream(query):
+    """Run a Firestore query and return all of its snapshots as a list"""
+    return await _run("firestore", "query", lambda: list(query.stream()))
+
+async def firestore_get_all(client, refs, field_paths=None):
+    """Fetch many documents in one batched read; snapshots come back in any order"""
+    if not refs:
+        return []
+    return await _run("firestore", "batch_get", lambda: list(client.get_all(refs, field_paths=field_paths)))
+
+async def storage_call(func, *args, **kwargs):
+    """Run a blocking Cloud Storage call"""
+    return await run_blocking("storage", func, *args, **kwargs)
+
+async def auth_call(func, *args, **kwargs):
+    """Run a blocking Firebase Auth call"""
+    return await run_blocking("auth", func, *args, **kwargs)
+
+async def stripe_call(func, *args, **kwargs):
+    """Run a blocking Stripe API call"""
+    return await run_blocking("stripe", func, *args, **kwargs)
+
+async def local_call(func, *args, **kwargs):
+    """Run blocking local disk or CPU work, e.g. hashing a spooled upload"""
+    return await run_blocking("local", func, *args, **kwargs)
+
+def shutdown_executor():
+    """Stop the shared pool, waiting for in-flight calls to finish"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,272 @@
+"""Streaming ZIP export of a user's backed up files.
+
+``GET /api/files/export`` sends all of the user's files, or the selected
+ones, as one ZIP built on the fly (see ``routes.zipstream``). Object data is
+fetched from storage in ``EXPORT_CHUNK_SIZE`` ranges with up to
+``EXPORT_PREFETCH_CHUNKS`` fetches running ahead of the writer, so memory use
+stays the same whatever the size of the backup.
+
+Already-compressed formats are stored as-is. When nothing is deflated (or
+``compress=false`` is passed) the response has a Content-Length and accepts
+``Range`` requests, so an interrupted download can resume. The CRC-32 of
+each exported file is saved on its document, which lets a resumed download
+skip re-reading the files before the restart offset.
+"""
+from fastapi import APIRouter, HTTPException, Depends, Request, Query as QueryParam
+from fastapi.responses import StreamingResponse
+from google.cloud.firestore_v1.base_query import FieldFilter
+from typing import List, Optional
+from collections import deque
+from datetime import datetime, timezone
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+
+from .auth import verify_token
+from .executor import firestore_call, firestore_stream, local_call, storage_call
+from .files import batch_ids, get_owned_files
+from .firebase_config import get_firestore_client, get_storage_bucket
+from .zipstream import ZipEntry, read_plan, stream_zip, zip_size
+
+router = APIRouter()
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 4 * 1024 * 1024))
+EXPORT_PREFETCH_CHUNKS = int(os.getenv("EXPORT_PREFETCH_CHUNKS", 8))
+# Formats that are compressed already; deflating them again only costs CPU
+STORED_EXTENSIONS = {'package', 'ts4script', 'zip', 'rar', '7z', 'gz', 'png', 'jpg', 'jpeg', 'webp'}
+EXPORT_FIELDS = ['name', 'path', 'size', 'mtime', 'upload_date', 'storage_path', 'crc32', 'crc32_path']
+# Saved CRC-32s are written in batches of this many
+CRC_FLUSH_SIZE = 100
+
+def archive_path(file_data: dict, file_id: str):
+    """Relative path a file gets inside the archive"""
+    raw = (file_data.get('path') or file_data.get('name') or '').replace('\\', '/')
+    parts = [part for part in raw.split('/') if part not in ('', '.', '..')]
+    return '/'.join(parts) or file_id
+
+def unique_names(paths: List[str]):
+    """Make archive paths unique by numbering repeats: 'a.package', 'a (2).package'"""
+    seen = set()
+    names = []
+    for path in paths:
+        name = path
+        stem, ext = posixpath.splitext(path)
+        number = 2
+        while name.lower() in seen:
+            name = f"{stem} ({number}){ext}"
+            number += 1
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+def modified_time(file_data: dict):
+    if file_data.get('mtime') is not None:
+        return datetime.fromtimestamp(file_data['mtime'], timezone.utc)
+    upload_date = file_data.get('upload_date')
+    return upload_date if isinstance(upload_date, datetime) else datetime(1980, 1, 1)
+
+def export_entries(files: dict, compress: bool):
+    """Archive entries for ``files`` (id -> data) in a stable order.
+
+    Returns ``(file_ids, entries)`` with the ids in entry order.
+    """
+    ordered = sorted(files.items(), key=lambda item: (archive_path(item[1], item[0]).lower(), item[0]))
+    names = unique_names([archive_path(data, file_id) for file_id, data in ordered])
+    entries = []
+    for name, (file_id, data) in zip(names, ordered):
+        extension = posixpath.splitext(name)[1].lstrip('.').lower()
+        # A saved CRC only holds for the object it was computed from
+        crc32 = data.get('crc32') if data.get('crc32_path') == data.get('storage_path') else None
+        entries.append(ZipEntry(
+            name=name,
+            size=data.get('size', 0),
+            modified=modified_time(data),
+            compress=compress and extension not in STORED_EXTENSIONS,
+            crc32=crc32,
+        ))
+    return [file_id for file_id, _ in ordered], entries
+
+def export_etag(file_ids: List[str], files: dict, entries: List[ZipEntry]):
+    """Validator that changes whenever the archive's bytes would"""
+    fingerprint = [
+        [file_id, entry.name, entry.size, entry.compress, files[file_id].get('storage_path'), entry.modified.isoformat()]
+        for file_id, entry in zip(file_ids, entries)
+    ]
+    return '"' + hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()[:32] + '"'
+
+def parse_range(header: Optional[str], total: int):
+    """``(start, end)`` of a single ``bytes=`` range, or None to send everything"""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(total - int(last), 0), total - 1
+    else:
+        start = int(first)
+        end = min(int(last), total - 1) if last else total - 1
+    if start >= total or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={'Content-Range': f'bytes */{total}'})
+    return start, end
+
+async def prefetched_chunks(jobs, fetch, window: int):
+    """Yield ``fetch(*job)`` results in job order, keeping ``window`` fetches in flight"""
+    jobs = iter(jobs)
+    pending = deque()
+
+    def fill():
+        while len(pending) < window:
+            job = next(jobs, None)
+            if job is None:
+                return
+            pending.append(asyncio.ensure_future(fetch(*job)))
+
+    try:
+        fill()
+        while pending:
+            chunk = await pending.popleft()
+            fill()
+            yield chunk
+    finally:
+        for task in pending:
+            task.cancel()
+
+def chunk_jobs(plan, file_ids: List[str], files: dict, entries: List[ZipEntry]):
+    """Storage ranges, in stream order, covering what ``read_plan`` asks for"""
+    for index, offset in plan:
+        storage_path = files[file_ids[index]]['storage_path']
+        for start in range(offset, entries[index].size, EXPORT_CHUNK_SIZE):
+            yield storage_path, start, min(start + EXPORT_CHUNK_SIZE, entries[index].size)
+
+async def fetch_range(storage_path: str, start: int, end: int):
+    """Bytes ``[start, end)`` of a stored object"""
+    blob = get_storage_bucket().blob(storage_path)
+    return await storage_call(blob.download_as_bytes, start=start, end=end - 1, raw_download=True, checksum=None)
+
+# CRC-32 writes still running; kept here so they aren't garbage collected,
+# and awaited by drain_crc_writes at shutdown
+pending_crc_writes = set()
+
+async def save_crcs(crcs: List[tuple]):
+    """Record computed CRC-32s on their files documents"""
+    db = get_firestore_client()
+    batch = db.batch()
+    for file_id, storage_path, crc in crcs:
+        batch.update(db.collection('files').document(file_id), {'crc32': crc, 'crc32_path': storage_path})
+    try:
+        await firestore_call(batch.commit)
+    except Exception as e:
+        # Saved CRCs only spare a resumed download some reads; a file deleted
+        # mid-export (NotFound) or a Firestore error mustn't cut the ZIP short
+        logging.warning(f"Saving {len(crcs)} export CRC-32s failed: {type(e).__name__}: {e}")
+
+def flush_crcs(crcs: List[tuple]):
+    """Save CRC-32s in the background, so the stream never waits on Firestore"""
+    task = asyncio.create_task(save_crcs(crcs))
+    pending_crc_writes.add(task)
+    task.add_done_callback(pending_crc_writes.discard)
+
+async def drain_crc_writes():
+    """Wait for background CRC-32 writes; each logs its own failure"""
+    if pending_crc_writes:
+        await asyncio.gather(*pending_crc_writes, return_exceptions=True)
+
+async def export_stream(file_ids, files, entries, start: int, length: Optional[int]):
+    """Archive bytes from ``start``, ``length`` of them if given"""
+    computed = []
+
+    def on_crc(index, crc):
+        file_id = file_ids[index]
+        computed.append((file_id, files[file_id]['storage_path'], crc))
+
+    plan = read_plan(entries, start)
+    chunks = prefetched_chunks(chunk_jobs(plan, file_ids, files, entries), fetch_range, EXPORT_PREFETCH_CHUNKS)
+    archive = stream_zip(entries, chunks, start, offload=local_call, on_crc=on_crc)
+    remaining = length
+    try:
+        async for data in archive:
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            if data:
+                yield data
+            if len(computed) >= CRC_FLUSH_SIZE:
+                batch, computed[:] = computed[:], []
+                flush_crcs(batch)
+            if remaining == 0:
+                break
+        if computed:
+            flush_crcs(computed)
+    except Exception as e:
+        # Headers are gone already; all we can do is cut the download short
+        logging.error(f"Export stream failed: {type(e).__name__}: {e}")
+        raise
+    finally:
+        await archive.aclose()
+        await chunks.aclose()
+
+@router.get("/export")
+async def export_files(
+    request: Request,
+    file_id: Optional[List[str]] = QueryParam(None),
+    compress: bool = True,
+    user = Depends(verify_token)
+):
+    """Download the user's files (all, or those given as ``file_id``) as a ZIP.
+
+    Pass ``compress=false`` to store every entry, which makes the download
+    resumable with ``Range`` even when it has compressible files.
+    """
+    db = get_firestore_client()
+    try:
+        if file_id:
+            files, not_found, forbidden = await get_owned_files(db, batch_ids(file_id), user['uid'])
+            if not_found or forbidden:
+                raise HTTPException(status_code=404, detail=f"Files not found: {', '.join(not_found + forbidden)}")
+        else:
+            query = db.collection('files').where(filter=FieldFilter('user_id', '==', user['uid'])).select(EXPORT_FIELDS)
+            files = {doc.id: doc.to_dict() for doc in await firestore_stream(query)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Loading files for export failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to export files: {str(e)}")
+
+    file_ids, entries = export_entries(files, compress)
+    etag = export_etag(file_ids, files, entries)
+    total = zip_size(entries)
+    headers = {
+        'Content-Disposition': f'attachment; filename="simsync-backup-{datetime.now():%Y%m%d}.zip"',
+        'ETag': etag,
+        'Accept-Ranges': 'bytes' if total is not None else 'none',
+    }
+
+    byte_range = None
+    if total is not None:
+        if_range = request.headers.get('if-range')
+        if if_range is None or if_range == etag:
+            byte_range = parse_range(request.headers.get('range'), total)
+
+    if byte_range is None:
+        if total is not None:
+            headers['Content-Length'] = str(total)
+        return StreamingResponse(
+            export_stream(file_ids, files, entries, 0, None),
+            media_type='application/zip',
+            headers=headers
+        )
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(
+        export_stream(file_ids, files, entries, start, end - start + 1),
+        status_code=206,
+        media_type='application/zip',
+        headers=headers
+    )
@@ -1,17 +1,57 @@
+from google.cloud.firestore_v1 import Query
 from google.cloud.firestore_v1.base_query import FieldFilter
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Depends, Request, UploadFile, File, Form, Query as QueryParam
 from pydantic import BaseModel
-from typing import List, Optional
-import io
+from typing import List, Literal, Optional
+from firebase_admin import firestore
+from google.api_core import exceptions as gcs_exceptions
+import asyncio
 import logging
-from datetime import datetime
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
 
 from .firebase_config import get_firestore_client, get_storage_bucket
+from .executor import firestore_call, firestore_get_all, firestore_stream, storage_call
+from .content_store import (
+    adopt_content,
+    delete_blob_objects,
+    is_content_addressed,
+    release_blob,
+    remove_references,
+    store_content,
+)
 from .auth import verify_token
+from .user_profiles import (
+    commit_with_usage,
+    file_limit,
+    get_file_count,
+    get_usage,
+    get_user_profile,
+    invalidate_user_profile,
+    storage_limit_mb,
+    usage_increments,
+)
+from .quota import daily_limit, daily_quota, fixed_window, refund_quota
+from .inspection import PENDING_INSPECTION, add_inspection_job
+from .jobs import job_queue
 
 router = APIRouter()
 
+MANIFEST_MAX_ENTRIES = int(os.getenv("MANIFEST_MAX_ENTRIES", 5000))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", 500))
+# Only these fields are fetched for file listings
+LIST_FIELDS = ['name', 'size', 'upload_date', 'content_type', 'download_url', 'inspection']
+# Direct-to-storage uploads: largest accepted file, and how long a session may stay open
+DIRECT_UPLOAD_MAX_SIZE = int(os.getenv("DIRECT_UPLOAD_MAX_SIZE", 2 * 1024 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+# Batch endpoints: most ids per request, and storage deletes in flight at once
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", 1000))
+BATCH_DELETE_CONCURRENCY = int(os.getenv("BATCH_DELETE_CONCURRENCY", 16))
+# Firestore's limit on writes in one batch
+BATCH_WRITE_LIMIT = 500
+
 class FileMetadata(BaseModel):
     id: str
     name: str
@@ -19,142 +59,573 @@ class FileMetadata(BaseModel):
     upload_date: datetime
     content_type: str
     download_url: str = None
+    # Filled in by a background job after upload; see routes.inspection
+    inspection: Optional[dict] = None
 
 class FileListResponse(BaseModel):
     files: List[FileMetadata]
     total_count: int
+    next_cursor: Optional[str] = None
+
+class ManifestEntry(BaseModel):
+    path: str  # relative path inside the Mods/Tray folder
+    size: int
+    mtime: Optional[float] = None  # seconds since the epoch
+    hash: Optional[str] = None  # SHA-256 hex digest
+
+class ManifestRequest(BaseModel):
+    entries: List[ManifestEntry]
+
+class ManifestResponse(BaseModel):
+    needed: List[ManifestEntry]
+    unchanged_count: int
+
+class BatchDeleteRequest(BaseModel):
+    file_ids: List[str]
+
+class UploadSessionRequest(BaseModel):
+    name: str
+    size: int
+    content_type: Optional[str] = None
+    path: Optional[str] = None
+    mtime: Optional[float] = None
+    md5: Optional[str] = None  # base64 MD5, as Cloud Storage reports it
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    upload_url: str  # resumable session URL; PUT the file body here
+    storage_path: str
+    expires_at: datetime
+
+def is_unchanged(entry: ManifestEntry, stored: dict):
+    """Whether a stored file already holds the content described by ``entry``"""
+    if entry.hash and stored.get('content_hash'):
+        return entry.hash.lower() == stored['content_hash']
+    if entry.size != stored.get('size'):
+        return False
+    stored_mtime = stored.get('mtime')
+    if entry.mtime is not None and stored_mtime is not None:
+        return abs(entry.mtime - stored_mtime) < 1
+    return True
+
+async def check_storage_quota(user_id: str, size: int, count: int = 1):
+    """Reject adding ``count`` files totalling ``size`` bytes over the user's limits"""
+    usage = await get_usage(user_id)
+    limit_mb = storage_limit_mb(usage)
+    used = usage.get('storage_used_bytes', 0)
+    if used + size > limit_mb * 1024 * 1024:
+        available_mb = max(limit_mb * 1024 * 1024 - used, 0) / (1024 * 1024)
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload exceeds storage limit: {available_mb:.1f}MB of {limit_mb}MB available"
+        )
+    max_files = file_limit(usage)
+    if count and max_files is not None and usage.get('file_count', 0) + count > max_files:
+        raise HTTPException(
+            status_code=403,
+            detail=f"Upload exceeds file limit: your plan stores up to {max_files} files"
+        )
 
 @router.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
-    user = Depends(verify_token)
+    path: Optional[str] = Form(None),
+    mtime: Optional[float] = Form(None),
+    user = Depends(daily_quota('uploads'))
 ):
     """Upload a file to Firebase Storage"""
+    await check_storage_quota(user['uid'], file.size or 0)
     try:
-        print(f"Upload attempt for user: {user['uid']}, file: {file.filename}")
-        
-        # Read file content first
-        content = await file.read()
-        print(f"File content read: {len(content)} bytes")
-        
-        # Try to get storage bucket
-        try:
-            bucket = get_storage_bucket()
-            print(f"Storage bucket obtained: {bucket.name}")
-            
-            # Create unique filename with user ID
-            file_name = f"{user['uid']}/{file.filename}"
-            blob = bucket.blob(file_name)
-            
-            # Upload to Firebase Storage
-            blob.upload_from_string(
-                content,
-                content_type=file.content_type
-            )
-            
-            # Make file publicly accessible
-            blob.make_public()
-            download_url = blob.public_url
-            print(f"File uploaded to storage successfully: {download_url}")
-            
-        except Exception as storage_error:
-            print(f"Storage upload failed: {storage_error}")
-            # Fallback: create a mock download URL
-            download_url = f"https://firebasestorage.googleapis.com/v0/b/simsync-1a87e.firebasestorage.app/o/{user['uid']}%2F{file.filename}?alt=media"
-            print(f"Using fallback URL: {download_url}")
+        # The multipart body is already spooled to a temp file; hash it there
+        # and only send it to storage if this content isn't stored yet.
+        content_hash, blob_data, deduplicated = await store_content(file.file, file.content_type)
+        size = blob_data['size']
+        storage_path = blob_data['storage_path']
+        download_url = blob_data['download_url']
         
         # Store metadata in Firestore
         db = get_firestore_client()
         file_doc = {
             'name': file.filename,
-            'size': len(content),
+            'path': path or file.filename,
+            'mtime': mtime,
+            'size': size,
             'content_type': file.content_type,
+            'content_hash': content_hash,
             'upload_date': datetime.now(),
             'user_id': user['uid'],
-            'storage_path': f"{user['uid']}/{file.filename}",
-            'download_url': download_url
+            'storage_path': storage_path,
+            'download_url': download_url,
+            'inspection': PENDING_INSPECTION
         }
         
-        doc_ref = db.collection('files').add(file_doc)
-        file_id = doc_ref[1].id
-        print(f"File metadata saved to Firestore: {file_id}")
+        file_ref = db.collection('files').document()
+        batch = db.batch()
+        batch.set(file_ref, file_doc)
+        job_id = add_inspection_job(batch, file_ref.id)
+        try:
+            await commit_with_usage(batch, user['uid'], file_count=1, storage_used_bytes=size)
+        except Exception:
+            # Nothing points at the reference store_content took
+            await release_blob(content_hash)
+            raise
+        job_queue.submit(job_id)
+        file_id = file_ref.id
+        logging.info(f"Uploaded file {file_id} as {storage_path} (deduplicated: {deduplicated})")
         
         return {
             'message': 'File uploaded successfully',
             'file_id': file_id,
-            'download_url': download_url
+            'download_url': download_url,
+            'deduplicated': deduplicated
         }
         
     except Exception as e:
-        print(f"Upload failed: {type(e).__name__}: {str(e)}")
-        logging.error(f"File upload failed: {e}")
+        logging.error(f"File upload failed: {type(e).__name__}: {e}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-@router.get("/list", response_model=FileListResponse)
-async def list_user_files(user = Depends(verify_token)):
-    """Get list of user's uploaded files"""
+@router.post("/upload-session", response_model=UploadSessionResponse)
+async def create_upload_session(
+    request: UploadSessionRequest,
+    http_request: Request,
+    user = Depends(daily_quota('uploads'))
+):
+    """Start a resumable upload that sends the file straight to Cloud Storage.
+
+    The session only accepts exactly ``size`` bytes of ``content_type``. Once
+    the upload is done, call ``/upload-session/{upload_id}/finalize``; to give
+    up on it, ``DELETE /upload-session/{upload_id}``.
+    """
+    name = os.path.basename(request.name.replace('\\', '/'))
+    if not name:
+        raise HTTPException(status_code=400, detail="File name is required")
+    if request.size <= 0 or request.size > DIRECT_UPLOAD_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Direct uploads must be between 1 byte and {DIRECT_UPLOAD_MAX_SIZE} bytes")
+    await check_storage_quota(user['uid'], request.size)
+    # Cancelling the session gives back the upload it was charged, that same day
+    charged = daily_limit(await get_user_profile(user['uid']), 'uploads') is not None
+
+    try:
+        upload_id = uuid.uuid4().hex
+        # The upload id keeps re-uploads of the same name from replacing each other
+        storage_path = f"{user['uid']}/{upload_id}/{name}"
+        content_type = request.content_type or 'application/octet-stream'
+        blob = get_storage_bucket().blob(storage_path)
+        upload_url = await storage_call(
+            blob.create_resumable_upload_session,
+            content_type=content_type,
+            size=request.size,
+            origin=http_request.headers.get('origin'),
+            if_generation_match=0
+        )
+
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_SESSION_TTL)
+        db = get_firestore_client()
+        await firestore_call(db.collection('pending_uploads').document(upload_id).set, {
+            'user_id': user['uid'],
+            'storage_path': storage_path,
+            'name': name,
+            'path': request.path or name,
+            'mtime': request.mtime,
+            'size': request.size,
+            'content_type': content_type,
+            'md5': request.md5,
+            'quota_window': fixed_window(user['uid'], 'uploads').key if charged else None,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'expires_at': expires_at
+        })
+
+        return UploadSessionResponse(
+            upload_id=upload_id,
+            upload_url=upload_url,
+            storage_path=storage_path,
+            expires_at=expires_at
+        )
+
+    except Exception as e:
+        logging.error(f"Creating upload session failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to start upload: {str(e)}")
+
+@firestore.transactional
+def _claim_pending_upload(transaction, pending_ref, file_ref, file_doc, user_ref):
+    # Finalizing twice must not create two files documents
+    if not pending_ref.get(transaction=transaction).exists:
+        return None
+    transaction.delete(pending_ref)
+    transaction.set(file_ref, file_doc)
+    transaction.set(user_ref, usage_increments(1, file_doc['size']), merge=True)
+    return add_inspection_job(transaction, file_ref.id)
+
+async def get_pending_upload(db, upload_id: str, user_id: str):
+    """The user's pending upload document, or 404/403"""
+    pending_ref = db.collection('pending_uploads').document(upload_id)
+    pending_doc = await firestore_call(pending_ref.get)
+    if not pending_doc.exists:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    pending = pending_doc.to_dict()
+    if pending['user_id'] != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return pending_ref, pending
+
+@router.post("/upload-session/{upload_id}/finalize")
+async def finalize_upload_session(upload_id: str, user = Depends(verify_token)):
+    """Check a finished direct upload and record it as one of the user's files.
+
+    The object is taken into the content store like an ``/upload``, so it is
+    deduplicated and packages get a resource index for delta updates.
+    """
+    db = get_firestore_client()
+    pending_ref, pending = await get_pending_upload(db, upload_id, user['uid'])
+
+    try:
+        blob = await storage_call(get_storage_bucket().get_blob, pending['storage_path'])
+        if blob is None:
+            raise HTTPException(status_code=409, detail="Upload is not complete")
+
+        if blob.size != pending['size'] or (pending.get('md5') and blob.md5_hash != pending['md5']):
+            await storage_call(blob.delete)
+            await firestore_call(pending_ref.delete)
+            raise HTTPException(status_code=400, detail="Uploaded file does not match the declared size and checksum")
+
+        with tempfile.TemporaryFile() as local_copy:
+            await storage_call(blob.download_to_file, local_copy)
+            content_hash, blob_data, deduplicated = await adopt_content(blob, local_copy, pending['content_type'])
+        file_doc = {
+            'name': pending['name'],
+            'path': pending['path'],
+            'mtime': pending.get('mtime'),
+            'size': blob_data['size'],
+            'content_type': pending['content_type'],
+            'content_hash': content_hash,
+            'upload_date': datetime.now(),
+            'user_id': user['uid'],
+            'storage_path': blob_data['storage_path'],
+            'download_url': blob_data['download_url'],
+            'inspection': PENDING_INSPECTION
+        }
+        file_ref = db.collection('files').document()
+        user_ref = db.collection('users').document(user['uid'])
+        try:
+            job_id = await firestore_call(_claim_pending_upload, db.transaction(), pending_ref, file_ref, file_doc, user_ref)
+        except Exception:
+            await release_blob(content_hash)
+            raise
+        finally:
+            invalidate_user_profile(user['uid'])
+        if job_id is None:
+            # Finalized concurrently; that request keeps its own reference
+            await release_blob(content_hash)
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        job_queue.submit(job_id)
+
+        # The file now points at the content-addressed copy
+        try:
+            await storage_call(blob.delete)
+        except gcs_exceptions.NotFound:
+            pass
+
+        return {
+            'message': 'File uploaded successfully',
+            'file_id': file_ref.id,
+            'download_url': blob_data['download_url'],
+            'deduplicated': deduplicated
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Finalizing upload {upload_id} failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to finalize upload: {str(e)}")
+
+@firestore.transactional
+def _cancel_pending_upload(transaction, pending_ref):
+    # Whichever of a cancel and a finalize deletes the session first wins
+    if not pending_ref.get(transaction=transaction).exists:
+        return False
+    transaction.delete(pending_ref)
+    return True
+
+@router.delete("/upload-session/{upload_id}")
+async def cancel_upload_session(upload_id: str, user = Depends(verify_token)):
+    """Abandon a direct upload and give back the daily upload it was charged.
+
+    Clients falling back to ``/upload`` call this first, so the file only
+    counts against the quota once.
+    """
+    db = get_firestore_client()
+    pending_ref, pending = await get_pending_upload(db, upload_id, user['uid'])
+    try:
+        if not await firestore_call(_cancel_pending_upload, db.transaction(), pending_ref):
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        try:
+            await storage_call(get_storage_bucket().blob(pending['storage_path']).delete)
+        except gcs_exceptions.NotFound:
+            pass
+        refunded = pending.get('quota_window') is not None and pending['quota_window'] == fixed_window(user['uid'], 'uploads').key
+        if refunded:
+            await refund_quota(user['uid'], 'uploads')
+        return {'message': 'Upload cancelled', 'quota_refunded': refunded}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Cancelling upload {upload_id} failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to cancel upload: {str(e)}")
+
+@router.post("/manifest", response_model=ManifestResponse)
+async def check_manifest(request: ManifestRequest, user = Depends(verify_token)):
+    """Return the manifest entries that are not already backed up"""
+    if len(request.entries) > MANIFEST_MAX_ENTRIES:
+        raise HTTPException(status_code=413, detail=f"Manifest is limited to {MANIFEST_MAX_ENTRIES} entries")
     try:
-        print(f"Listing files for user: {user['uid']}")
         db = get_firestore_client()
         
-        # Query user's files from Firestore
+        # One query over the user's files, fetching only the compared fields
+        query = (db.collection('files')
+                 .where(filter=FieldFilter('user_id', '==', user['uid']))
+                 .select(['name', 'path', 'size', 'mtime', 'content_hash']))
+        
+        stored_by_path = {}
+        for doc in await firestore_stream(query):
+            file_data = doc.to_dict()
+            stored_by_path.setdefault(file_data.get('path') or file_data.get('name'), []).append(file_data)
+        
+        needed = [
+            entry for entry in request.entries
+            if not any(is_unchanged(entry, stored) for stored in stored_by_path.get(entry.path, []))
+        ]
+        return ManifestResponse(
+            needed=needed,
+            unchanged_count=len(request.entries) - len(needed)
+        )
+        
+    except Exception as e:
+        logging.error(f"Manifest check failed: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Manifest check failed: {str(e)}")
+
+@router.get("/list", response_model=FileListResponse)
+async def list_user_files(
+    page_size: int = QueryParam(100, ge=1),
+    cursor: Optional[str] = None,
+    order_by: Literal['upload_date', 'size'] = 'upload_date',
+    direction: Literal['desc', 'asc'] = 'desc',
+    user = Depends(verify_token)
+):
+    """Get one page of the user's uploaded files.
+
+    Pass the returned ``next_cursor`` back as ``cursor`` to get the next page.
+    """
+    try:
+        page_size = min(page_size, LIST_MAX_PAGE_SIZE)
+        db = get_firestore_client()
         files_ref = db.collection('files')
-        query = files_ref.where(filter=FieldFilter('user_id', '==', user['uid']))
+        
+        # Indexed query on (user_id, order_by), fetching only listed fields
+        query = (files_ref
+                 .where(filter=FieldFilter('user_id', '==', user['uid']))
+                 .order_by(order_by, direction=Query.DESCENDING if direction == 'desc' else Query.ASCENDING)
+                 .select(LIST_FIELDS))
+        if cursor:
+            cursor_doc = await firestore_call(files_ref.document(cursor).get)
+            if not cursor_doc.exists or cursor_doc.get('user_id') != user['uid']:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.start_after(cursor_doc)
+        
+        # One extra document tells us whether another page exists
+        docs = await firestore_stream(query.limit(page_size + 1))
+        page = docs[:page_size]
         
         files = []
-        doc_count = 0
-        for doc in query.stream():
-            doc_count += 1
+        for doc in page:
             file_data = doc.to_dict()
-            print(f"Found file: {file_data.get('name')}")
             files.append(FileMetadata(
                 id=doc.id,
                 name=file_data['name'],
                 size=file_data['size'],
                 upload_date=file_data['upload_date'],
                 content_type=file_data['content_type'],
-                download_url=file_data.get('download_url')
+                download_url=file_data.get('download_url'),
+                inspection=file_data.get('inspection')
             ))
         
-        print(f"Total files found: {doc_count}")
         return FileListResponse(
             files=files,
-            total_count=len(files)
+            total_count=await get_file_count(user['uid']),
+            next_cursor=page[-1].id if len(docs) > page_size else None
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error listing files: {type(e).__name__}: {str(e)}")
         logging.error(f"Failed to list files: {type(e).__name__}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve files: {str(e)}")
 
+@firestore.transactional
+def _delete_files(transaction, db, file_ids: List[str], user_id: str):
+    """Delete the user's files, their blob references and their usage together.
+
+    The files are read in the transaction, so a file deleted concurrently is
+    reported as not found instead of releasing its blob reference twice.
+    Returns ``(deleted, not_found, forbidden, released)``: ``deleted`` maps id
+    to data and ``released`` holds blobs that lost their last reference.
+    """
+    refs = [db.collection('files').document(file_id) for file_id in file_ids]
+    snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs, transaction=transaction)}
+    deleted, not_found, forbidden = {}, [], []
+    for file_id in file_ids:
+        snapshot = snapshots.get(file_id)
+        if snapshot is None or not snapshot.exists:
+            not_found.append(file_id)
+        elif snapshot.get('user_id') != user_id:
+            forbidden.append(file_id)
+        else:
+            deleted[file_id] = snapshot.to_dict()
+
+    references = {}
+    for file_data in deleted.values():
+        if is_content_addressed(file_data):
+            references[file_data['content_hash']] = references.get(file_data['content_hash'], 0) + 1
+    released = remove_references(transaction, db, references)
+
+    for file_id in deleted:
+        transaction.delete(db.collection('files').document(file_id))
+    if deleted:
+        transaction.set(
+            db.collection('users').document(user_id),
+            usage_increments(-len(deleted), -sum(file_data.get('size', 0) for file_data in deleted.values())),
+            merge=True
+        )
+    return deleted, not_found, forbidden, released
+
+async def delete_files(db, file_ids: List[str], user_id: str):
+    """Run ``_delete_files`` and keep the user's cached profile in step"""
+    try:
+        return await firestore_call(_delete_files, db.transaction(), db, file_ids, user_id)
+    finally:
+        invalidate_user_profile(user_id)
+
 @router.delete("/delete/{file_id}")
 async def delete_file(file_id: str, user = Depends(verify_token)):
-    """Delete a user's file"""
+    """Delete a user's file.
+
+    The document goes before the stored object, so a file never points at
+    deleted storage.
+    """
     try:
         db = get_firestore_client()
-        bucket = get_storage_bucket()
-        
-        # Get file metadata
-        file_doc = db.collection('files').document(file_id).get()
-        
-        if not file_doc.exists:
+        deleted, not_found, forbidden, released = await delete_files(db, [file_id], user['uid'])
+        if not_found:
             raise HTTPException(status_code=404, detail="File not found")
-        
-        file_data = file_doc.to_dict()
-        
-        # Verify file ownership
-        if file_data['user_id'] != user['uid']:
+        if forbidden:
             raise HTTPException(status_code=403, detail="Access denied")
-        
-        # Delete from Storage
-        blob = bucket.blob(file_data['storage_path'])
-        blob.delete()
-        
-        # Delete from Firestore
-        db.collection('files').document(file_id).delete()
+
+        # Shared blobs go only with their last reference
+        file_data = deleted[file_id]
+        if is_content_addressed(file_data):
+            if file_data['content_hash'] in released:
+                await delete_blob_objects(file_data['content_hash'], released[file_data['content_hash']])
+        elif file_data.get('storage_path'):
+            try:
+                await storage_call(get_storage_bucket().blob(file_data['storage_path']).delete)
+            except gcs_exceptions.NotFound:
+                pass
         
         return {'message': 'File deleted successfully'}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"File deletion failed: {e}")
-        raise HTTPException(status_code=500, detail="Failed to delete file")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to delete file")
+
+def batch_ids(ids: List[str]):
+    """Distinct, valid document ids from a batch request, in request order"""
+    if len(ids) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"Batches are limited to {BATCH_MAX_IDS} ids")
+    return [file_id for file_id in dict.fromkeys(ids) if file_id and '/' not in file_id]
+
+async def get_owned_files(db, file_ids: List[str], user_id: str):
+    """Load files with one batched read and split them by ownership.
+
+    Returns ``(owned, not_found, forbidden)`` where ``owned`` maps id to data.
+    """
+    refs = [db.collection('files').document(file_id) for file_id in file_ids]
+    snapshots = {snapshot.id: snapshot for snapshot in await firestore_get_all(db, refs)}
+    owned, not_found, forbidden = {}, [], []
+    for file_id in file_ids:
+        snapshot = snapshots.get(file_id)
+        if snapshot is None or not snapshot.exists:
+            not_found.append(file_id)
+        elif snapshot.get('user_id') != user_id:
+            forbidden.append(file_id)
+        else:
+            owned[file_id] = snapshot.to_dict()
+    return owned, not_found, forbidden
+
+@router.post("/batch-delete")
+async def batch_delete_files(request: BatchDeleteRequest, user = Depends(verify_token)):
+    """Delete many of the user's files at once.
+
+    Firestore documents and blob references go first, in transactions, so a
+    file never points at deleted storage. Stored objects are then removed
+    concurrently.
+    """
+    file_ids = batch_ids(request.file_ids)
+    try:
+        db = get_firestore_client()
+        bucket = get_storage_bucket()
+
+        # Each file may also take a blob update, and one write is the usage update
+        chunk_size = (BATCH_WRITE_LIMIT - 1) // 2
+        deleted, not_found, forbidden, released = {}, [], [], {}
+        for start in range(0, len(file_ids), chunk_size):
+            chunk = await delete_files(db, file_ids[start:start + chunk_size], user['uid'])
+            deleted.update(chunk[0])
+            not_found += chunk[1]
+            forbidden += chunk[2]
+            released.update(chunk[3])
+
+        loose_paths = [
+            file_data['storage_path'] for file_data in deleted.values()
+            if not is_content_addressed(file_data) and file_data.get('storage_path')
+        ]
+
+        semaphore = asyncio.Semaphore(BATCH_DELETE_CONCURRENCY)
+        failed = 0
+
+        async def delete_blob(content_hash, blob_data):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    await delete_blob_objects(content_hash, blob_data)
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"Deleting blob {content_hash} failed: {e}")
+
+        async def delete_object(storage_path):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    await storage_call(bucket.blob(storage_path).delete)
+                except gcs_exceptions.NotFound:
+                    pass
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"Deleting {storage_path} failed: {e}")
+
+        await asyncio.gather(
+            *[delete_blob(content_hash, blob_data) for content_hash, blob_data in released.items()],
+            *[delete_object(storage_path) for storage_path in loose_paths]
+        )
+
+        return {
+            'message': f"Deleted {len(deleted)} files",
+            'deleted': list(deleted),
+            'not_found': not_found,
+            'forbidden': forbidden,
+            'storage_failures': failed
+        }
+
+    except Exception as e:
+        logging.error(f"Batch deletion failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to delete files: {str(e)}")
@@ -1,54 +1,143 @@
+"""Firebase setup and the clients the routes use for metadata and storage.
+
+``SIMSYNC_BACKEND`` picks where both live:
+
+- ``firebase`` (default): Cloud Firestore and Cloud Storage through the
+  Firebase Admin SDK.
+- ``local``: an in-memory Firestore stand-in (``routes.memory_firestore``)
+  and a bucket on local disk (``routes.local_storage``), for running the API
+  offline, self-hosting and load tests that leave Google's latency out.
+  Metadata is kept in process, so run a single worker.
+
+Either way the routes get objects with the Firestore client and Storage
+bucket interfaces, so they don't know which backend is in use.
+
+Nothing is set up at import. The first ``get_*`` call initializes the
+backend and each client is created once, on first use, and then reused, so
+a worker starts serving without waiting for credentials or connections.
+``main``'s lifespan warms the clients up in the background.
+"""
 import firebase_admin
 from firebase_admin import credentials, firestore, storage, auth
+import google.auth.credentials
+import logging
 import os
+import threading
 from dotenv import load_dotenv
 
+from .memory_firestore import MemoryFirestore
+
 # Load environment variables
 load_dotenv()
 
-def initialize_firebase():
-    """Initialize Firebase Admin SDK"""
-    if not firebase_admin._apps:
-        # For development, we'll use environment variables
-        # In production, you would use a service account key file
-        project_id = os.getenv("FIREBASE_PROJECT_ID")
-        private_key = os.getenv("FIREBASE_PRIVATE_KEY", "").replace('\\n', '\n')
-        client_email = os.getenv("FIREBASE_CLIENT_EMAIL")
+SIMSYNC_BACKEND = os.getenv("SIMSYNC_BACKEND", "firebase")
+
+class FirebaseBackend:
+    """Cloud Firestore and Cloud Storage through the Firebase Admin SDK"""
+
+    def __init__(self):
+        self._firestore = None
+        self._bucket = None
+
+    def initialize(self):
+        if not firebase_admin._apps:
+            # For development, we'll use environment variables
+            # In production, you would use a service account key file
+            project_id = os.getenv("FIREBASE_PROJECT_ID")
+            private_key = os.getenv("FIREBASE_PRIVATE_KEY", "").replace('\\n', '\n')
+            client_email = os.getenv("FIREBASE_CLIENT_EMAIL")
         
-        print(f"Initializing Firebase with project_id: {project_id}")
-        print(f"Client email: {client_email}")
-        print(f"Private key length: {len(private_key)} chars")
+            logging.info(f"Initializing Firebase for project {project_id}")
         
-        cred_dict = {
-            "type": "service_account",
-            "project_id": project_id,
-            "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
-            "private_key": private_key,
-            "client_email": client_email,
-            "client_id": os.getenv("FIREBASE_CLIENT_ID"),
-            "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
-            "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
-        }
+            cred_dict = {
+                "type": "service_account",
+                "project_id": project_id,
+                "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
+                "private_key": private_key,
+                "client_email": client_email,
+                "client_id": os.getenv("FIREBASE_CLIENT_ID"),
+                "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
+                "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
+            }
         
-        try:
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {
-                'storageBucket': f'{project_id}.firebasestorage.app'
-            })
-            print("Firebase Admin SDK initialized successfully!")
-            print(f"Storage bucket configured: {project_id}.firebasestorage.app")
-        except Exception as e:
-            print(f"Firebase initialization failed: {e}")
-            raise e
+            try:
+                cred = credentials.Certificate(cred_dict)
+                firebase_admin.initialize_app(cred, {
+                    'storageBucket': f'{project_id}.firebasestorage.app'
+                })
+                logging.info(f"Firebase Admin SDK initialized with storage bucket {project_id}.firebasestorage.app")
+            except Exception as e:
+                logging.error(f"Firebase initialization failed: {e}")
+                raise e
+
+    def firestore_client(self):
+        if self._firestore is None:
+            self._firestore = firestore.client()
+        return self._firestore
+
+    def storage_bucket(self):
+        if self._bucket is None:
+            self._bucket = storage.bucket()
+        return self._bucket
+
+class NoCredential(credentials.Base):
+    """Credential for an app that only verifies ID tokens"""
+
+    def get_credential(self):
+        return google.auth.credentials.AnonymousCredentials()
+
+class LocalBackend:
+    """In-memory metadata and objects on local disk"""
+
+    def __init__(self):
+        self._client = MemoryFirestore()
+
+    def initialize(self):
+        bucket = self.storage_bucket()
+        logging.info(f"Using the local backend: in-memory metadata, objects in {bucket.root}")
+        if not firebase_admin._apps:
+            # Sign-in still uses Firebase ID tokens, and checking them needs no service account
+            firebase_admin.initialize_app(NoCredential(), {'projectId': os.getenv("FIREBASE_PROJECT_ID")})
+
+    def firestore_client(self):
+        return self._client
+
+    def storage_bucket(self):
+        # Imported here: local_storage's routes import modules that import this one
+        from .local_storage import local_bucket
+        return local_bucket()
+
+BACKENDS = {
+    'firebase': FirebaseBackend,
+    'local': LocalBackend,
+}
+
+backend = BACKENDS[SIMSYNC_BACKEND]()
+_initialized = False
+# Clients are first asked for from pool threads, possibly several at once
+_initialize_lock = threading.Lock()
+
+def initialize_firebase():
+    """Initialize Firebase Admin SDK, or the local backend; only the first call does anything"""
+    global _initialized
+    if _initialized:
+        return
+    with _initialize_lock:
+        if not _initialized:
+            backend.initialize()
+            _initialized = True
 
 def get_firestore_client():
     """Get Firestore client"""
-    return firestore.client()
+    initialize_firebase()
+    return backend.firestore_client()
 
 def get_storage_bucket():
     """Get Storage bucket"""
-    return storage.bucket()
+    initialize_firebase()
+    return backend.storage_bucket()
 
 def get_auth_client():
     """Get Auth client"""
+    initialize_firebase()
     return auth
\ No newline at end of file
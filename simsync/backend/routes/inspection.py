@@ -0,0 +1,195 @@
+"""Content inspection of uploaded files, run as background jobs.
+
+Uploads record the file with ``inspection: {'status': 'pending'}`` and an
+``inspect_file`` job (see ``routes.jobs``) in the same write, so the upload
+response doesn't wait for it. The job reads only what it needs from storage,
+in ranged reads: the header and index of a DBPF package, or the central
+directory of a ZIP or .ts4script. It then fills in ``inspection`` on the
+files document:
+
+- ``format``: what the content is (``dbpf``, ``zip``, ``7z``, ``rar`` or
+  ``unknown``), and ``matches_extension`` for the extensions we know
+- DBPF packages: ``resource_count``, plus ``resource_types`` as a count per
+  resource type id
+- ZIP archives and .ts4script: ``member_count``, ``uncompressed_size``, the
+  first ``INSPECTION_MAX_MEMBERS`` member names, and ``truncated``
+- ``script_mod``: set for .ts4script files and for archives holding
+  .ts4script or Python files
+
+7z and RAR archives are identified but not listed, since that would take
+libraries outside the standard library.
+"""
+import logging
+import os
+import posixpath
+import zipfile
+from collections import Counter
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gcs_exceptions
+
+from . import dbpf
+from .executor import firestore_call, storage_call
+from .firebase_config import get_firestore_client, get_storage_bucket
+from .jobs import job_queue
+
+INSPECTION_MAX_MEMBERS = int(os.getenv("INSPECTION_MAX_MEMBERS", 100))
+# Ranged reads fetch at least this much, so parsing an index takes few requests
+INSPECTION_READ_SIZE = int(os.getenv("INSPECTION_READ_SIZE", 256 * 1024))
+
+MAGIC_NUMBERS = [
+    (b'DBPF', 'dbpf'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),  # empty archive
+    (b"7z\xbc\xaf\x27\x1c", '7z'),
+    (b'Rar!\x1a\x07', 'rar'),
+]
+EXPECTED_FORMATS = {
+    'package': 'dbpf',
+    'ts4script': 'zip',
+    'zip': 'zip',
+    '7z': '7z',
+    'rar': 'rar',
+}
+SCRIPT_EXTENSIONS = {'.py', '.pyc', '.ts4script'}
+
+PENDING_INSPECTION = {'status': 'pending'}
+
+class BlobReader:
+    """Read-only, seekable file over a stored object, fetched in ranges"""
+
+    def __init__(self, blob, size: int, read_size: int = INSPECTION_READ_SIZE):
+        self._blob = blob
+        self._size = size
+        self._read_size = read_size
+        self._position = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self.requests = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            # OSError like a real file; zipfile relies on it for short files
+            raise OSError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def read(self, size: int = -1):
+        end = self._size if size is None or size < 0 else min(self._position + size, self._size)
+        if end <= self._position:
+            return b''
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not (self._buffer_start <= self._position and end <= buffer_end):
+            fetch_end = min(max(end, self._position + self._read_size), self._size)
+            self._buffer = self._blob.download_as_bytes(start=self._position, end=fetch_end - 1, raw_download=True, checksum=None)
+            self._buffer_start = self._position
+            self.requests += 1
+        data = self._buffer[self._position - self._buffer_start:end - self._buffer_start]
+        self._position += len(data)
+        return data
+
+def detect_format(head: bytes):
+    for magic, name in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    return 'unknown'
+
+def inspect_package(reader: BlobReader):
+    resources = dbpf.read_index(reader)
+    types = Counter(f"{resource.type:08X}" for resource in resources)
+    return {'resource_count': len(resources), 'resource_types': dict(types)}
+
+def inspect_zip(reader: BlobReader):
+    with zipfile.ZipFile(reader) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+    extensions = {posixpath.splitext(info.filename)[1].lower() for info in members}
+    return {
+        'member_count': len(members),
+        'uncompressed_size': sum(info.file_size for info in members),
+        'members': [info.filename for info in members[:INSPECTION_MAX_MEMBERS]],
+        'truncated': len(members) > INSPECTION_MAX_MEMBERS,
+        'script_mod': bool(extensions & SCRIPT_EXTENSIONS),
+    }
+
+def inspect_object(blob, name: str, size: int):
+    """Summarize a stored object's content (blocking; does ranged reads)"""
+    reader = BlobReader(blob, size)
+    extension = posixpath.splitext(name)[1].lstrip('.').lower()
+    content_format = detect_format(reader.read(8))
+    reader.seek(0)
+    summary = {
+        'format': content_format,
+        'matches_extension': EXPECTED_FORMATS[extension] == content_format if extension in EXPECTED_FORMATS else None,
+        'script_mod': extension == 'ts4script',
+    }
+    try:
+        if content_format == 'dbpf':
+            summary.update(inspect_package(reader))
+        elif content_format == 'zip':
+            details = inspect_zip(reader)
+            details['script_mod'] = summary['script_mod'] or details['script_mod']
+            summary.update(details)
+    except (dbpf.DBPFError, zipfile.BadZipFile) as e:
+        # Damaged content is a finding, not a reason to retry
+        summary['error'] = str(e)
+    summary['range_requests'] = reader.requests
+    return summary
+
+@firestore.transactional
+def _store_inspection(transaction, file_ref, storage_path: str, inspection: dict):
+    # The file may have been replaced by a newer upload while this one was inspected
+    snapshot = file_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get('storage_path') != storage_path:
+        return False
+    transaction.update(file_ref, {'inspection': inspection})
+    return True
+
+async def save_inspection(file_id: str, storage_path: str, inspection: dict):
+    db = get_firestore_client()
+    file_ref = db.collection('files').document(file_id)
+    inspection = {**inspection, 'inspected_at': datetime.now(timezone.utc)}
+    return await firestore_call(_store_inspection, db.transaction(), file_ref, storage_path, inspection)
+
+async def inspection_failed(payload: dict, error: str):
+    file_ref = get_firestore_client().collection('files').document(payload['file_id'])
+    snapshot = await firestore_call(file_ref.get)
+    if snapshot.exists:
+        await save_inspection(payload['file_id'], snapshot.get('storage_path'), {'status': 'failed', 'error': error})
+
+@job_queue.handler('inspect_file', on_failure=inspection_failed)
+async def inspect_file(payload: dict):
+    """Job: inspect the current content of ``files/{file_id}``"""
+    file_ref = get_firestore_client().collection('files').document(payload['file_id'])
+    snapshot = await firestore_call(file_ref.get)
+    if not snapshot.exists:
+        return
+    file_data = snapshot.to_dict()
+    storage_path = file_data['storage_path']
+    blob = get_storage_bucket().blob(storage_path)
+    try:
+        summary = await storage_call(inspect_object, blob, file_data.get('name', ''), file_data.get('size', 0))
+    except gcs_exceptions.NotFound:
+        await save_inspection(payload['file_id'], storage_path, {'status': 'failed', 'error': "File is missing from storage"})
+        return
+    await save_inspection(payload['file_id'], storage_path, {'status': 'done', **summary})
+    logging.info(f"Inspected {payload['file_id']}: {summary['format']} in {summary['range_requests']} range requests")
+
+def add_inspection_job(writer, file_id: str):
+    """Record an inspection job for ``file_id`` in a batch or transaction.
+
+    Returns the job id; pass it to ``job_queue.submit`` once committed.
+    """
+    job_ref, job = job_queue.new_job('inspect_file', {'file_id': file_id})
+    writer.set(job_ref, job)
+    return job_ref.id
@@ -0,0 +1,227 @@
+"""Durable background jobs run by an in-process worker pool.
+
+A job is a ``jobs/{id}`` document holding:
+
+- ``kind`` and ``payload``
+- ``status``: ``queued``, ``running``, ``done`` or ``failed``
+- the number of attempts so far
+- ``run_after``: when it may next run
+
+Writing the document is what schedules the job, so it can go in the same
+batch or transaction as the write that calls for it. Afterwards
+``submit(job_id)`` puts the id on this worker's queue so it usually starts
+straight away.
+
+The queue is bounded (``JOB_QUEUE_SIZE``). When it is full, new jobs are
+only recorded. A periodic sweep then picks up due jobs from Firestore as
+room frees up, oldest first (straight away once the queue has drained to
+half), so a burst of uploads waits in Firestore rather than in memory. The
+sweep also recovers jobs whose worker died mid-run, once their lease has
+expired.
+
+Workers claim a job in a transaction before running it, so each job runs on
+one worker at a time even across API processes. A handler that raises is
+retried with exponential backoff until ``max_attempts`` is reached. The job
+is then left ``failed`` with its last error, and the handler's
+``on_failure`` callback runs. Finished jobs get ``expires_at`` for a
+Firestore TTL policy; failed ones are kept.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from .executor import firestore_call, firestore_stream
+from .firebase_config import get_firestore_client
+
+JOBS_COLLECTION = 'jobs'
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+# A running job is presumed lost, and run again, once its lease runs out
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 300))
+JOB_SWEEP_SECONDS = int(os.getenv("JOB_SWEEP_SECONDS", 30))
+JOB_RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", 10))
+JOB_RETRY_MAX_SECONDS = int(os.getenv("JOB_RETRY_MAX_SECONDS", 3600))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+
+def retry_delay(attempts: int):
+    """Seconds to wait before the next attempt after ``attempts`` failures"""
+    return min(JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+
+@firestore.transactional
+def _claim(transaction, job_ref, lease_seconds: int):
+    """Mark a due job as running here; returns the job, or None if it isn't ours to run"""
+    snapshot = job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    job = snapshot.to_dict()
+    now = datetime.now(timezone.utc)
+    due = job['status'] == 'queued' and job['run_after'] <= now
+    lost = job['status'] == 'running' and job['lease_expires_at'] <= now
+    if not (due or lost):
+        return None
+    job['attempts'] += 1
+    transaction.update(job_ref, {
+        'status': 'running',
+        'attempts': job['attempts'],
+        'lease_expires_at': now + timedelta(seconds=lease_seconds),
+        'updated_at': now,
+    })
+    return job
+
+class JobQueue:
+    """Bounded in-memory queue of job ids in front of the ``jobs`` collection"""
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._handlers = {}
+        self._queue = None
+        # Ids on the queue or being run by this worker
+        self._pending = set()
+        # Set when a job didn't fit; the sweep runs early once the queue drains
+        self._backlog = False
+        self._wake = None
+
+    def handler(self, kind: str, max_attempts: int = JOB_MAX_ATTEMPTS, on_failure=None):
+        """Register ``async def handle(payload)`` for jobs of ``kind``.
+
+        ``on_failure(payload, error)`` is awaited once the job has failed
+        for the last time.
+        """
+        def register(func):
+            self._handlers[kind] = (func, max_attempts, on_failure)
+            return func
+        return register
+
+    def new_job(self, kind: str, payload: dict, job_id: str = None):
+        """``(ref, document)`` for a new job; ``set`` it, then ``submit(ref.id)``.
+
+        A fixed ``job_id`` written with ``create`` makes a job that is
+        recorded only once.
+        """
+        now = datetime.now(timezone.utc)
+        job_ref = get_firestore_client().collection(JOBS_COLLECTION).document(job_id)
+        return job_ref, {
+            'kind': kind,
+            'payload': payload,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': self._handlers[kind][1],
+            'created_at': now,
+            'updated_at': now,
+            'run_after': now,
+        }
+
+    def submit(self, job_id: str):
+        """Run the job soon if the queue has room; if not, a later sweep picks it up"""
+        if self._queue is None or job_id in self._pending:
+            return False
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            self._backlog = True
+            return False
+        self._pending.add(job_id)
+        return True
+
+    async def enqueue(self, kind: str, payload: dict):
+        """Record a job and submit it; returns the job id"""
+        job_ref, job = self.new_job(kind, payload)
+        await firestore_call(job_ref.set, job)
+        self.submit(job_ref.id)
+        return job_ref.id
+
+    async def run_job(self, job_id: str):
+        """Claim and run one job, recording the outcome"""
+        db = get_firestore_client()
+        job_ref = db.collection(JOBS_COLLECTION).document(job_id)
+        job = await firestore_call(_claim, db.transaction(), job_ref, JOB_LEASE_SECONDS)
+        if job is None:
+            return
+        handle, _, on_failure = self._handlers[job['kind']]
+        try:
+            await handle(job['payload'])
+        except Exception as e:
+            now = datetime.now(timezone.utc)
+            error = f"{type(e).__name__}: {e}"
+            failed = job['attempts'] >= job['max_attempts']
+            await firestore_call(job_ref.update, {
+                'status': 'failed' if failed else 'queued',
+                'last_error': error,
+                'run_after': now + timedelta(seconds=retry_delay(job['attempts'])),
+                'lease_expires_at': firestore.DELETE_FIELD,
+                'updated_at': now,
+            })
+            logging.warning(f"Job {job_id} ({job['kind']}) attempt {job['attempts']} failed: {error}")
+            if failed and on_failure:
+                await on_failure(job['payload'], error)
+            return
+
+        now = datetime.now(timezone.utc)
+        await firestore_call(job_ref.update, {
+            'status': 'done',
+            'lease_expires_at': firestore.DELETE_FIELD,
+            'updated_at': now,
+            'expires_at': now + timedelta(seconds=JOB_RETENTION_SECONDS),
+        })
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self.run_job(job_id)
+            except Exception as e:
+                # Left as it was; the sweep retries it once its lease runs out
+                logging.error(f"Running job {job_id} failed: {e}")
+            finally:
+                self._pending.discard(job_id)
+                self._queue.task_done()
+            if self._backlog and self._queue.qsize() <= self.queue_size // 2:
+                self._wake.set()
+
+    async def sweep(self):
+        """Submit due and abandoned jobs from Firestore, as many as there is room for"""
+        room = self.queue_size - self._queue.qsize()
+        if room <= 0:
+            return 0
+        self._backlog = False
+        now = datetime.now(timezone.utc)
+        jobs_ref = get_firestore_client().collection(JOBS_COLLECTION)
+        due = await firestore_stream(
+            jobs_ref.where(filter=FieldFilter('status', '==', 'queued'))
+            .where(filter=FieldFilter('run_after', '<=', now))
+            .order_by('run_after').select(['kind']).limit(room)
+        )
+        lost = await firestore_stream(
+            jobs_ref.where(filter=FieldFilter('status', '==', 'running'))
+            .where(filter=FieldFilter('lease_expires_at', '<=', now))
+            .order_by('lease_expires_at').select(['kind']).limit(room)
+        )
+        return sum(self.submit(doc.id) for doc in due + lost)
+
+    async def run_forever(self):
+        """Run the workers and sweep periodically; meant to run as a background task"""
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._wake = asyncio.Event()
+        workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        try:
+            while True:
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logging.error(f"Job sweep failed: {e}")
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_SWEEP_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+job_queue = JobQueue()
@@ -0,0 +1,419 @@
+"""Cloud Storage stand-in that keeps objects on local disk.
+
+``LocalBucket`` and ``LocalBlob`` implement the part of
+``google.cloud.storage.Bucket`` and ``Blob`` the routes use. Objects live
+under ``LOCAL_STORAGE_ROOT``. Each object's data is in
+``objects/{xx}/{sha256 of name}`` with its metadata (name, size, MD5,
+generation, content type, public flag) in a JSON file beside it, so object
+names never turn into filesystem paths. Writes go to a temporary file that
+is renamed into place, and generation preconditions are honoured. Ranged
+reads come from a memory map of the file.
+
+``router`` serves what Cloud Storage serves over HTTP:
+
+- public and signed object URLs, with ``Range`` support. Whole objects go
+  out as file responses, handed to the server with ``http.response.pathsend``
+  when it supports that.
+- resumable upload sessions, single request or chunked with
+  ``Content-Range``.
+
+``main`` mounts it at ``ROUTE_PREFIX`` when ``SIMSYNC_BACKEND=local``.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from google.api_core import exceptions
+
+from .executor import storage_call
+from .export import parse_range
+
+router = APIRouter()
+
+ROUTE_PREFIX = "/storage"
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "local_storage")
+# Base URL the API is reachable at; object and upload URLs start with it
+LOCAL_STORAGE_URL = os.getenv("LOCAL_STORAGE_URL", "http://localhost:8000").rstrip('/')
+# Key for signed URLs; without one they stop working when the process restarts
+LOCAL_STORAGE_SECRET = os.getenv("LOCAL_STORAGE_SECRET") or secrets.token_hex(32)
+LOCAL_STORAGE_CHUNK_SIZE = 1024 * 1024
+
+# Makes replacing an object's data and metadata one step for readers
+_commit_lock = threading.Lock()
+
+def _sign(method: str, name: str, expires: int):
+    message = f"{method}\n{name}\n{expires}".encode()
+    return hmac.new(LOCAL_STORAGE_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def _write_json(path: str, data: dict):
+    temp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(temp_path, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(temp_path, path)
+
+class LocalBucket:
+    """Bucket whose objects are files under ``root``"""
+
+    def __init__(self, root: str = LOCAL_STORAGE_ROOT, base_url: str = LOCAL_STORAGE_URL, name: str = 'local'):
+        self.name = name
+        self.root = os.path.abspath(root)
+        self.base_url = base_url
+        self.uploads_dir = os.path.join(self.root, 'uploads')
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def blob(self, blob_name: str, chunk_size: Optional[int] = None):
+        return LocalBlob(self, blob_name, chunk_size)
+
+    def get_blob(self, blob_name: str):
+        """The object with its metadata loaded, or None if there is none"""
+        blob = self.blob(blob_name)
+        try:
+            blob.reload()
+        except exceptions.NotFound:
+            return None
+        return blob
+
+    def copy_blob(self, blob, destination_bucket, new_name: Optional[str] = None,
+                  if_generation_match: Optional[int] = None, **kwargs):
+        """Copy an object's data and content type; like Cloud Storage, the copy isn't public"""
+        metadata, handle = self._open(blob.name)
+        with handle, destination_bucket._temp_file() as temp:
+            shutil.copyfileobj(handle, temp, LOCAL_STORAGE_CHUNK_SIZE)
+        copy = destination_bucket.blob(new_name or blob.name)
+        return copy._load(destination_bucket._commit(copy.name, temp.name, {
+            'size': metadata['size'],
+            'md5_hash': metadata['md5_hash'],
+            'content_type': metadata['content_type'],
+            'public': False,
+        }, if_generation_match))
+
+    def _paths(self, name: str):
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        data_path = os.path.join(self.root, 'objects', digest[:2], digest)
+        return data_path, f"{data_path}.json"
+
+    def _read_metadata(self, name: str):
+        try:
+            with open(self._paths(name)[1]) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
+
+    def _temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.uploads_dir, suffix='.tmp', delete=False)
+
+    def _commit(self, name: str, temp_path: str, metadata: dict, if_generation_match: Optional[int] = None):
+        """Move ``temp_path`` into place as object ``name`` and return its metadata"""
+        data_path, metadata_path = self._paths(name)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        with _commit_lock:
+            current = self._read_metadata(name)
+            if if_generation_match is not None and (current or {}).get('generation', 0) != if_generation_match:
+                os.remove(temp_path)
+                raise exceptions.PreconditionFailed(f"Generation of {name} does not match {if_generation_match}")
+            metadata = {
+                **metadata,
+                'name': name,
+                'generation': max(time.time_ns(), (current or {}).get('generation', 0) + 1),
+                'updated': datetime.now(timezone.utc).isoformat(),
+            }
+            os.replace(temp_path, data_path)
+            _write_json(metadata_path, metadata)
+        return metadata
+
+    def _update_metadata(self, name: str, changes: dict):
+        with _commit_lock:
+            metadata = self._read_metadata(name)
+            if metadata is None:
+                raise exceptions.NotFound(f"No such object: {self.name}/{name}")
+            metadata.update(changes)
+            _write_json(self._paths(name)[1], metadata)
+        return metadata
+
+    def _delete(self, name: str, if_generation_match: Optional[int] = None):
+        data_path, metadata_path = self._paths(name)
+        with _commit_lock:
+            metadata = self._read_metadata(name)
+            if metadata is None:
+                raise exceptions.NotFound(f"No such object: {self.name}/{name}")
+            if if_generation_match is not None and metadata['generation'] != if_generation_match:
+                raise exceptions.PreconditionFailed(f"Generation of {name} does not match {if_generation_match}")
+            os.remove(metadata_path)
+            os.remove(data_path)
+
+    def _open(self, name: str):
+        """``(metadata, open file)`` for the current version of an object"""
+        with _commit_lock:
+            metadata = self._read_metadata(name)
+            if metadata is None:
+                raise exceptions.NotFound(f"No such object: {self.name}/{name}")
+            return metadata, open(self._paths(name)[0], 'rb')
+
+class LocalBlob:
+    """One object in a ``LocalBucket``; metadata attributes are set by reload and writes"""
+
+    def __init__(self, bucket: LocalBucket, name: str, chunk_size: Optional[int] = None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.size = None
+        self.md5_hash = None
+        self.generation = None
+        self.content_type = None
+        self.updated = None
+        self.public = False
+
+    def _load(self, metadata: dict):
+        self.size = metadata['size']
+        self.md5_hash = metadata['md5_hash']
+        self.generation = metadata['generation']
+        self.content_type = metadata['content_type']
+        self.updated = datetime.fromisoformat(metadata['updated'])
+        self.public = metadata.get('public', False)
+        return self
+
+    @property
+    def public_url(self):
+        return f"{self.bucket.base_url}{ROUTE_PREFIX}/o/{quote(self.name, safe='')}"
+
+    def exists(self, **kwargs):
+        return self.bucket._read_metadata(self.name) is not None
+
+    def reload(self, **kwargs):
+        metadata = self.bucket._read_metadata(self.name)
+        if metadata is None:
+            raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        self._load(metadata)
+
+    def upload_from_file(self, file_obj, rewind: bool = False, size: Optional[int] = None,
+                         content_type: Optional[str] = None, if_generation_match: Optional[int] = None, **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        chunk_size = self.chunk_size or LOCAL_STORAGE_CHUNK_SIZE
+        md5 = hashlib.md5()
+        total = 0
+        with self.bucket._temp_file() as temp:
+            try:
+                while size is None or total < size:
+                    chunk = file_obj.read(chunk_size if size is None else min(chunk_size, size - total))
+                    if not chunk:
+                        break
+                    temp.write(chunk)
+                    md5.update(chunk)
+                    total += len(chunk)
+            except BaseException:
+                os.remove(temp.name)
+                raise
+        self._load(self.bucket._commit(self.name, temp.name, {
+            'size': total,
+            'md5_hash': base64.b64encode(md5.digest()).decode(),
+            'content_type': content_type or 'application/octet-stream',
+            'public': False,
+        }, if_generation_match))
+
+    def upload_from_string(self, data, content_type: str = 'text/plain', if_generation_match: Optional[int] = None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.bucket._temp_file() as temp:
+            temp.write(data)
+        self._load(self.bucket._commit(self.name, temp.name, {
+            'size': len(data),
+            'md5_hash': base64.b64encode(hashlib.md5(data).digest()).decode(),
+            'content_type': content_type,
+            'public': False,
+        }, if_generation_match))
+
+    def download_as_bytes(self, start: Optional[int] = None, end: Optional[int] = None,
+                          if_generation_match: Optional[int] = None, **kwargs):
+        """Bytes ``start`` through ``end`` (inclusive), read through a memory map"""
+        metadata, handle = self.bucket._open(self.name)
+        with handle:
+            if if_generation_match is not None and metadata['generation'] != if_generation_match:
+                raise exceptions.PreconditionFailed(f"Generation of {self.name} does not match {if_generation_match}")
+            self._load(metadata)
+            first = start or 0
+            last = metadata['size'] - 1 if end is None else min(end, metadata['size'] - 1)
+            if first > last:
+                return b''
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[first:last + 1]
+
+    def download_to_file(self, file_obj, **kwargs):
+        metadata, handle = self.bucket._open(self.name)
+        with handle:
+            self._load(metadata)
+            shutil.copyfileobj(handle, file_obj, LOCAL_STORAGE_CHUNK_SIZE)
+
+    def delete(self, if_generation_match: Optional[int] = None, **kwargs):
+        self.bucket._delete(self.name, if_generation_match)
+
+    def make_public(self, **kwargs):
+        self._load(self.bucket._update_metadata(self.name, {'public': True}))
+
+    def generate_signed_url(self, expiration=None, method: str = 'GET', **kwargs):
+        """URL the object can be read from until ``expiration`` without being public"""
+        if isinstance(expiration, timedelta):
+            expires = time.time() + expiration.total_seconds()
+        elif isinstance(expiration, datetime):
+            expires = expiration.timestamp()
+        else:
+            expires = time.time() + (expiration or 3600)
+        expires = int(expires)
+        return f"{self.public_url}?expires={expires}&signature={_sign(method, self.name, expires)}"
+
+    def create_resumable_upload_session(self, content_type: Optional[str] = None, size: Optional[int] = None,
+                                        origin: Optional[str] = None, if_generation_match: Optional[int] = None, **kwargs):
+        """Start an upload session; its URL accepts the data with ``PUT``"""
+        session_id = secrets.token_urlsafe(24)
+        open(os.path.join(self.bucket.uploads_dir, f"{session_id}.part"), 'wb').close()
+        _write_json(os.path.join(self.bucket.uploads_dir, f"{session_id}.json"), {
+            'name': self.name,
+            'content_type': content_type or 'application/octet-stream',
+            'size': size,
+            'if_generation_match': if_generation_match,
+            'created': time.time(),
+        })
+        return f"{self.bucket.base_url}{ROUTE_PREFIX}/upload/{session_id}"
+
+_bucket = None
+
+def local_bucket():
+    """The bucket at ``LOCAL_STORAGE_ROOT``, created on first use"""
+    global _bucket
+    if _bucket is None:
+        _bucket = LocalBucket()
+    return _bucket
+
+def object_resource(metadata: dict):
+    """Object metadata as the Cloud Storage JSON API returns it"""
+    return {
+        'kind': 'storage#object',
+        'bucket': local_bucket().name,
+        'name': metadata['name'],
+        'size': str(metadata['size']),
+        'md5Hash': metadata['md5_hash'],
+        'generation': str(metadata['generation']),
+        'contentType': metadata['content_type'],
+        'updated': metadata['updated'],
+    }
+
+class LocalFileResponse(FileResponse):
+    """File response that lets the server send the file itself when it can"""
+
+    async def __call__(self, scope, receive, send):
+        if "http.response.pathsend" not in scope.get("extensions", {}) or scope.get("method") == "HEAD":
+            return await super().__call__(scope, receive, send)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.pathsend", "path": self.path})
+
+async def ranged_chunks(blob: LocalBlob, start: int, end: int):
+    """Bytes ``start`` through ``end`` of the object's current generation, in chunks"""
+    for offset in range(start, end + 1, LOCAL_STORAGE_CHUNK_SIZE):
+        last = min(offset + LOCAL_STORAGE_CHUNK_SIZE, end + 1) - 1
+        yield await storage_call(blob.download_as_bytes, start=offset, end=last, if_generation_match=blob.generation)
+
+@router.get("/o/{name:path}")
+async def download_object(name: str, request: Request, expires: Optional[int] = None, signature: Optional[str] = None):
+    """Serve an object at its public or signed URL"""
+    blob = await storage_call(local_bucket().get_blob, name)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="No such object")
+    if signature is not None:
+        if expires is None or expires < time.time() or not hmac.compare_digest(signature, _sign('GET', name, expires)):
+            raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    elif not blob.public:
+        raise HTTPException(status_code=403, detail="Object is not public")
+
+    headers = {'ETag': f'"{blob.generation}"', 'x-goog-generation': str(blob.generation), 'Accept-Ranges': 'bytes'}
+    byte_range = parse_range(request.headers.get('range'), blob.size) if blob.size else None
+    if byte_range is None:
+        data_path = local_bucket()._paths(name)[0]
+        stat_result = await storage_call(os.stat, data_path)
+        return LocalFileResponse(data_path, media_type=blob.content_type, headers=headers, stat_result=stat_result)
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{blob.size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(ranged_chunks(blob, start, end), status_code=206, media_type=blob.content_type, headers=headers)
+
+def _finish_upload(session_id: str, session: dict):
+    """Turn a session's received data into its object"""
+    bucket = local_bucket()
+    part_path = os.path.join(bucket.uploads_dir, f"{session_id}.part")
+    md5 = hashlib.md5()
+    size = 0
+    with open(part_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(LOCAL_STORAGE_CHUNK_SIZE), b''):
+            md5.update(chunk)
+            size += len(chunk)
+    try:
+        return bucket._commit(session['name'], part_path, {
+            'size': size,
+            'md5_hash': base64.b64encode(md5.digest()).decode(),
+            'content_type': session['content_type'],
+            'public': False,
+        }, session.get('if_generation_match'))
+    finally:
+        os.remove(os.path.join(bucket.uploads_dir, f"{session_id}.json"))
+
+@router.put("/upload/{session_id}")
+async def upload_session_data(session_id: str, request: Request):
+    """Receive all or part of a resumable upload session's data"""
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', session_id):
+        raise HTTPException(status_code=404, detail="No such upload session")
+    uploads_dir = local_bucket().uploads_dir
+    session_path = os.path.join(uploads_dir, f"{session_id}.json")
+    part_path = os.path.join(uploads_dir, f"{session_id}.part")
+    try:
+        with open(session_path) as handle:
+            session = json.load(handle)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="No such upload session")
+    received = await storage_call(os.path.getsize, part_path)
+
+    # Content-Range: "bytes first-last/total", "bytes first-last/*" or "bytes */total"
+    content_range = request.headers.get('content-range')
+    match = re.fullmatch(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', (content_range or '').strip())
+    if content_range and not match:
+        raise HTTPException(status_code=400, detail="Invalid Content-Range")
+    first = int(match.group(1)) if match and match.group(1) else None
+    total = int(match.group(3)) if match and match.group(3) != '*' else None
+    if match and first is not None and first != received:
+        raise HTTPException(status_code=400, detail=f"Expected data from byte {received}")
+    if total is not None and session.get('size') is not None and total != session['size']:
+        raise HTTPException(status_code=400, detail="Upload size does not match the session")
+
+    if first is not None or not content_range:
+        with open(part_path, 'ab') as handle:
+            async for chunk in request.stream():
+                await storage_call(handle.write, chunk)
+                received += len(chunk)
+        if not content_range:
+            total = received
+
+    if total is None or received < total:
+        # Resume Incomplete, telling the client how much was kept
+        headers = {'Range': f'bytes=0-{received - 1}'} if received else {}
+        return Response(status_code=308, headers=headers)
+    if received > total or (session.get('size') is not None and received != session['size']):
+        raise HTTPException(status_code=400, detail="Upload size does not match the session")
+    try:
+        metadata = await storage_call(_finish_upload, session_id, session)
+    except exceptions.PreconditionFailed:
+        raise HTTPException(status_code=412, detail="Object already exists")
+    return JSONResponse(object_resource(metadata))
@@ -0,0 +1,310 @@
+"""Structured logging that keeps formatting and writing off the request path.
+
+``setup_logging`` installs a ``QueueHandler`` on the root logger. Code that
+logs on the event loop only puts the record on an in-memory queue. Every
+``LOG_FLUSH_SECONDS`` a writer thread takes everything queued, formats it
+(one JSON object per line by default) and writes it to stdout in one go.
+Batching keeps thread wake-ups, which cost more than the logging itself,
+to a few per second. When ``LOG_QUEUE_SIZE`` records are waiting, new ones
+are dropped and counted rather than blocking the request, and the count is
+written out as a warning.
+
+``RequestLogMiddleware`` gives each request an id, taken from an incoming
+``X-Request-ID`` header or generated, and returns it in the same header.
+Every record logged while the request runs carries that id, its method and
+its route. When the request finishes, one access line is written with its
+status and duration.
+
+Sampling keeps the volume of busy routes down. Each request is kept or
+dropped as a whole, at its route's rate:
+
+- ``LOG_SAMPLE_RATE``: the default rate
+- ``LOG_ROUTE_SAMPLE_RATES``: rates for particular routes, e.g.
+  ``/api/files/list=0.05,/api/community/files=0.01``
+
+A dropped request logs nothing below WARNING. Warnings and errors, 5xx
+responses, and requests slower than ``LOG_SLOW_REQUEST_MS`` are always
+logged.
+
+Other settings:
+
+- ``LOG_LEVEL``: the minimum level (``INFO`` by default)
+- ``LOG_FORMAT``: ``json`` or ``text``
+- ``LOG_QUEUE_SIZE``: how many records can wait for the writer thread
+- ``LOG_FLUSH_SECONDS``: how often the writer thread writes
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", 0.1))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+LOG_SLOW_REQUEST_MS = float(os.getenv("LOG_SLOW_REQUEST_MS", 1000))
+
+def parse_sample_rates(value: str):
+    """``route=rate,...`` to a dict of rates"""
+    rates = {}
+    for item in value.split(','):
+        route, _, rate = item.strip().rpartition('=')
+        if route:
+            rates[route] = float(rate)
+    return rates
+
+LOG_ROUTE_SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_ROUTE_SAMPLE_RATES", ""))
+
+# Attributes every LogRecord has; anything else was passed with ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class RequestContext:
+    """What records logged during a request are tagged with"""
+
+    __slots__ = ('request_id', 'method', 'scope', 'sampled')
+
+    def __init__(self, request_id: str, method: str, scope: dict, sampled: Optional[bool] = None):
+        self.request_id = request_id
+        self.method = method
+        self.scope = scope
+        # Decided once the route is known
+        self.sampled = sampled
+
+    @property
+    def route(self):
+        route = self.scope.get('route')
+        return route.path if route is not None else None
+
+    def is_sampled(self):
+        if self.sampled is None:
+            route = self.route
+            if route is None:
+                # Not routed yet; decide once it is
+                return True
+            rate = LOG_ROUTE_SAMPLE_RATES.get(route, LOG_SAMPLE_RATE)
+            self.sampled = rate >= 1 or random.random() < rate
+        return self.sampled
+
+_request_context: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar('simsync_log_context', default=None)
+
+class SamplingFilter(logging.Filter):
+    """Drops records below WARNING from requests that weren't sampled"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        context = _request_context.get()
+        return context is None or context.is_sampled()
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: records that don't fit are counted and dropped.
+
+    ``prepare`` runs on the logging thread, so it only captures what can't be
+    read later (the message and the request context). Formatting is left to
+    the writer thread.
+    """
+
+    def __init__(self, log_queue, max_size: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        context = _request_context.get()
+        if context is not None:
+            record.request_id = context.request_id
+            record.method = context.method
+            record.route = context.route
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue has no bound of its own, but puts without taking a lock
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+    def take_dropped(self):
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with any ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class LogWriter:
+    """Thread that writes queued records in batches"""
+
+    def __init__(self, queue_handler: DroppingQueueHandler, stream, formatter: logging.Formatter,
+                 interval: float = LOG_FLUSH_SECONDS):
+        self.queue_handler = queue_handler
+        self.stream = stream
+        self.formatter = formatter
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="simsync-log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        records = []
+        log_queue = self.queue_handler.queue
+        while True:
+            try:
+                records.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        dropped = self.queue_handler.take_dropped()
+        if dropped:
+            records.append(logging.LogRecord('simsync.logs', logging.WARNING, __file__, 0,
+                                             f"Dropped {dropped} log records: the log queue was full", None, None))
+        if not records:
+            return
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record) + '\n')
+            except Exception:
+                lines.append(f"Unformattable log record: {record.msg!r}\n")
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except Exception:
+            pass
+
+_writer = None
+
+def setup_logging(stream=None):
+    """Route all logging through the queue and its writer thread; safe to call twice"""
+    global _writer
+    if _writer is not None:
+        return _writer
+
+    if LOG_FORMAT == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    queue_handler = DroppingQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    # uvicorn's own records go through the queue too; its access log is
+    # replaced by RequestLogMiddleware's sampled one
+    for name in ('uvicorn', 'uvicorn.error'):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    logging.getLogger('uvicorn.access').disabled = True
+
+    _writer = LogWriter(queue_handler, stream or sys.stdout, formatter)
+    _writer.start()
+    atexit.register(stop_logging)
+    return _writer
+
+def _restart_after_fork():
+    """A forked worker has no writer thread; start one on a queue of its own"""
+    global _writer
+    if _writer is not None:
+        queue_handler = _writer.queue_handler
+        # Records queued before the fork are the parent's to write
+        queue_handler.queue = queue.SimpleQueue()
+        queue_handler.dropped = 0
+        _writer = LogWriter(queue_handler, _writer.stream, _writer.formatter, _writer.interval)
+        _writer.start()
+
+# Servers that preload the app (gunicorn --preload) fork after setup_logging
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+def stop_logging():
+    """Write out queued records and stop the writer thread"""
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+access_logger = logging.getLogger('simsync.access')
+
+class RequestLogMiddleware:
+    """ASGI middleware tagging records with the request and writing a sampled access line"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope['headers']:
+            if name == b'x-request-id':
+                request_id = value.decode('latin-1')[:64]
+                break
+        context = RequestContext(request_id or uuid.uuid4().hex, scope['method'], scope)
+        token = _request_context.set(context)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_id(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', context.request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            if status >= 500 or duration_ms >= LOG_SLOW_REQUEST_MS:
+                context.sampled = True
+            if access_logger.isEnabledFor(logging.INFO) and context.is_sampled():
+                access_logger.info(
+                    f"{scope['method']} {context.route or scope['path']} {status} {duration_ms:.1f}ms",
+                    extra={'status': status, 'duration_ms': round(duration_ms, 1)},
+                )
+            _request_context.reset(token)
@@ -0,0 +1,631 @@
+"""In-memory stand-in for the Firestore client.
+
+``MemoryFirestore`` implements the part of ``google.cloud.firestore.Client``
+the routes use: documents and subcollections; ``set`` (with ``merge``),
+``update``, ``create`` and ``delete``; the ``Increment``, ``SERVER_TIMESTAMP``
+and ``DELETE_FIELD`` sentinels; queries with ``where``, ``order_by``,
+``start_after``, ``limit`` and ``select``; count, sum and avg aggregations;
+``get_all``; write batches; and transactions that work with
+``firestore.transactional``.
+
+Transactions are optimistic. Documents read in a transaction are checked
+again at commit, and a conflicting write aborts the commit, which
+``firestore.transactional`` retries as it would with Firestore. Reads after
+writes and batches over 500 writes fail the same way they do against
+Firestore, so code that runs here also runs there.
+
+Data only lives as long as the process, so a deployment using this must run
+a single worker.
+"""
+import copy
+import functools
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, NamedTuple, Optional
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+
+# Firestore's limit on writes in one commit
+MAX_WRITES_PER_COMMIT = 500
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+INEQUALITY_OPERATORS = {'<', '<=', '>', '>=', '!=', 'not-in'}
+OPERATORS = INEQUALITY_OPERATORS | {'==', 'in', 'array_contains', 'array_contains_any'}
+
+_MISSING = object()
+
+class _Stored(NamedTuple):
+    data: dict  # never mutated once stored; writes store a new dict
+    version: int
+    create_time: datetime
+    update_time: datetime
+
+class TransformResult(NamedTuple):
+    """The fields of the ``Value`` a field transform produced"""
+    integer_value: int = 0
+    double_value: float = 0.0
+    timestamp_value: Optional[datetime] = None
+
+class WriteResult(NamedTuple):
+    update_time: datetime
+    transform_results: list
+
+class AggregationResult(NamedTuple):
+    alias: str
+    value: Any
+    read_time: Optional[datetime] = None
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _normalize(value):
+    """Copy ``value`` the way Firestore would return it: datetimes in UTC, lists for tuples"""
+    if isinstance(value, datetime):
+        # Naive datetimes are local time, as the Firestore client treats them
+        return value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+def _get_field(data: dict, field_path: str):
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _project(data: dict, field_paths):
+    projected = {}
+    for field_path in field_paths:
+        value = _get_field(data, field_path)
+        if value is not _MISSING:
+            _write_field(projected, field_path.split('.'), value, [])
+    return projected
+
+def _leaves(data: dict, prefix=()):
+    """``(path parts, value)`` for every non-map value, and every empty map, in ``data``"""
+    for key, value in data.items():
+        path = prefix + (key,)
+        if isinstance(value, dict) and value:
+            yield from _leaves(value, path)
+        else:
+            yield path, value
+
+def _number_result(value):
+    if isinstance(value, int):
+        return TransformResult(integer_value=value)
+    return TransformResult(double_value=value)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _write_field(document: dict, parts, value, transform_results: list):
+    """Apply one field write or transform to ``document`` in place"""
+    parent = document
+    for part in parts[:-1]:
+        child = parent.get(part)
+        if not isinstance(child, dict):
+            child = parent[part] = {}
+        parent = child
+    name = parts[-1]
+    current = parent.get(name)
+
+    if value is transforms.DELETE_FIELD:
+        parent.pop(name, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        parent[name] = _now()
+        transform_results.append(TransformResult(timestamp_value=parent[name]))
+    elif isinstance(value, transforms.Increment):
+        parent[name] = (current if _is_number(current) else 0) + value.value
+        transform_results.append(_number_result(parent[name]))
+    elif isinstance(value, transforms.Maximum):
+        parent[name] = max(current, value.value) if _is_number(current) else value.value
+        transform_results.append(_number_result(parent[name]))
+    elif isinstance(value, transforms.Minimum):
+        parent[name] = min(current, value.value) if _is_number(current) else value.value
+        transform_results.append(_number_result(parent[name]))
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        items += [item for item in _normalize(value.values) if item not in items]
+        parent[name] = items
+        transform_results.append(TransformResult())
+    elif isinstance(value, transforms.ArrayRemove):
+        removed = _normalize(value.values)
+        parent[name] = [item for item in current if item not in removed] if isinstance(current, list) else []
+        transform_results.append(TransformResult())
+    else:
+        parent[name] = _normalize(value)
+
+def _apply_write(old: Optional[dict], op: str, data: Optional[dict], merge: bool):
+    """Document data after one write (None once deleted) and its transform results"""
+    transform_results = []
+    if op == 'delete':
+        return None, transform_results
+    if op == 'create' and old is not None:
+        raise exceptions.AlreadyExists("Document already exists")
+    if op == 'update' and old is None:
+        raise exceptions.NotFound("No document to update")
+
+    if op == 'update':
+        document = copy.deepcopy(old)
+        for field_path, value in data.items():
+            parts = field_path.split('.')
+            if isinstance(value, dict):
+                # A map value replaces the whole field
+                _write_field(document, parts, {}, transform_results)
+                for sub_parts, sub_value in _leaves(value):
+                    _write_field(document, parts + list(sub_parts), sub_value, transform_results)
+            else:
+                _write_field(document, parts, value, transform_results)
+        return document, transform_results
+
+    document = copy.deepcopy(old) if merge and old is not None else {}
+    for parts, value in _leaves(data):
+        if value is transforms.DELETE_FIELD and not merge:
+            raise ValueError("Cannot delete a field outside update() or set(merge=True)")
+        _write_field(document, list(parts), value, transform_results)
+    return document, transform_results
+
+def _rank(value):
+    """Sort key following Firestore's ordering of values across types"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, bytes):
+        return (5, value)
+    if isinstance(value, MemoryDocument):
+        return (6, value.path)
+    if isinstance(value, list):
+        return (8, [_rank(item) for item in value])
+    if isinstance(value, dict):
+        return (9, sorted((key, _rank(item)) for key, item in value.items()))
+    return (7, str(value))
+
+def _compare(a, b):
+    a, b = _rank(a), _rank(b)
+    return (a > b) - (a < b)
+
+def _field_value(doc_id: str, data: dict, field_path: str):
+    return doc_id if field_path == '__name__' else _get_field(data, field_path)
+
+def _matches(doc_id: str, data: dict, field_path: str, op: str, value):
+    actual = _field_value(doc_id, data, field_path)
+    if actual is _MISSING:
+        return False
+    if op == '==':
+        return _compare(actual, value) == 0
+    if op == '!=':
+        return actual is not None and _compare(actual, value) != 0
+    if op == 'in':
+        return any(_compare(actual, item) == 0 for item in value)
+    if op == 'not-in':
+        return actual is not None and all(_compare(actual, item) != 0 for item in value)
+    if op == 'array_contains':
+        return isinstance(actual, list) and any(_compare(item, value) == 0 for item in actual)
+    if op == 'array_contains_any':
+        return isinstance(actual, list) and any(_compare(item, wanted) == 0 for item in actual for wanted in value)
+    # Range comparisons only match values of the same type
+    if _rank(actual)[0] != _rank(value)[0]:
+        return False
+    order = _compare(actual, value)
+    return {'<': order < 0, '<=': order <= 0, '>': order > 0, '>=': order >= 0}[op]
+
+class MemorySnapshot:
+    """Read-only view of a document at the time it was read"""
+
+    def __init__(self, reference, stored: Optional[_Stored], field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = stored is not None
+        self.create_time = stored.create_time if stored else None
+        self.update_time = stored.update_time if stored else None
+        self.read_time = _now()
+        self._data = None
+        if stored is not None:
+            self._data = stored.data if field_paths is None else _project(stored.data, field_paths)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field_path: str):
+        if not self.exists:
+            return None
+        value = _get_field(self._data, field_path)
+        if value is _MISSING:
+            raise KeyError(f"'{field_path}' is not contained in the data")
+        return copy.deepcopy(value)
+
+class MemoryDocument:
+    """Reference to ``{collection path}/{id}``"""
+
+    def __init__(self, client, collection_path: str, document_id: str):
+        if not document_id or '/' in document_id:
+            raise ValueError(f"Invalid document id: {document_id!r}")
+        self._client = client
+        self._collection_path = collection_path
+        self.id = document_id
+
+    @property
+    def path(self):
+        return f"{self._collection_path}/{self.id}"
+
+    @property
+    def parent(self):
+        return MemoryCollection(self._client, self._collection_path)
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryDocument) and other._client is self._client and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, collection_id: str):
+        return MemoryCollection(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths=None, transaction=None):
+        if transaction is not None:
+            transaction._check_read()
+        stored = self._client._lookup(self._collection_path, self.id)
+        if transaction is not None:
+            transaction._record_read(self._collection_path, self.id, stored)
+        return MemorySnapshot(self, stored, field_paths)
+
+    def set(self, document_data: dict, merge: bool = False):
+        return self._client._commit([('set', self, document_data, merge)])[0]
+
+    def update(self, field_updates: dict, option=None):
+        return self._client._commit([('update', self, field_updates, False)])[0]
+
+    def create(self, document_data: dict):
+        return self._client._commit([('create', self, document_data, False)])[0]
+
+    def delete(self, option=None):
+        return self._client._commit([('delete', self, None, False)])[0].update_time
+
+class MemoryQuery:
+    """Immutable query over one collection; each method returns a new query"""
+
+    def __init__(self, client, collection_path: str):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = ()
+        self._orders = ()
+        self._limit = None
+        self._offset = 0
+        self._start = None
+        self._projection = None
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        for name, value in changes.items():
+            setattr(query, f"_{name}", value)
+        return query
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in OPERATORS:
+            raise ValueError(f"Unsupported operator: {op_string}")
+        if isinstance(value, MemoryDocument) and field_path == '__name__':
+            value = value.id
+        return self._copy(filters=self._filters + ((field_path, op_string, _normalize(value)),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip: int):
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, False))
+
+    def start_at(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, True))
+
+    def _effective_orders(self):
+        """Explicit orders, then inequality fields, then the document id"""
+        orders = list(self._orders)
+        ordered = {field_path for field_path, _ in orders}
+        for field_path, op, _ in self._filters:
+            if op in INEQUALITY_OPERATORS and field_path not in ordered:
+                orders.append((field_path, ASCENDING))
+                ordered.add(field_path)
+        if '__name__' not in ordered:
+            orders.append(('__name__', orders[-1][1] if orders else ASCENDING))
+        return orders
+
+    def _cursor_values(self, orders):
+        cursor, _ = self._start
+        if isinstance(cursor, MemorySnapshot):
+            return [_field_value(cursor.id, cursor._data or {}, field_path) for field_path, _ in orders]
+        values = []
+        for field_path, _ in orders:
+            if field_path not in cursor:
+                break
+            values.append(_normalize(cursor[field_path]))
+        return values
+
+    def _run(self, transaction=None):
+        """Matching ``(id, stored)`` pairs in query order"""
+        if transaction is not None:
+            transaction._check_read()
+        documents = self._client._documents(self._collection_path)
+        orders = self._effective_orders()
+        matched = [
+            (doc_id, stored) for doc_id, stored in documents
+            if all(_matches(doc_id, stored.data, *condition) for condition in self._filters)
+            # Documents without an ordered field are left out, as in Firestore
+            and all(_field_value(doc_id, stored.data, field_path) is not _MISSING for field_path, _ in orders)
+        ]
+
+        def compare_order(values_a, values_b):
+            for (_, direction), a, b in zip(orders, values_a, values_b):
+                order = _compare(a, b)
+                if order:
+                    return -order if direction == DESCENDING else order
+            return 0
+
+        keyed = [([_field_value(doc_id, stored.data, field_path) for field_path, _ in orders], doc_id, stored) for doc_id, stored in matched]
+        keyed.sort(key=functools.cmp_to_key(lambda a, b: compare_order(a[0], b[0])))
+        if self._start is not None:
+            cursor = self._cursor_values(orders)
+            inclusive = self._start[1]
+            keyed = [
+                item for item in keyed
+                if (compare_order(item[0][:len(cursor)], cursor) >= 0 if inclusive else compare_order(item[0][:len(cursor)], cursor) > 0)
+            ]
+        keyed = keyed[self._offset:]
+        if self._limit is not None:
+            keyed = keyed[:self._limit]
+        if transaction is not None:
+            for _, doc_id, stored in keyed:
+                transaction._record_read(self._collection_path, doc_id, stored)
+        return [(doc_id, stored) for _, doc_id, stored in keyed]
+
+    def stream(self, transaction=None):
+        for doc_id, stored in self._run(transaction):
+            reference = MemoryDocument(self._client, self._collection_path, doc_id)
+            yield MemorySnapshot(reference, stored, self._projection)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def count(self, alias: str = None):
+        return MemoryAggregation(self).count(alias)
+
+    def sum(self, field_path: str, alias: str = None):
+        return MemoryAggregation(self).sum(field_path, alias)
+
+    def avg(self, field_path: str, alias: str = None):
+        return MemoryAggregation(self).avg(field_path, alias)
+
+class MemoryCollection(MemoryQuery):
+    """Reference to a collection; also the query over all of its documents"""
+
+    @property
+    def id(self):
+        return self._collection_path.rsplit('/', 1)[-1]
+
+    def document(self, document_id: str = None):
+        # Firestore generates 20 character ids
+        return MemoryDocument(self._client, self._collection_path, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data: dict, document_id: str = None):
+        reference = self.document(document_id)
+        return reference.create(document_data).update_time, reference
+
+    def list_documents(self):
+        return [MemoryDocument(self._client, self._collection_path, doc_id) for doc_id, _ in self._client._documents(self._collection_path)]
+
+class MemoryAggregation:
+    """``count``, ``sum`` and ``avg`` over a query's results"""
+
+    def __init__(self, query: MemoryQuery, aggregations=()):
+        self._query = query
+        self._aggregations = aggregations
+
+    def _add(self, kind: str, field_path: Optional[str], alias: Optional[str]):
+        alias = alias or f"field_{len(self._aggregations) + 1}"
+        return MemoryAggregation(self._query, self._aggregations + ((kind, field_path, alias),))
+
+    def count(self, alias: str = None):
+        return self._add('count', None, alias)
+
+    def sum(self, field_path: str, alias: str = None):
+        return self._add('sum', field_path, alias)
+
+    def avg(self, field_path: str, alias: str = None):
+        return self._add('avg', field_path, alias)
+
+    def get(self, transaction=None):
+        documents = self._query._run(transaction)
+        read_time = _now()
+        results = []
+        for kind, field_path, alias in self._aggregations:
+            if kind == 'count':
+                value = len(documents)
+            else:
+                numbers = [value for value in (_get_field(stored.data, field_path) for _, stored in documents) if _is_number(value)]
+                if kind == 'sum':
+                    value = sum(numbers)
+                else:
+                    value = sum(numbers) / len(numbers) if numbers else None
+            results.append(AggregationResult(alias, value, read_time))
+        return [results]
+
+    def stream(self, transaction=None):
+        yield from self.get(transaction)
+
+class _Writes:
+    """Write methods shared by batches and transactions"""
+
+    def _add_write(self, op: str, reference: MemoryDocument, data, merge: bool = False):
+        self._writes.append((op, reference, data, merge))
+
+    def set(self, reference: MemoryDocument, document_data: dict, merge: bool = False):
+        self._add_write('set', reference, document_data, merge)
+
+    def update(self, reference: MemoryDocument, field_updates: dict, option=None):
+        self._add_write('update', reference, field_updates)
+
+    def create(self, reference: MemoryDocument, document_data: dict):
+        self._add_write('create', reference, document_data)
+
+    def delete(self, reference: MemoryDocument, option=None):
+        self._add_write('delete', reference, None)
+
+class MemoryWriteBatch(_Writes):
+    """Writes applied together by ``commit``, all or none"""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self):
+        results = self._client._commit(self._writes)
+        self._writes = []
+        return results
+
+class MemoryTransaction(_Writes):
+    """Transaction for ``firestore.transactional``: buffers writes, checks reads at commit"""
+
+    def __init__(self, client, max_attempts: int = 5, read_only: bool = False):
+        self._client = client
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._reads = {}
+        self._writes = []
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _add_write(self, op: str, reference: MemoryDocument, data, merge: bool = False):
+        if self._read_only:
+            raise ValueError("Cannot perform write operation in read-only transaction.")
+        super()._add_write(op, reference, data, merge)
+
+    def _check_read(self):
+        if self._writes:
+            raise ValueError("Attempted read after write in a transaction.")
+
+    def _record_read(self, collection_path: str, doc_id: str, stored: Optional[_Stored]):
+        # The first read is what the transaction's decisions were based on
+        self._reads.setdefault((collection_path, doc_id), stored.version if stored else 0)
+
+    def _begin(self, retry_id=None):
+        if self._id is not None:
+            raise ValueError("The transaction has already begun.")
+        self._id = uuid.uuid4().bytes
+
+    def _clean_up(self):
+        self._id = None
+        self._reads = {}
+        self._writes = []
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        if self._id is None:
+            raise ValueError("The transaction is not in progress.")
+        try:
+            return self._client._commit(self._writes, self._reads)
+        finally:
+            self._clean_up()
+
+    def get(self, ref_or_query, field_paths=None):
+        if isinstance(ref_or_query, MemoryDocument):
+            return iter([ref_or_query.get(field_paths=field_paths, transaction=self)])
+        return ref_or_query.stream(transaction=self)
+
+class MemoryFirestore:
+    """Firestore client whose documents live in this process"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # collection path -> {document id: _Stored}
+        self._collections = {}
+        self._version = 0
+
+    def collection(self, *collection_path: str):
+        return MemoryCollection(self, '/'.join(collection_path))
+
+    def document(self, *document_path: str):
+        collection_path, _, document_id = '/'.join(document_path).rpartition('/')
+        return MemoryDocument(self, collection_path, document_id)
+
+    def batch(self):
+        return MemoryWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False):
+        return MemoryTransaction(self, max_attempts, read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for reference in references:
+            yield reference.get(field_paths=field_paths, transaction=transaction)
+
+    def _lookup(self, collection_path: str, doc_id: str):
+        with self._lock:
+            return self._collections.get(collection_path, {}).get(doc_id)
+
+    def _documents(self, collection_path: str):
+        with self._lock:
+            return list(self._collections.get(collection_path, {}).items())
+
+    def _commit(self, writes, reads=None):
+        """Apply ``writes`` atomically; ``reads`` maps documents to the versions they must still have"""
+        if len(writes) > MAX_WRITES_PER_COMMIT:
+            raise exceptions.InvalidArgument(f"maximum {MAX_WRITES_PER_COMMIT} writes allowed per request")
+        with self._lock:
+            for (collection_path, doc_id), version in (reads or {}).items():
+                stored = self._collections.get(collection_path, {}).get(doc_id)
+                if (stored.version if stored else 0) != version:
+                    raise exceptions.Aborted("Transaction lost a race with a concurrent write")
+
+            now = _now()
+            self._version += 1
+            staged = {}
+            results = []
+            for op, reference, data, merge in writes:
+                key = (reference._collection_path, reference.id)
+                old = staged[key] if key in staged else self._collections.get(key[0], {}).get(key[1])
+                document, transform_results = _apply_write(old.data if old else None, op, data, merge)
+                staged[key] = None if document is None else _Stored(
+                    document, self._version, old.create_time if old else now, now
+                )
+                results.append(WriteResult(now, transform_results))
+
+            for (collection_path, doc_id), stored in staged.items():
+                documents = self._collections.setdefault(collection_path, {})
+                if stored is None:
+                    documents.pop(doc_id, None)
+                else:
+                    documents[doc_id] = stored
+            return results
@@ -0,0 +1,349 @@
+"""Request and backend metrics, served at ``/metrics`` in Prometheus text format.
+
+``MetricsMiddleware`` times every request and counts it by method, route
+template and status, and tracks the requests in flight. Every blocking
+Firebase, Storage and Stripe call goes through ``routes.executor``, which
+reports it here with ``record_backend_call``. A context variable ties the
+call to the request it was made for, and the call is charged to that
+request's route when it finishes. That shows which endpoint makes which
+calls:
+
+- calls and time per backend (``firestore``, ``storage``, ``auth``,
+  ``stripe``, ``local``) and operation
+- Firestore documents read and written, counted the way Firestore bills
+  them: a query reads at least one document and an aggregation counts as
+  one. Reads and writes inside a transaction aren't broken down; the
+  transaction counts as one call, named after its function.
+- bytes sent to and received from Cloud Storage by uploads and downloads
+
+Calls made outside a request, such as background jobs, are charged to the
+``background`` route. Metrics are kept per worker process, so every worker
+needs to be scraped. If ``METRICS_TOKEN`` is set, ``/metrics`` requires it
+as a bearer token.
+
+Setting ``PROFILE_SLOW_REQUEST_MS`` turns on a sampling profiler. While
+requests are in flight, a thread samples every thread's stack each
+``PROFILE_INTERVAL_MS``. When a request is slower than the threshold, the
+samples taken while it ran are written to ``PROFILE_DIR`` as folded stacks,
+which ``flamegraph.pl`` and speedscope read directly. The samples cover the
+whole process, so concurrent requests show up in them too. Each route
+writes at most one profile per ``PROFILE_COOLDOWN_SECONDS``.
+"""
+import contextvars
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", 0))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_COOLDOWN_SECONDS = float(os.getenv("PROFILE_COOLDOWN_SECONDS", 60))
+PROFILE_MAX_SAMPLES = int(os.getenv("PROFILE_MAX_SAMPLES", 20000))
+
+BACKGROUND_ROUTE = 'background'
+# Requests that matched no route, e.g. 404s and CORS preflights
+UNMATCHED_ROUTE = 'unmatched'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FIRESTORE_WRITES = {'set', 'update', 'create', 'delete'}
+STORAGE_UPLOADS = {'upload_from_file', 'upload_from_string', 'upload_from_filename', 'stream_upload'}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in [*zip(names, values), *extra]]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    """A counter or gauge with a fixed set of label names"""
+
+    def __init__(self, name: str, help: str, labels=(), kind: str = 'counter'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.kind = kind
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+    def render(self):
+        return '\n'.join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Histogram(Metric):
+    """Observations counted into cumulative ``le`` buckets, with their sum"""
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels, kind='histogram')
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # Per-bucket counts, then +Inf, then the sum
+                series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(series)) for label_values, series in self._values.items())
+        for label_values, series in values:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], series):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [('le', bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+REQUESTS = Metric('simsync_http_requests_total', "HTTP requests by method, route and status", ['method', 'route', 'status'])
+REQUEST_SECONDS = Histogram('simsync_http_request_duration_seconds', "HTTP request latency, including streaming the body", ['method', 'route'])
+REQUESTS_IN_FLIGHT = Metric('simsync_http_requests_in_flight', "HTTP requests being handled", kind='gauge')
+BACKEND_CALLS = Metric('simsync_backend_calls_total', "Blocking backend calls by route, backend and operation", ['route', 'backend', 'operation'])
+BACKEND_SECONDS = Metric('simsync_backend_seconds_total', "Time spent in blocking backend calls", ['route', 'backend'])
+FIRESTORE_READS = Metric('simsync_firestore_documents_read_total', "Firestore documents read, as billed", ['route'])
+FIRESTORE_WRITTEN = Metric('simsync_firestore_documents_written_total', "Firestore documents written", ['route'])
+STORAGE_BYTES = Metric('simsync_storage_bytes_total', "Bytes sent to and received from Cloud Storage", ['route', 'direction'])
+
+METRICS = [
+    REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, BACKEND_CALLS, BACKEND_SECONDS,
+    FIRESTORE_READS, FIRESTORE_WRITTEN, STORAGE_BYTES,
+]
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+class RequestStats:
+    """Backend usage of one request, charged to its route when it finishes"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.reads = 0
+        self.writes = 0
+        self.sent = 0
+        self.received = 0
+        self.finished = False
+
+    def charge(self, route: str):
+        for (backend, operation), calls in self.calls.items():
+            BACKEND_CALLS.inc(route, backend, operation, amount=calls)
+        for backend, seconds in self.seconds.items():
+            BACKEND_SECONDS.inc(route, backend, amount=seconds)
+        if self.reads:
+            FIRESTORE_READS.inc(route, amount=self.reads)
+        if self.writes:
+            FIRESTORE_WRITTEN.inc(route, amount=self.writes)
+        if self.sent:
+            STORAGE_BYTES.inc(route, 'sent', amount=self.sent)
+        if self.received:
+            STORAGE_BYTES.inc(route, 'received', amount=self.received)
+
+_current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar('simsync_request_stats', default=None)
+
+def operation_name(func):
+    """Label for a blocking call: the method or function name"""
+    # firestore.transactional wraps the function it runs
+    func = getattr(func, 'to_wrap', func)
+    if isinstance(func, functools.partial):
+        func = func.func
+    return getattr(func, '__name__', type(func).__name__).lstrip('_')
+
+def firestore_usage(operation: str, result):
+    """``(documents read, documents written)`` by a Firestore call"""
+    if operation == 'commit':
+        return 0, len(result)
+    if operation in FIRESTORE_WRITES:
+        return 0, 1
+    if isinstance(result, list):
+        if result and isinstance(result[0], list):
+            # Aggregation query
+            return 1, 0
+        # A query reads one document even when it matches none
+        return (len(result) if operation == 'batch_get' else max(len(result), 1)), 0
+    if hasattr(result, 'exists') and hasattr(result, 'reference'):
+        return 1, 0
+    return 0, 0
+
+def storage_transfer(operation: str, blob, result):
+    """``(bytes sent, bytes received)`` by a Cloud Storage call on ``blob``"""
+    if isinstance(result, (bytes, bytearray)):
+        return 0, len(result)
+    size = getattr(blob, 'size', None) or 0
+    if operation == 'download_to_file':
+        return 0, size
+    if operation in STORAGE_UPLOADS:
+        return size, 0
+    return 0, 0
+
+def record_backend_call(backend: str, operation: Optional[str], func, args, result, seconds: float):
+    """Charge a finished blocking call to the current request (or ``background``)"""
+    stats = _current_request.get()
+    background = stats is None or stats.finished
+    if background:
+        stats = RequestStats()
+    operation = operation or operation_name(func)
+    stats.calls[(backend, operation)] += 1
+    stats.seconds[backend] += seconds
+    if result is not None:
+        if backend == 'firestore':
+            reads, writes = firestore_usage(operation, result)
+            stats.reads += reads
+            stats.writes += writes
+        elif backend == 'storage':
+            blob = getattr(func, '__self__', None) or (args[0] if args else None)
+            sent, received = storage_transfer(operation, blob, result)
+            stats.sent += sent
+            stats.received += received
+    if background:
+        stats.charge(BACKGROUND_ROUTE)
+
+# Innermost frames of threads that are waiting for work, left out of profiles
+IDLE_FRAMES = {
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+    ('threading.py', 'wait'),
+}
+
+def _fold(frame):
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+        return None
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class SamplingProfiler:
+    """Samples all thread stacks while requests run; writes profiles of slow ones"""
+
+    def __init__(self, threshold_ms: float, interval_ms: float = PROFILE_INTERVAL_MS,
+                 directory: str = PROFILE_DIR, cooldown: float = PROFILE_COOLDOWN_SECONDS):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.cooldown = cooldown
+        self._samples = deque(maxlen=PROFILE_MAX_SAMPLES)
+        self._active = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_dump = {}
+
+    def request_started(self):
+        self._active += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="simsync-profiler", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def request_finished(self, method: str, route: str, started: float, elapsed: float):
+        self._active -= 1
+        if elapsed < self.threshold:
+            return
+        now = time.monotonic()
+        if now - self._last_dump.get(route, float('-inf')) < self.cooldown:
+            return
+        self._last_dump[route] = now
+        stacks = Counter(stack for taken, stack in list(self._samples) if taken >= started)
+        if not stacks:
+            return
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        path = os.path.join(self.directory, f"{int(time.time() * 1000)}-{method}-{slug}-{int(elapsed * 1000)}ms.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+            logging.warning(f"Slow request {method} {route} took {elapsed * 1000:.0f}ms; profile written to {path}")
+        except OSError as e:
+            logging.error(f"Writing profile {path} failed: {e}")
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            self._wake.clear()
+            if self._active <= 0:
+                self._wake.wait()
+                continue
+            taken = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = _fold(frame)
+                if stack:
+                    self._samples.append((taken, f"{names.get(thread_id, thread_id)};{stack}"))
+            time.sleep(self.interval)
+
+profiler = SamplingProfiler(PROFILE_SLOW_REQUEST_MS) if PROFILE_SLOW_REQUEST_MS > 0 else None
+
+class MetricsMiddleware:
+    """ASGI middleware recording request metrics and charging backend calls to routes"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        status = 500
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        if profiler:
+            profiler.request_started()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_request.reset(token)
+            stats.finished = True
+            REQUESTS_IN_FLIGHT.dec()
+            # Set by FastAPI's router once the request matched a route
+            route = scope['route'].path if 'route' in scope else UNMATCHED_ROUTE
+            REQUESTS.inc(scope['method'], route, str(status))
+            REQUEST_SECONDS.observe(elapsed, scope['method'], route)
+            stats.charge(route)
+            if profiler:
+                profiler.request_finished(scope['method'], route, started, elapsed)
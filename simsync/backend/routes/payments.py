@@ -1,14 +1,22 @@
 """Payment routes for Stripe integration."""
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-import stripe
+import logging
 import os
 from typing import Dict, Any
-from datetime import datetime
-from .firebase_config import get_firestore_client
+from .executor import stripe_call
+from .stripe_events import STRIPE_WEBHOOK_SECRET, InvalidWebhook, record_event, verify_event
 
-# Initialize Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+_stripe = None
+
+def get_stripe():
+    """The Stripe SDK, imported and configured on first use rather than at startup"""
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+        _stripe = stripe
+    return _stripe
 
 router = APIRouter()
 
@@ -32,6 +40,7 @@ async def create_checkout_session(payment_request: PaymentRequest) -> Dict[str,
     Raises:
         HTTPException: If session creation fails
     """
+    stripe = get_stripe()
     try:
         # Get price ID from environment
         price_id = os.getenv("STRIPE_PRICE_ID")
@@ -39,7 +48,8 @@ async def create_checkout_session(payment_request: PaymentRequest) -> Dict[str,
             raise HTTPException(status_code=500, detail="Stripe price ID not configured")
             
         # Create checkout session
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price': price_id,
@@ -51,6 +61,10 @@ async def create_checkout_session(payment_request: PaymentRequest) -> Dict[str,
             client_reference_id=payment_request.user_id,
             metadata={
                 'user_id': payment_request.user_id
+            },
+            # So subscription updates and cancellations name the user too
+            subscription_data={
+                'metadata': {'user_id': payment_request.user_id}
             }
         )
         
@@ -62,50 +76,33 @@ async def create_checkout_session(payment_request: PaymentRequest) -> Dict[str,
         raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
 
 @router.post("/webhook")
-async def stripe_webhook(request: Dict[str, Any]) -> Dict[str, str]:
+async def stripe_webhook(request: Request) -> Dict[str, str]:
     """
-    Handle Stripe webhook events.
+    Receive a Stripe webhook event.
+    
+    The signature is checked and the event recorded; subscription changes
+    are applied by a background job (see routes.stripe_events), so Stripe
+    gets its answer without waiting on the user's profile.
     
     Args:
-        request: Stripe webhook payload
+        request: Request carrying the event and its Stripe-Signature header
         
     Returns:
         Dict with success status
+        
+    Raises:
+        HTTPException: If the event isn't correctly signed
     """
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Stripe webhook secret not configured")
+    payload = await request.body()
     try:
-        # In production, verify the webhook signature here
-        event = request
-        
-        # Handle successful payment
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            user_id = session.get('client_reference_id')
-            
-            if user_id:
-                print(f"Payment successful for user: {user_id}")
-                
-                # Update user's subscription in Firestore
-                try:
-                    db = get_firestore_client()
-                    
-                    user_data = {
-                        'subscription_tier': 'premium',
-                        'subscription_status': 'active',
-                        'storage_limit': 500,  # 500MB for premium
-                        'updated_at': datetime.now(),
-                        'premium_activated_at': datetime.now(),
-                        'stripe_session_id': session.get('id'),
-                        'stripe_customer_id': session.get('customer')
-                    }
-                    
-                    db.collection('users').document(user_id).update(user_data)
-                    print(f"User {user_id} upgraded to premium successfully")
-                    
-                except Exception as db_error:
-                    print(f"Error updating user subscription in database: {db_error}")
-                    # Don't fail the webhook, log the error
-                
-        return {"status": "success"}
-        
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Webhook error: {str(e)}")
\ No newline at end of file
+        event = verify_event(get_stripe(), payload, request.headers.get('stripe-signature'))
+    except InvalidWebhook as e:
+        raise HTTPException(status_code=400, detail=f"Webhook error: {str(e)}")
+    
+    if await record_event(event):
+        logging.info(f"Queued Stripe event {event['id']} ({event['type']})")
+    else:
+        logging.info(f"Stripe event {event['id']} ({event['type']}) was already received")
+    return {"status": "success"}
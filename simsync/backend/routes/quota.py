@@ -0,0 +1,206 @@
+"""Per-user fixed-window quotas, applied as FastAPI dependencies.
+
+``daily_quota(scope)`` authenticates the request and counts it against the
+user's daily limit for ``scope`` (e.g. ``downloads``). Limits depend on the
+subscription tier; a missing limit means unlimited and costs nothing.
+
+Counters live in a pluggable backend chosen with ``QUOTA_BACKEND``:
+
+- ``firestore`` (default): one ``quotas/{uid}_{scope}_{day}`` document per
+  user, scope and UTC day. A check is a single ``Increment`` write whose
+  result carries the new count, so it needs no read and no transaction.
+  Documents carry ``expires_at`` for a Firestore TTL policy to delete them.
+- ``memory``: an in-process counter for local development and single-worker
+  deployments.
+
+If the endpoint fails after the quota was taken, the unit is given back.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from fastapi import Depends, HTTPException, Response
+from firebase_admin import firestore
+
+from .auth import verify_token
+from .executor import firestore_call
+from .firebase_config import get_firestore_client
+from .user_profiles import get_user_profile
+
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "firestore")
+QUOTAS_COLLECTION = 'quotas'
+DAY_SECONDS = 24 * 60 * 60
+# Keep window documents a little past their window before TTL cleanup
+QUOTA_RETENTION_SECONDS = int(os.getenv("QUOTA_RETENTION_SECONDS", 2 * DAY_SECONDS))
+
+def _limit(name: str, default: Optional[int] = None):
+    """Daily limit from the environment; unset, empty or 0 means unlimited"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if not value.strip() or int(value) <= 0:
+        return None
+    return int(value)
+
+# Daily limits by subscription tier and scope; missing means unlimited
+DAILY_LIMITS = {
+    'basic': {
+        'downloads': _limit("BASIC_DAILY_DOWNLOADS", 10),
+        'uploads': _limit("BASIC_DAILY_UPLOADS"),
+        'shares': _limit("BASIC_DAILY_SHARES"),
+    },
+    'premium': {
+        'downloads': _limit("PREMIUM_DAILY_DOWNLOADS"),
+        'uploads': _limit("PREMIUM_DAILY_UPLOADS"),
+        'shares': _limit("PREMIUM_DAILY_SHARES"),
+    },
+}
+
+LIMIT_MESSAGES = {
+    'downloads': "Daily download limit reached. Upgrade to Premium for unlimited downloads!",
+    'uploads': "Daily upload limit reached. Upgrade to Premium for more uploads!",
+    'shares': "Daily share limit reached. Upgrade to Premium for more shares!",
+}
+
+class Window(NamedTuple):
+    key: str
+    start: datetime
+    end: datetime
+
+class Usage(NamedTuple):
+    count: int
+    limit: int
+    reset_at: datetime
+
+    @property
+    def allowed(self):
+        return self.count <= self.limit
+
+    @property
+    def remaining(self):
+        return max(self.limit - self.count, 0)
+
+def fixed_window(user_id: str, scope: str, seconds: int = DAY_SECONDS, now: Optional[float] = None):
+    """Window containing ``now``; windows are aligned to the epoch (UTC days)"""
+    now = time.time() if now is None else now
+    start = int(now // seconds) * seconds
+    start_at = datetime.fromtimestamp(start, timezone.utc)
+    label = start_at.strftime('%Y%m%d') if seconds == DAY_SECONDS else str(start)
+    return Window(f"{user_id}_{scope}_{label}", start_at, start_at + timedelta(seconds=seconds))
+
+class MemoryQuotaBackend:
+    """Fixed-window counters held in this process"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def _purge(self, now: datetime):
+        for key in [key for key, (_, expires) in self._counts.items() if expires <= now]:
+            del self._counts[key]
+
+    async def hit(self, window: Window, amount: int = 1):
+        """Add ``amount`` to the window and return the new count"""
+        with self._lock:
+            if time.monotonic() >= self._next_purge:
+                self._purge(datetime.now(timezone.utc))
+                self._next_purge = time.monotonic() + 60
+            count, _ = self._counts.get(window.key, (0, None))
+            count += amount
+            self._counts[window.key] = (count, window.end)
+            return count
+
+class FirestoreQuotaBackend:
+    """Fixed-window counters in ``quotas/{key}`` documents"""
+
+    async def hit(self, window: Window, amount: int = 1):
+        """Add ``amount`` to the window with one atomic write and return the new count"""
+        doc_ref = get_firestore_client().collection(QUOTAS_COLLECTION).document(window.key)
+        result = await firestore_call(doc_ref.set, {
+            'count': firestore.Increment(amount),
+            'window_start': window.start,
+            'expires_at': window.end + timedelta(seconds=QUOTA_RETENTION_SECONDS),
+        }, merge=True)
+        # The commit response carries the value the increment produced
+        return int(result.transform_results[0].integer_value)
+
+QUOTA_BACKENDS = {
+    'firestore': FirestoreQuotaBackend,
+    'memory': MemoryQuotaBackend,
+}
+
+quota_backend = QUOTA_BACKENDS[QUOTA_BACKEND]()
+
+def daily_limit(profile: dict, scope: str):
+    """The profile's daily limit for ``scope``, or None for unlimited"""
+    tier = profile.get('subscription_tier', 'basic')
+    return DAILY_LIMITS.get(tier, DAILY_LIMITS['basic']).get(scope)
+
+async def consume_quota(user_id: str, scope: str, limit: int, amount: int = 1):
+    """Count ``amount`` uses of ``scope`` today; the result says whether it was allowed"""
+    window = fixed_window(user_id, scope)
+    count = await quota_backend.hit(window, amount)
+    return Usage(count=count, limit=limit, reset_at=window.end)
+
+async def refund_quota(user_id: str, scope: str, amount: int = 1):
+    """Give back units taken by ``consume_quota``"""
+    await quota_backend.hit(fixed_window(user_id, scope), -amount)
+
+def quota_headers(usage: Usage):
+    return {
+        'X-RateLimit-Limit': str(usage.limit),
+        'X-RateLimit-Remaining': str(usage.remaining),
+        'X-RateLimit-Reset': str(int(usage.reset_at.timestamp())),
+    }
+
+def quota_exceeded(scope: str, usage: Usage):
+    """429 response for a request over its daily limit"""
+    retry_after = max(int(usage.reset_at.timestamp() - time.time()), 1)
+    return HTTPException(
+        status_code=429,
+        detail=LIMIT_MESSAGES.get(scope, "Daily limit reached"),
+        headers={**quota_headers(usage), 'Retry-After': str(retry_after)}
+    )
+
+async def take_daily_quota(user_id: str, scope: str, amount: int = 1):
+    """Take ``amount`` units of today's ``scope`` quota, all or nothing.
+
+    For endpoints that only know the amount once they've read the body.
+    Returns the usage, or None if the user's tier is unlimited; raises 429 if
+    the units don't fit.
+    """
+    limit = daily_limit(await get_user_profile(user_id), scope)
+    if limit is None:
+        return None
+    usage = await consume_quota(user_id, scope, limit, amount)
+    if not usage.allowed:
+        await refund_quota(user_id, scope, amount)
+        raise quota_exceeded(scope, usage)
+    return usage
+
+def daily_quota(scope: str):
+    """Dependency that verifies the token and enforces the daily ``scope`` limit.
+
+    Use in place of ``Depends(verify_token)``; it yields the same user dict.
+    """
+    async def check_quota(response: Response, user = Depends(verify_token)):
+        limit = daily_limit(await get_user_profile(user['uid']), scope)
+        if limit is None:
+            yield user
+            return
+
+        usage = await consume_quota(user['uid'], scope, limit)
+        if not usage.allowed:
+            raise quota_exceeded(scope, usage)
+        response.headers.update(quota_headers(usage))
+        try:
+            yield user
+        except Exception:
+            # Failed requests don't count against the quota
+            await refund_quota(user['uid'], scope)
+            raise
+
+    return check_quota
@@ -0,0 +1,186 @@
+"""Stripe webhook events, recorded once and applied by background jobs.
+
+The webhook only checks the signature and records the event: one batch
+creates ``stripe_events/{event id}`` and an ``apply_stripe_event`` job (see
+``routes.jobs``), and the response goes back without waiting for the user's
+profile to change. Stripe sends an event again when it doesn't get a 2xx in
+time; the second ``create`` fails because the event document exists, so a
+redelivered event is acknowledged without recording another job.
+
+The job applies the event to ``users/{uid}`` in a transaction. Each profile
+remembers the ``created`` time, type and id of the last event applied to it,
+and an event that sorts before that (see ``event_order``), or the same one
+again (a job retried after its write went through), changes nothing, so
+events arriving out of order leave the profile as the newest one set it.
+``created`` only has one-second resolution; events from the same second are
+ordered with cancellations last, then by id, so concurrent workers always
+settle on the same profile. The event document ends up with ``status``:
+
+- ``queued``: recorded, not applied yet
+- ``applied``: the profile was updated
+- ``stale``: a newer event had already been applied
+- ``ignored``: an event type, or one without a user, we don't act on
+- ``dead_letter``: the job failed ``STRIPE_EVENT_MAX_ATTEMPTS`` times; its
+  ``last_error`` says why, and the document is kept for review
+
+Other documents expire after ``STRIPE_EVENT_RETENTION_SECONDS`` through a
+Firestore TTL policy on ``expires_at``. That has to be longer than Stripe
+keeps retrying an event (three days).
+"""
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gcs_exceptions
+
+from .executor import firestore_call
+from .firebase_config import get_firestore_client
+from .jobs import job_queue
+from .user_profiles import STORAGE_LIMITS_MB, invalidate_user_profile
+
+STRIPE_EVENTS_COLLECTION = 'stripe_events'
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Oldest signature timestamp accepted, against replayed requests
+STRIPE_WEBHOOK_TOLERANCE_SECONDS = int(os.getenv("STRIPE_WEBHOOK_TOLERANCE_SECONDS", 300))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", 8))
+STRIPE_EVENT_RETENTION_SECONDS = int(os.getenv("STRIPE_EVENT_RETENTION_SECONDS", 30 * 24 * 60 * 60))
+
+# Subscription statuses that keep premium; anything else falls back to basic
+PREMIUM_STATUSES = {'active', 'trialing', 'past_due'}
+
+class InvalidWebhook(Exception):
+    """The webhook request isn't a correctly signed Stripe event"""
+
+def verify_event(stripe, payload: bytes, signature: str):
+    """Check the ``Stripe-Signature`` header and return the event as a dict"""
+    if not signature:
+        raise InvalidWebhook("Missing Stripe-Signature header")
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload.decode('utf-8'), signature, STRIPE_WEBHOOK_SECRET, STRIPE_WEBHOOK_TOLERANCE_SECONDS
+        )
+        event = json.loads(payload)
+    except (stripe.error.SignatureVerificationError, UnicodeDecodeError, ValueError) as e:
+        raise InvalidWebhook(str(e))
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        raise InvalidWebhook("Not a Stripe event")
+    return event
+
+def profile_update(event: dict):
+    """``(user_id, fields)`` an event sets on the user's profile, or None"""
+    data = event.get('data', {}).get('object', {})
+    if event['type'] == 'checkout.session.completed':
+        user_id = data.get('client_reference_id') or data.get('metadata', {}).get('user_id')
+        fields = {
+            'subscription_tier': 'premium',
+            'subscription_status': 'active',
+            'storage_limit': STORAGE_LIMITS_MB['premium'],
+            'premium_activated_at': datetime.now(timezone.utc),
+            'stripe_session_id': data.get('id'),
+            'stripe_customer_id': data.get('customer'),
+        }
+    elif event['type'] in ('customer.subscription.updated', 'customer.subscription.deleted'):
+        # The checkout session copies the user id onto the subscription
+        user_id = data.get('metadata', {}).get('user_id')
+        status = 'canceled' if event['type'] == 'customer.subscription.deleted' else data.get('status')
+        tier = 'premium' if status in PREMIUM_STATUSES else 'basic'
+        fields = {
+            'subscription_tier': tier,
+            'subscription_status': status,
+            'storage_limit': STORAGE_LIMITS_MB[tier],
+            'stripe_customer_id': data.get('customer'),
+        }
+    else:
+        return None
+    if not user_id:
+        return None
+    return user_id, fields
+
+async def record_event(event: dict):
+    """Record ``event`` and queue the job applying it; False if it was already recorded"""
+    db = get_firestore_client()
+    now = datetime.now(timezone.utc)
+    event_ref = db.collection(STRIPE_EVENTS_COLLECTION).document(event['id'])
+    job_ref, job = job_queue.new_job('apply_stripe_event', {'event': event})
+    batch = db.batch()
+    batch.create(event_ref, {
+        'type': event['type'],
+        'created': event.get('created', 0),
+        'status': 'queued',
+        'job_id': job_ref.id,
+        'received_at': now,
+        'expires_at': now + timedelta(seconds=STRIPE_EVENT_RETENTION_SECONDS),
+    })
+    batch.set(job_ref, job)
+    try:
+        await firestore_call(batch.commit)
+    except gcs_exceptions.AlreadyExists:
+        # Stripe sent this event before
+        return False
+    job_queue.submit(job_ref.id)
+    return True
+
+def event_order(created: int, event_type: str, event_id: str):
+    """Sort key deciding which of two events for a user is the newer.
+
+    Stripe's ``created`` is in whole seconds, so ties are broken
+    deterministically: a cancellation is final within its second, and
+    otherwise the id decides.
+    """
+    return (created, event_type == 'customer.subscription.deleted', event_id)
+
+@firestore.transactional
+def _apply(transaction, user_ref, event_ref, event: dict, fields: dict):
+    """Update the profile unless a newer event (or this one) got there first"""
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise ValueError(f"User {user_ref.id} doesn't exist")
+    profile = snapshot.to_dict()
+    created = event.get('created', 0)
+    last_id = profile.get('stripe_event_id')
+    newer = last_id is None or event_order(created, event['type'], event['id']) > event_order(
+        profile.get('stripe_event_created', 0), profile.get('stripe_event_type', ''), last_id
+    )
+    if last_id == event['id'] or not newer:
+        status = 'applied' if last_id == event['id'] else 'stale'
+    else:
+        transaction.update(user_ref, {
+            **fields,
+            'stripe_event_id': event['id'],
+            'stripe_event_created': created,
+            'stripe_event_type': event['type'],
+            'updated_at': datetime.now(timezone.utc),
+        })
+        status = 'applied'
+    transaction.update(event_ref, {'status': status})
+    return status
+
+async def stripe_event_failed(payload: dict, error: str):
+    event_id = payload['event']['id']
+    event_ref = get_firestore_client().collection(STRIPE_EVENTS_COLLECTION).document(event_id)
+    await firestore_call(event_ref.update, {
+        'status': 'dead_letter',
+        'last_error': error,
+        'expires_at': firestore.DELETE_FIELD,
+    })
+    logging.error(f"Stripe event {event_id} ({payload['event']['type']}) moved to dead letter: {error}")
+
+@job_queue.handler('apply_stripe_event', max_attempts=STRIPE_EVENT_MAX_ATTEMPTS, on_failure=stripe_event_failed)
+async def apply_stripe_event(payload: dict):
+    """Job: apply one Stripe event to the profile of the user it is about"""
+    event = payload['event']
+    db = get_firestore_client()
+    event_ref = db.collection(STRIPE_EVENTS_COLLECTION).document(event['id'])
+    update = profile_update(event)
+    if update is None:
+        await firestore_call(event_ref.update, {'status': 'ignored'})
+        return
+    user_id, fields = update
+    user_ref = db.collection('users').document(user_id)
+    try:
+        status = await firestore_call(_apply, db.transaction(), user_ref, event_ref, event, fields)
+    finally:
+        invalidate_user_profile(user_id)
+    logging.info(f"Stripe event {event['id']} ({event['type']}) for user {user_id}: {status}")
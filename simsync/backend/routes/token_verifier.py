@@ -0,0 +1,124 @@
+"""Firebase ID token verification with a decoded-token cache.
+
+Tokens are checked by ``firebase_admin.auth.verify_id_token``, with every
+check it makes, plus Firebase's rule that ``auth_time`` is in the past.
+Verified tokens are cached by SHA-256 of the raw token until their ``exp``
+claim, so repeat requests with the same token skip those checks. Google's public signing certificates are kept in memory and
+refreshed in the background before they expire, so verification never
+waits on a fetch.
+
+``TOKEN_CHECK_REVOKED`` also asks Firebase Auth whether the token was
+revoked or the user disabled. That is one more call per verification, and
+a revocation only applies once the token's cache entry expires, at most
+``TOKEN_CACHE_MAX_TTL`` seconds later.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+
+import firebase_admin
+import google.auth.exceptions
+import google.auth.transport
+import google.auth.transport.requests
+from firebase_admin import auth
+
+from .cache import TTLCache
+from .executor import auth_call
+from .firebase_config import get_auth_client
+
+ID_TOKEN_CERT_URI = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+)
+
+# Seconds of clock skew tolerated on iat/exp (Firebase allows 0-60)
+TOKEN_CLOCK_SKEW_SECONDS = min(max(int(os.getenv("TOKEN_CLOCK_SKEW_SECONDS", 10)), 0), 60)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_MAX_TTL = int(os.getenv("TOKEN_CACHE_MAX_TTL", 3600))
+# Refresh certs this many seconds before their Cache-Control max-age runs out
+CERT_REFRESH_MARGIN = int(os.getenv("CERT_REFRESH_MARGIN", 300))
+TOKEN_CHECK_REVOKED = os.getenv("TOKEN_CHECK_REVOKED", "false").lower() == "true"
+
+token_cache = TTLCache(max_entries=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_MAX_TTL)
+
+class CachedCertRequest(google.auth.transport.Request):
+    """google-auth transport that serves the signing certs from memory.
+
+    Any other URL is passed through to a regular requests transport.
+    """
+
+    def __init__(self):
+        self._delegate = google.auth.transport.requests.Request()
+        self._response = None
+        self.expires_at = 0.0
+
+    def refresh(self):
+        """Fetch the certs and remember them for their Cache-Control max-age"""
+        response = self._delegate(ID_TOKEN_CERT_URI, method="GET")
+        if response.status != 200:
+            raise google.auth.exceptions.TransportError(
+                f"Could not fetch certificates at {ID_TOKEN_CERT_URI}"
+            )
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        max_age = int(match.group(1)) if match else 3600
+        self._response = response
+        self.expires_at = time.time() + max_age
+        return max_age
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if url == ID_TOKEN_CERT_URI and method == "GET":
+            if self._response is None or time.time() >= self.expires_at:
+                self.refresh()
+            return self._response
+        return self._delegate(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+cert_request = CachedCertRequest()
+
+def use_cached_certs():
+    """Make the default app's token verifier fetch certs through ``cert_request``"""
+    verifier = auth._get_client(firebase_admin.get_app())._token_verifier
+    # firebase_admin has no setting for the transport its verifier uses
+    if verifier.request is not cert_request:
+        verifier.request = cert_request
+
+def verify_firebase_token(token: str):
+    """Verify a Firebase ID token's signature and claims (blocking)"""
+    firebase_auth = get_auth_client()
+    use_cached_certs()
+    claims = firebase_auth.verify_id_token(
+        token,
+        check_revoked=TOKEN_CHECK_REVOKED,
+        clock_skew_seconds=TOKEN_CLOCK_SKEW_SECONDS,
+    )
+    # Firebase requires auth_time in the past, which firebase_admin doesn't check
+    auth_time = claims.get("auth_time")
+    if not isinstance(auth_time, (int, float)) or auth_time > time.time() + TOKEN_CLOCK_SKEW_SECONDS:
+        raise auth.InvalidIdTokenError("Firebase ID token has an invalid \"auth_time\" claim")
+    return claims
+
+def token_cache_key(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+async def verify_id_token_cached(token: str):
+    """Return decoded claims for ``token``, verifying it only on a cache miss"""
+    key = token_cache_key(token)
+    claims = token_cache.get(key)
+    if claims is not None:
+        return claims
+
+    claims = await auth_call(verify_firebase_token, token)
+    token_cache.set(key, claims, ttl=claims["exp"] + TOKEN_CLOCK_SKEW_SECONDS - time.time())
+    return claims
+
+async def refresh_certs_forever():
+    """Keep the signing certs warm; meant to run as a background task"""
+    while True:
+        try:
+            max_age = await auth_call(cert_request.refresh)
+            delay = max(max_age - CERT_REFRESH_MARGIN, 60)
+        except Exception as e:
+            logging.error(f"Signing cert refresh failed: {e}")
+            delay = 30
+        await asyncio.sleep(delay)
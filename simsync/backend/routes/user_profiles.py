@@ -0,0 +1,221 @@
+"""Shared, cached access to ``users/{uid}`` profile documents.
+
+Every router reads user profiles through ``get_user_profile`` so a request
+costs at most one Firestore read of the user document, and repeat requests
+within ``USER_CACHE_TTL`` seconds cost none. Writers must go through
+``update_user_profile`` (or call ``invalidate_user_profile``) so the cached
+copy is dropped. The cache is per worker process; other workers see a change
+once their entry expires.
+
+Profiles also carry the user's usage: ``file_count`` and
+``storage_used_bytes`` change in the same atomic write as the ``files``
+document they account for (see ``usage_increments``). Profiles created
+before that are reconciled from aggregation queries on first use, and
+``reconcile_all_usage`` repairs any drift in bulk.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from .cache import TTLCache
+from .executor import firestore_call, firestore_stream
+from .firebase_config import get_firestore_client
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+# Bulk usage reconciliation: how often, and how many users at once
+USAGE_RECONCILE_SECONDS = int(os.getenv("USAGE_RECONCILE_SECONDS", 24 * 60 * 60))
+USAGE_RECONCILE_CONCURRENCY = int(os.getenv("USAGE_RECONCILE_CONCURRENCY", 8))
+USAGE_RECONCILE_PAGE_SIZE = 500
+
+# Default storage limits (MB) and file limits by subscription tier; None is unlimited
+STORAGE_LIMITS_MB = {
+    'basic': int(os.getenv("BASIC_STORAGE_LIMIT_MB", 50)),
+    'premium': int(os.getenv("PREMIUM_STORAGE_LIMIT_MB", 500)),
+}
+FILE_LIMITS = {
+    'basic': int(os.getenv("BASIC_MAX_FILES", 25)),
+    'premium': None,
+}
+
+profile_cache = TTLCache(max_entries=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Reads in flight, so concurrent misses for the same user share one read
+_pending = {}
+
+def default_profile():
+    """Profile written for users seen for the first time"""
+    return {
+        'subscription_tier': 'basic',
+        'subscription_status': 'active',
+        'storage_used': 0,
+        'storage_limit': 50,
+        'file_count': 0,
+        'storage_used_bytes': 0,
+        'usage_reconciled_at': datetime.now(),
+        'created_at': datetime.now(),
+        'updated_at': datetime.now()
+    }
+
+async def _load_profile(user_id: str):
+    db = get_firestore_client()
+    user_ref = db.collection('users').document(user_id)
+    user_doc = await firestore_call(user_ref.get)
+    if user_doc.exists:
+        return user_doc.to_dict()
+
+    user_data = default_profile()
+    await firestore_call(user_ref.set, user_data)
+    return user_data
+
+def _finish_load(user_id: str, load: asyncio.Future):
+    # A load that was invalidated while in flight must not be cached
+    if _pending.get(user_id) is not load:
+        return
+    del _pending[user_id]
+    if not load.cancelled() and load.exception() is None:
+        profile_cache.set(user_id, load.result())
+
+async def get_user_profile(user_id: str):
+    """Return a copy of the user's profile, creating a basic-tier one if missing"""
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        load = _pending.get(user_id)
+        if load is None:
+            load = _pending[user_id] = asyncio.ensure_future(_load_profile(user_id))
+            load.add_done_callback(lambda done: _finish_load(user_id, done))
+        profile = await asyncio.shield(load)
+    return dict(profile)
+
+def invalidate_user_profile(user_id: str):
+    """Drop the cached profile after the user document changed"""
+    _pending.pop(user_id, None)
+    profile_cache.pop(user_id)
+
+async def update_user_profile(user_id: str, data: dict):
+    """Update the user document and invalidate its cached copy"""
+    db = get_firestore_client()
+    try:
+        await firestore_call(db.collection('users').document(user_id).update, data)
+    finally:
+        invalidate_user_profile(user_id)
+
+def storage_limit_mb(profile: dict):
+    """Storage limit in MB: the profile's own, else its tier's default"""
+    tier = profile.get('subscription_tier', 'basic')
+    return profile.get('storage_limit') or STORAGE_LIMITS_MB.get(tier, STORAGE_LIMITS_MB['basic'])
+
+def file_limit(profile: dict):
+    """Most files the user may store, or None for unlimited"""
+    return FILE_LIMITS.get(profile.get('subscription_tier', 'basic'), FILE_LIMITS['basic'])
+
+def usage_increments(file_count: int = 0, storage_used_bytes: int = 0):
+    """Profile update adjusting the user's usage; write it with ``merge=True``"""
+    return {
+        'file_count': firestore.Increment(file_count),
+        'storage_used_bytes': firestore.Increment(storage_used_bytes),
+    }
+
+async def commit_with_usage(batch, user_id: str, file_count: int = 0, storage_used_bytes: int = 0):
+    """Commit ``batch`` together with the matching change to the user's usage"""
+    user_ref = get_firestore_client().collection('users').document(user_id)
+    batch.set(user_ref, usage_increments(file_count, storage_used_bytes), merge=True)
+    try:
+        await firestore_call(batch.commit)
+    finally:
+        invalidate_user_profile(user_id)
+
+@firestore.transactional
+def _store_usage(transaction, user_ref, expected, totals):
+    snapshot = user_ref.get(transaction=transaction)
+    current = snapshot.to_dict() if snapshot.exists else {}
+    # Files were added or removed while aggregating; the totals may be stale
+    if (current.get('file_count'), current.get('storage_used_bytes')) != expected:
+        return False
+    transaction.set(user_ref, {**totals, 'usage_reconciled_at': datetime.now()}, merge=True)
+    return True
+
+async def reconcile_usage(user_id: str, attempts: int = 3):
+    """Recompute the user's file count and bytes stored from their files.
+
+    Uses one count/sum aggregation query. Returns ``(file_count,
+    storage_used_bytes)``. The totals are only stored if the profile's
+    counters did not change while aggregating; file writes adjust the
+    counters atomically, so that means the aggregation saw a consistent state.
+    """
+    db = get_firestore_client()
+    user_ref = db.collection('users').document(user_id)
+    query = (
+        db.collection('files')
+        .where(filter=FieldFilter('user_id', '==', user_id))
+        .count(alias='file_count')
+        .sum('size', alias='storage_used_bytes')
+    )
+    for _ in range(attempts):
+        user_doc = await firestore_call(user_ref.get)
+        current = user_doc.to_dict() if user_doc.exists else {}
+        expected = (current.get('file_count'), current.get('storage_used_bytes'))
+
+        result = await firestore_call(query.get)
+        totals = {aggregate.alias: int(aggregate.value or 0) for aggregate in result[0]}
+        stored = await firestore_call(_store_usage, db.transaction(), user_ref, expected, totals)
+        if stored:
+            invalidate_user_profile(user_id)
+            break
+    return totals['file_count'], totals['storage_used_bytes']
+
+async def get_usage(user_id: str):
+    """The user's profile with accurate ``file_count`` and ``storage_used_bytes``.
+
+    Costs one cached profile read; profiles that predate usage tracking are
+    reconciled once first.
+    """
+    profile = await get_user_profile(user_id)
+    if 'usage_reconciled_at' not in profile:
+        profile['file_count'], profile['storage_used_bytes'] = await reconcile_usage(user_id)
+    return profile
+
+async def get_file_count(user_id: str):
+    """Number of files the user owns"""
+    return (await get_usage(user_id))['file_count']
+
+async def reconcile_all_usage():
+    """Reconcile every user's usage, a page of users at a time.
+
+    Returns the number of profiles whose stored totals were wrong.
+    """
+    db = get_firestore_client()
+    users_ref = db.collection('users')
+    semaphore = asyncio.Semaphore(USAGE_RECONCILE_CONCURRENCY)
+    corrected = 0
+
+    async def reconcile(user_doc):
+        nonlocal corrected
+        async with semaphore:
+            stored = user_doc.to_dict()
+            totals = await reconcile_usage(user_doc.id)
+            if totals != (stored.get('file_count'), stored.get('storage_used_bytes')):
+                corrected += 1
+
+    query = users_ref.order_by('__name__').select(['file_count', 'storage_used_bytes']).limit(USAGE_RECONCILE_PAGE_SIZE)
+    page = await firestore_stream(query)
+    while page:
+        await asyncio.gather(*[reconcile(user_doc) for user_doc in page])
+        if len(page) < USAGE_RECONCILE_PAGE_SIZE:
+            break
+        page = await firestore_stream(query.start_after(page[-1]))
+    return corrected
+
+async def reconcile_usage_forever():
+    """Reconcile all users periodically; meant to run as a background task"""
+    while True:
+        await asyncio.sleep(USAGE_RECONCILE_SECONDS)
+        try:
+            corrected = await reconcile_all_usage()
+            logging.info(f"Usage reconciliation corrected {corrected} profiles")
+        except Exception as e:
+            logging.error(f"Usage reconciliation failed: {e}")
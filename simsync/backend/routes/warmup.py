@@ -0,0 +1,40 @@
+"""Create a worker's clients once it starts, instead of on its first requests.
+
+Clients are created lazily (see ``routes.firebase_config`` and
+``payments.get_stripe``), so a worker answers ``/health`` as soon as it is
+up. ``warm_up`` then creates them all at once on the blocking pool, so the
+first real requests don't wait for credentials, connections or SDK imports
+either. A request that needs a client before it is warm creates it itself;
+creation is locked or idempotent, so nothing is set up twice.
+
+``WARMUP`` decides what the lifespan does:
+
+- ``background`` (default): warm up while serving
+- ``wait``: finish warming up before serving, for platforms that route
+  traffic to a worker as soon as it accepts connections
+- ``off``: create every client on first use
+"""
+import asyncio
+import logging
+import os
+import time
+
+from .executor import run_blocking
+
+WARMUP = os.getenv("WARMUP", "background").lower()
+
+async def _warm(name, backend, func):
+    started = time.perf_counter()
+    try:
+        await run_blocking(backend, func)
+    except Exception as e:
+        # Not fatal: the first request that needs it tries again
+        logging.warning(f"Warm-up of {name} failed: {e}")
+        return
+    logging.info(f"Warmed up {name} in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+async def warm_up(hooks):
+    """Run each ``(name, backend, func)`` hook on the blocking pool, concurrently"""
+    started = time.perf_counter()
+    await asyncio.gather(*(_warm(name, backend, func) for name, backend, func in hooks))
+    logging.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f}ms")
@@ -0,0 +1,264 @@
+"""Deterministic, streaming ZIP writer.
+
+Entries are written with data descriptors, so nothing is buffered or seeked
+back to: each entry's CRC-32 and sizes follow its data. Entries over 4 GiB,
+archives over 4 GiB and archives with more than 65535 entries use ZIP64
+records.
+
+The same entries always produce the same bytes. When every entry is stored
+rather than deflated, the position of every byte is known up front:
+``zip_size`` gives the archive's length and ``stream_zip`` can start at any
+offset, which is what resuming an HTTP download with ``Range`` needs.
+
+Like ``routes.dbpf`` this only depends on the standard library.
+"""
+import struct
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, List, NamedTuple, Optional
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+FLAG_DATA_DESCRIPTOR = 0x0008
+FLAG_UTF8 = 0x0800
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+DEFLATE_LEVEL = 6
+
+class ZipEntry(NamedTuple):
+    name: str
+    size: int  # uncompressed size in bytes
+    modified: datetime
+    compress: bool = False
+    # A known CRC-32 lets a stream that starts past this entry skip reading it
+    crc32: Optional[int] = None
+
+class ZipError(ValueError):
+    """Raised when entry data doesn't match what the archive promised"""
+
+def dos_datetime(modified: datetime):
+    """MS-DOS (time, date) fields; DOS dates can't go before 1980"""
+    if modified.year < 1980:
+        return 0, (1 << 5) | 1
+    year = min(modified.year, 2107)
+    date = ((year - 1980) << 9) | (modified.month << 5) | modified.day
+    time = (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2)
+    return time, date
+
+def _is_zip64(entry: ZipEntry):
+    # Deflate can grow incompressible data slightly; leave room for that
+    max_size = entry.size + entry.size // 1000 + 1024 if entry.compress else entry.size
+    return max_size >= ZIP64_LIMIT
+
+def _local_header(entry: ZipEntry):
+    name = entry.name.encode('utf-8')
+    zip64 = _is_zip64(entry)
+    # Sizes and CRC go in the data descriptor; ZIP64 entries flag that with 0xFFFFFFFF
+    extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b''
+    sizes = ZIP64_LIMIT if zip64 else 0
+    time, date = dos_datetime(entry.modified)
+    return struct.pack(
+        '<IHHHHHIIIHH',
+        0x04034B50,
+        45 if zip64 else 20,
+        FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+        METHOD_DEFLATED if entry.compress else METHOD_STORED,
+        time, date,
+        0, sizes, sizes,
+        len(name), len(extra)
+    ) + name + extra
+
+def _descriptor(entry: ZipEntry, crc: int, compressed_size: int):
+    if _is_zip64(entry):
+        return struct.pack('<IIQQ', 0x08074B50, crc, compressed_size, entry.size)
+    return struct.pack('<IIII', 0x08074B50, crc, compressed_size, entry.size)
+
+def _descriptor_size(entry: ZipEntry):
+    return 24 if _is_zip64(entry) else 16
+
+def _central_header(entry: ZipEntry, crc: int, compressed_size: int, offset: int):
+    name = entry.name.encode('utf-8')
+    zip64 = _is_zip64(entry)
+    extra_fields = []
+    uncompressed_field, compressed_field, offset_field = entry.size, compressed_size, offset
+    if zip64:
+        extra_fields += [entry.size, compressed_size]
+        uncompressed_field = compressed_field = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        extra_fields.append(offset)
+        offset_field = ZIP64_LIMIT
+    extra = struct.pack(f'<HH{len(extra_fields)}Q', 0x0001, 8 * len(extra_fields), *extra_fields) if extra_fields else b''
+    version = 45 if extra_fields else 20
+    time, date = dos_datetime(entry.modified)
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII',
+        0x02014B50,
+        (3 << 8) | version,  # made by: Unix
+        version,
+        FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+        METHOD_DEFLATED if entry.compress else METHOD_STORED,
+        time, date,
+        crc, compressed_field, uncompressed_field,
+        len(name), len(extra), 0,
+        0, 0,
+        0o100644 << 16,  # regular file, rw-r--r--
+        offset_field
+    ) + name + extra
+
+def _central_header_size(entry: ZipEntry, offset: int):
+    fields = (2 if _is_zip64(entry) else 0) + (1 if offset >= ZIP64_LIMIT else 0)
+    return 46 + len(entry.name.encode('utf-8')) + (4 + 8 * fields if fields else 0)
+
+def _end_records(count: int, directory_offset: int, directory_size: int):
+    records = b''
+    if count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        zip64_end_offset = directory_offset + directory_size
+        records += struct.pack(
+            '<IQHHIIQQQQ', 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0,
+            count, count, directory_size, directory_offset
+        )
+        records += struct.pack('<IIQI', 0x07064B50, 0, zip64_end_offset, 1)
+    records += struct.pack(
+        '<IHHHHIIH', 0x06054B50, 0, 0,
+        min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+        min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0
+    )
+    return records
+
+def _end_records_size(count: int, directory_offset: int, directory_size: int):
+    zip64 = count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT
+    return 22 + (56 + 20 if zip64 else 0)
+
+def zip_size(entries: List[ZipEntry]):
+    """Length of the archive in bytes, or None if any entry is deflated"""
+    if any(entry.compress for entry in entries):
+        return None
+    offset = 0
+    directory_size = 0
+    for entry in entries:
+        directory_size += _central_header_size(entry, offset)
+        offset += len(_local_header(entry)) + entry.size + _descriptor_size(entry)
+    return offset + directory_size + _end_records_size(len(entries), offset, directory_size)
+
+def read_plan(entries: List[ZipEntry], start: int = 0):
+    """Entry data ``stream_zip`` will read when starting at ``start``.
+
+    A list of ``(index, offset)``: entry ``index`` is read from ``offset`` to
+    its end. Entries wholly before ``start`` are only read when their CRC-32
+    isn't known, and then from their beginning.
+    """
+    plan = []
+    position = 0
+    for index, entry in enumerate(entries):
+        data_start = position + len(_local_header(entry))
+        data_end = data_start + entry.size
+        if entry.size and (entry.crc32 is None or data_end > start):
+            skip = 0 if entry.crc32 is None else max(start - data_start, 0)
+            plan.append((index, skip))
+        position = data_end + _descriptor_size(entry)
+    return plan
+
+async def stream_zip(entries: List[ZipEntry], chunks: AsyncIterator[bytes], start: int = 0, offload=None, on_crc=None):
+    """Yield the archive's bytes from offset ``start``.
+
+    ``chunks`` yields the data described by ``read_plan(entries, start)`` in
+    that order, with no chunk spanning two entries. ``offload(func, *args)``
+    is awaited to run deflate off the event loop when given. ``on_crc(index,
+    crc)`` is called for every entry whose CRC-32 was computed here.
+    """
+    if start and zip_size(entries) is None:
+        raise ZipError("Only archives with no deflated entries can start part way")
+
+    plan = dict(read_plan(entries, start))
+    position = 0
+    central = []
+
+    def visible(data: bytes):
+        # The part of ``data`` (which starts at ``position``) at or after ``start``
+        if position + len(data) <= start:
+            return b''
+        return data[max(start - position, 0):]
+
+    async def run(func, *args):
+        return await offload(func, *args) if offload else func(*args)
+
+    for index, entry in enumerate(entries):
+        offset = position
+        header = _local_header(entry)
+        out = visible(header)
+        if out:
+            yield out
+        position += len(header)
+
+        crc = entry.crc32
+        compressed_size = entry.size
+        if entry.compress:
+            compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+            crc = 0
+            compressed_size = 0
+            remaining = entry.size
+            while remaining:
+                chunk = await _next_chunk(chunks, entry, remaining)
+                remaining -= len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                out = await run(compressor.compress, chunk)
+                if out:
+                    compressed_size += len(out)
+                    position += len(out)
+                    yield out
+            out = compressor.flush()
+            compressed_size += len(out)
+            position += len(out)
+            if out:
+                yield out
+            if entry.crc32 is not None and crc != entry.crc32:
+                raise ZipError(f"CRC-32 of {entry.name} changed")
+            if on_crc:
+                on_crc(index, crc)
+        elif index in plan:
+            skip = plan[index]
+            read_crc = 0
+            remaining = entry.size - skip
+            data_position = position + skip
+            while remaining:
+                chunk = await _next_chunk(chunks, entry, remaining)
+                remaining -= len(chunk)
+                if not skip:
+                    read_crc = zlib.crc32(chunk, read_crc)
+                if data_position + len(chunk) > start:
+                    yield chunk[max(start - data_position, 0):]
+                data_position += len(chunk)
+            position += entry.size
+            if not skip:
+                if entry.crc32 is not None and read_crc != entry.crc32:
+                    raise ZipError(f"CRC-32 of {entry.name} changed")
+                crc = read_crc
+                if on_crc and entry.crc32 is None:
+                    on_crc(index, crc)
+        else:
+            # Known CRC and nothing to send, or an empty entry
+            position += entry.size
+            if crc is None:
+                crc = 0
+
+        descriptor = _descriptor(entry, crc, compressed_size)
+        out = visible(descriptor)
+        if out:
+            yield out
+        position += len(descriptor)
+        central.append((entry, crc, compressed_size, offset))
+
+    directory_offset = position
+    directory = b''.join(_central_header(*record) for record in central)
+    out = visible(directory + _end_records(len(entries), directory_offset, len(directory)))
+    if out:
+        yield out
+
+async def _next_chunk(chunks: AsyncIterator[bytes], entry: ZipEntry, remaining: int):
+    try:
+        chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        raise ZipError(f"Data for {entry.name} ended early")
+    if not chunk or len(chunk) > remaining:
+        raise ZipError(f"Data for {entry.name} does not match its size")
+    return chunk
@@ -80,8 +80,23 @@ const Dashboard = () => {
     }
 
     const handleFileUpload = async (event) => {
-        const files = Array.from(event.target.files)
-        if (files.length === 0) return
+        const selectedFiles = Array.from(event.target.files)
+        if (selectedFiles.length === 0) return
+
+        // Skip files that are already backed up unchanged
+        let files = selectedFiles
+        try {
+            const manifest = await apiService.checkManifest(selectedFiles)
+            const neededPaths = new Set(manifest.needed.map(entry => entry.path))
+            files = selectedFiles.filter(file => neededPaths.has(apiService.getFilePath(file)))
+        } catch (error) {
+            console.error('Manifest check failed, uploading everything:', error)
+        }
+
+        if (files.length === 0) {
+            alert(`✅ All ${selectedFiles.length} file(s) are already backed up.`)
+            return
+        }
 
         // Check storage limits
         if (userInfo) {
@@ -93,9 +108,9 @@ const Dashboard = () => {
                 return
             }
             
-            // Check file count limits for basic users
-            if (userInfo.subscription_tier === 'basic' && backups.length + files.length > 25) {
-                alert(`Upload exceeds file limit!\n\nBasic users can store up to 25 files.\nYou currently have ${backups.length} files and are trying to upload ${files.length} more.\n\nUpgrade to Premium for unlimited files!`)
+            // Check file count limits (the server enforces both limits too)
+            if (userInfo.file_limit != null && userInfo.file_count + files.length > userInfo.file_limit) {
+                alert(`Upload exceeds file limit!\n\nBasic users can store up to ${userInfo.file_limit} files.\nYou currently have ${userInfo.file_count} files and are trying to upload ${files.length} more.\n\nUpgrade to Premium for unlimited files!`)
                 return
             }
         }
@@ -326,7 +341,7 @@ const Dashboard = () => {
     const loadCommunityFiles = async () => {
         try {
             console.log('Loading community files...')
-            const response = await apiService.getCommunityFiles(50, 0)
+            const response = await apiService.getCommunityFiles(50)
             setCommunityFiles(response.files || [])
             console.log('Loaded community files:', response.files?.length || 0)
             // Reset any cached ratings
@@ -75,12 +75,68 @@ class ApiService {
   }
 
   // File endpoints
+  // Sends the file straight to Cloud Storage over a resumable session, then
+  // asks the backend to record it (it is deduplicated there like any upload)
   async uploadFile(file) {
+    if (file.size === 0) {
+      return this.uploadFileViaApi(file)
+    }
+    const contentType = file.type || 'application/octet-stream'
+    const session = await this.makeRequest('/files/upload-session', {
+      method: 'POST',
+      body: JSON.stringify({
+        name: file.name,
+        size: file.size,
+        content_type: contentType,
+        path: this.getFilePath(file),
+        mtime: file.lastModified / 1000
+      })
+    })
+
+    let upload
+    try {
+      upload = await fetch(session.upload_url, {
+        method: 'PUT',
+        headers: { 'Content-Type': contentType },
+        body: file
+      })
+    } catch (error) {
+      // Network or CORS failure talking to storage: send it through the API instead,
+      // after cancelling the session so the upload isn't charged twice
+      console.error('Direct upload failed, falling back to API upload:', error)
+      await this.cancelUploadSession(session.upload_id)
+      return this.uploadFileViaApi(file)
+    }
+    if (!upload.ok) {
+      await this.cancelUploadSession(session.upload_id)
+      throw new Error(`Upload failed: ${upload.status}`)
+    }
+
+    return this.makeRequest(`/files/upload-session/${session.upload_id}/finalize`, {
+      method: 'POST'
+    })
+  }
+
+  // Abandons a direct upload session and gives back the upload quota it took
+  async cancelUploadSession(uploadId) {
+    try {
+      await this.makeRequest(`/files/upload-session/${uploadId}`, {
+        method: 'DELETE'
+      })
+    } catch (error) {
+      console.error('Cancelling upload session failed:', error)
+    }
+  }
+
+  // Uploads the file through the backend as multipart form data
+  async uploadFileViaApi(file) {
     try {
       const token = await this.getAuthToken()
       
       const formData = new FormData()
       formData.append('file', file)
+      formData.append('path', this.getFilePath(file))
+      formData.append('mtime', String(file.lastModified / 1000))
 
       const response = await fetch(`${this.baseURL}/files/upload`, {
         method: 'POST',
@@ -103,8 +159,37 @@ class ApiService {
     }
   }
 
+  // Relative path of a picked file (folder uploads keep their sub-folders)
+  getFilePath(file) {
+    return file.webkitRelativePath || file.name
+  }
+
+  // Ask the backend which of these files are not backed up yet
+  async checkManifest(files) {
+    const entries = files.map(file => ({
+      path: this.getFilePath(file),
+      size: file.size,
+      mtime: file.lastModified / 1000
+    }))
+    return this.makeRequest('/files/manifest', {
+      method: 'POST',
+      body: JSON.stringify({ entries })
+    })
+  }
+
+  // Fetches every page of the user's files
   async listFiles() {
-    return this.makeRequest('/files/list')
+    const files = []
+    let cursor = null
+    let totalCount = 0
+    do {
+      const query = `?page_size=500${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''}`
+      const page = await this.makeRequest(`/files/list${query}`)
+      files.push(...page.files)
+      totalCount = page.total_count
+      cursor = page.next_cursor
+    } while (cursor)
+    return { files, total_count: totalCount }
   }
 
   async deleteFile(fileId) {
@@ -113,6 +198,13 @@ class ApiService {
     })
   }
 
+  async batchDeleteFiles(fileIds) {
+    return this.makeRequest('/files/batch-delete', {
+      method: 'POST',
+      body: JSON.stringify({ file_ids: fileIds })
+    })
+  }
+
   // Payment methods
   async createCheckoutSession(userId, successUrl, cancelUrl) {
     return this.makeRequest('/payments/create-checkout-session', {
@@ -136,8 +228,19 @@ class ApiService {
     })
   }
 
-  async getCommunityFiles(limit = 50, offset = 0) {
-    return this.makeRequest(`/community/files?limit=${limit}&offset=${offset}`, {
+  async batchShareFiles(fileIds, description = '') {
+    return this.makeRequest('/community/batch-share', {
+      method: 'POST',
+      body: JSON.stringify({
+        file_ids: fileIds,
+        description: description
+      })
+    })
+  }
+
+  async getCommunityFiles(limit = 50, cursor = null, sort = 'newest') {
+    const cursorParam = cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''
+    return this.makeRequest(`/community/files?limit=${limit}&sort=${sort}${cursorParam}`, {
       method: 'GET'
     })
   }
@@ -172,10 +275,13 @@ export const {
   verifyUser,
   getUserInfo,
   uploadFile,
+  checkManifest,
   listFiles,
   deleteFile,
+  batchDeleteFiles,
   createCheckoutSession,
   shareFile,
+  batchShareFiles,
   getCommunityFiles,
   downloadCommunityFile,
   rateCommunityFile,
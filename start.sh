@@ -1,3 +1,3 @@
 #!/bin/bash
 cd simsync/backend
-python -m uvicorn main:app --host 0.0.0.0 --port $PORT
\ No newline at end of file
+python -m gunicorn -c gunicorn.conf.py main:app
\ No newline at end of file